@@ -1,17 +1,30 @@
+import os
+
 import numpy as np
-import warnings
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-import plotly.io as pio
 import streamlit as st
-
-from update_data_cache import get_data
-
-from pypfopt.efficient_frontier import EfficientFrontier
-from pypfopt import EfficientFrontier, exceptions
-
-pio.renderers.default='browser' # use when doing dev in Spyder (to show figs)
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+import instrument
+from instrument import stage
+from batch import solve_theme
+from charts import MAX_POINTS, frontier_layer, frontier_spec, payload_bytes, star_traces, utility_loss_spec
+from frontier import cml_utility, max_utility_portfolio
+from moments import current_version, load_moments, load_precomputed
+from refresh import Scheduler, start_in_background
+from resample import history_returns, resampled_utility_loss, worker_pool
+from result_cache import ResultCache, result_key
+from themes import (THEMES, SECTORS, RISK_LEVELS, DEFAULT_RISK_AVERSION, SP500_KEY,
+                    ThemeIndex, theme_key)
+
+if get_script_run_ctx() is None: # plain python, e.g. dev in Spyder: show figs in the browser
+    import plotly.io as pio
+    pio.renderers.default='browser'
+
+# stage timings, off unless DASHBOARD_PROFILE is set (see instrument.py)
+session_id = getattr(get_script_run_ctx(), 'session_id', None)
+instrument.set_session(session_id)
+st.cache_resource(instrument.serve_metrics)() # DASHBOARD_METRICS_PORT, once per process
 
 # Page config
 st.set_page_config(
@@ -44,7 +57,7 @@ with st.sidebar:
     def theme_selector():
         option = st.selectbox(
         'Select your theme :)',
-        ('ESG Investing', 'L,E,H,I,G,H', 'I like my beta low', 'I am not high, beta is', 'Sector','Cheapest Stocks'))
+        THEMES)
     
         options_info = {
             'ESG Investing': "ESG investing has been growing in recent years. It incorporates Environmental, Social, and Governance factors of the firms.",
@@ -56,8 +69,7 @@ with st.sidebar:
     
         selected_sectors = []
         if option == 'Sector':
-            sectors = ['Industrials', 'Healthcare', 'Technology', 'Utilities', 'Financial Services', 'Basic Materials', 'Consumer Cyclical', 'Real Estate', 'Communication Services', 'Consumer Defensive', 'Energy']
-            selected_sectors = st.multiselect('Select the sectors:', sectors)
+            selected_sectors = st.multiselect('Select the sectors:', SECTORS)
             st.write(f"**You selected the following sectors: {', '.join(selected_sectors)}**")
         else:
             st.write(options_info.get(option, "No info available"))
@@ -71,34 +83,6 @@ with st.sidebar:
 
     
     
-    '''
-    ---
-  
-    ## RISK
-    '''
-    risk_levels = st.radio(
-    "How risky do you want to be?",
-    [":rainbow[Mild Risk]", ":rainbow[Moderate]", ":rainbow[Elevated Risk]", ":rainbow[Severe Risk]", ":rainbow[Extreme Risk]"],
-    index=None ,
-     )
-    
-    # todo - didn't think about these numbers AT ALL, adjust them
-    if risk_levels == ":rainbow[Mild Risk]":
-        risk_aversion = 3
-    elif risk_levels == ":rainbow[Moderate]":
-        risk_aversion = 2.5
-    elif risk_levels == ":rainbow[Elevated Risk]":
-        risk_aversion = 2
-    elif risk_levels == ":rainbow[Severe Risk]":
-        risk_aversion = 1.75
-    elif risk_levels == ":rainbow[Extreme Risk]":
-        risk_aversion = .05
-    else:
-        risk_aversion = 10
-
-    st.write("You selected:", risk_levels)
-    
-    
     '''
     
     ---
@@ -110,330 +94,366 @@ with st.sidebar:
 # end: sidebar
 #############################################
 
-def get_ef_points(ef, ef_param, ef_param_range):
-    """
-    Helper function to get the points on the efficient frontier from an EfficientFrontier object
-    
-    This is _plot_ef without the plotting, and returning the points.
-    """
-    mus, sigmas = [], []
-
-    # Create a portfolio for each value of ef_param_range
-    for param_value in ef_param_range:
-        try:
-            if ef_param == "utility":
-                ef.max_quadratic_utility(param_value)
-            elif ef_param == "risk":
-                ef.efficient_risk(param_value)
-            elif ef_param == "return":
-                ef.efficient_return(param_value)
-            else:
-                raise NotImplementedError(
-                    "ef_param should be one of {'utility', 'risk', 'return'}"
-                )
-        except exceptions.OptimizationError:
-            continue
-        except ValueError:
-            warnings.warn(
-                "Could not construct portfolio for parameter value {:.3f}".format(
-                    param_value
-                )
-            )
-
-        ret, sigma, _ = ef.portfolio_performance()
-        mus.append(ret)
-        sigmas.append(sigma)
-
-    return mus, sigmas 
-
 #############################################
 # start: build dashboard (this is cached because nothing here changes due to 
 # user input)
 #############################################
 
-@st.cache_data
-def get_plotting_structures(asset_list=None):
+@st.cache_resource
+def get_refresh_scheduler():
+    '''
+    With DASHBOARD_REFRESH_HOURS set, rebuilds the data in the background
+    (refresh.py) once the live version is that old, checking every quarter
+    of that (at most hourly). Sessions keep the version they have until the
+    new one is published. One per process.
+    '''
+    hours = float(os.environ.get('DASHBOARD_REFRESH_HOURS', 0))
+    if hours > 0:
+        return Scheduler(every=min(hours*900, 3600), max_age=hours*3600).start()
+
+@st.cache_resource(max_entries=2)
+def load_moments_version(version):
+    '''
+    One version of the moments artifact, memory-mapped (the live one and the
+    one before it while sessions move over).
+    '''
+    with stage('load_moments', version=version):
+        return load_moments(version=version)
+
+def get_moments_store():
+    '''
+    Full S&P universe moments of the live version (moments_version, read
+    from inputs/moments/CURRENT on every rerun), shared by every session.
+    Themes are slices of this, so switching themes never downloads or
+    re-estimates anything.
     '''
-    Assets is a list of tickers, allowing this to be used with custom list 
-    of assets. If none given, uses 200 of the S&P500 as if Feb 2023 (quick - no 
-    downloads required). If list is given, will download using
-    yfinance. No error handling provided. 
+    return load_moments_version(moments_version)
+
+@st.cache_resource(max_entries=2)
+def get_precomputed(version):
+    '''
+    Theme results from `update_data_cache.py --precompute` (or refresh.py),
+    keyed by theme_key ({} if the artifact doesn't have them).
+    '''
+    return load_precomputed(load_moments_version(version)).get('themes', {})
+
+@st.cache_resource
+def get_result_cache():
+    '''
+    Frontier results shared by every session, LRU within a byte budget
+    (DASHBOARD_CACHE_MB, default 64; see result_cache.py). Its hit/miss/
+    eviction counters are in the metrics and the debug panel.
+    '''
+    cache = ResultCache(float(os.environ.get('DASHBOARD_CACHE_MB', 64))*1e6)
+    instrument.add_collector('result_cache', cache.stats)
+    return cache
+
+def get_plotting_structures(key, positions=None):
+    '''
+    key names the asset list (see themes.theme_key). positions are positions
+    in the full S&P estimates in get_moments_store (see get_theme_index),
+    allowing this to be used with custom list of assets. If none given (or
+    empty), uses the whole S&P universe. No downloads required. If key was
+    precomputed, the frontier and tangency portfolio are just looked up.
+
+    Results live in get_result_cache under the sorted ticker set + moments
+    version + estimator, so any theme with the same stocks shares them.
+    Arrays come back read-only, as stored (no copy).
 
     Returns
     -------
-    
+
         risk_free_rate
-        assets          = [rets, vols]
+        assets          = [tickers, rets, vols]
         ef_points       = [rets, vols]
         tangency_port   = [ret_tangent, vol_tangent, sharpe_tangent]
-        
+
     '''
-        
-    # get prices and risk free rate
-    # then calc E(r), COV
-    
-    if not asset_list:
-        
-        # use default list of assets and precomputed data
-        
-        with open('inputs/risk_free_rate.txt', 'r') as f:
-            rf_rate = float(f.read())
-        
-        # get the x,y values for asset in scatter
-        
-        e_returns = pd.read_csv('inputs/expected_returns.csv',index_col=0).squeeze()
-        cov_mat   = pd.read_csv('inputs/covariance_matrix_returns.csv',index_col=0)        
-        
-    else:
-        
-        # download them and compute
-        
-        e_returns, cov_mat, rf_rate = get_data(asset_list)
-        
-    assets    = [e_returns, np.sqrt(np.diag(cov_mat))] 
-    
-    # set up the EF object & dups for alt uses
-    
-    ef            = EfficientFrontier(e_returns, cov_mat)
-    ef_max_sharpe = EfficientFrontier(e_returns, cov_mat)
-    ef_min_vol    = EfficientFrontier(e_returns, cov_mat)
-    
-    # # Find+plot the tangency portfolio
-        
-    ef_max_sharpe.max_sharpe(risk_free_rate=rf_rate)
-    ret_tangent, vol_tangent, sharpe_tangent = ef_max_sharpe.portfolio_performance(risk_free_rate=rf_rate)
-    tangency_port = [ret_tangent, vol_tangent, sharpe_tangent]
-            
-    # prelim step: get the min vol (vol_min_vol is where we will start the efficient frontier)
-    
-    ef_min_vol.min_volatility()
-    ret_min_vol, vol_min_vol, _ = ef_min_vol.portfolio_performance()
-    
-    # get the efficient frontier 
-    # use risk levels from vol_min_vol to the most risky asset's vol
-    # to make faster, just 20 points
-    # but we want more points at the front of EF where it is curviest --> logscale 
-    
-    risk_range     = np.logspace(np.log(vol_min_vol+.000001), 
-                                 np.log(assets[1].max()), 
-                                 20, 
-                                 base=np.e)
+    store = get_moments_store()
+    if positions is None or not len(positions):
+        positions = np.arange(len(store))
+    positions = np.sort(positions) # the same set gives the same result
+    tickers   = np.asarray(store.tickers[positions])
 
-    ret_ef, vol_ef = get_ef_points(ef, 'risk', risk_range) 
-    ef_points      = [ret_ef,vol_ef]
-    
-    return rf_rate, assets, ef_points, tangency_port
+    def compute():
+
+        instrument.cache_miss()
+
+        # get E(r), COV and the risk free rate
+
+        e_returns, cov_mat, rf_rate = store.subset(positions=positions)
+
+        assets    = [tickers, e_returns.to_numpy(), np.sqrt(store.variances(positions))]
+
+        if key in get_precomputed(moments_version):
+            pre = get_precomputed(moments_version)[key]
+            return rf_rate, assets, [np.array(x) for x in pre['ef_points']], np.array(pre['tangency_port'])
+
+        # trace the whole frontier once (critical line algorithm): the tangency
+        # portfolio and 200 frontier points (more of them where the frontier
+        # bends), down to min vol. Same pipeline as batch.py
+
+        solved = solve_theme(e_returns, cov_mat, rf_rate, key=key)
+        return rf_rate, assets, solved['ef_points'], solved['tangency_port']
+
+    cache_key = result_key(tickers, store.version, store.estimator, points=200,
+                           covariance='factor' if store.cov_mat is None else 'dense')
+    value, _  = get_result_cache().get_or_compute(cache_key, compute)
+    return value
+
+@st.cache_resource(max_entries=int(os.environ.get('DASHBOARD_LAYER_CACHE', 64)))
+def get_frontier_layer(version, key, _positions, cml_color, ef_color, asset_color=None):
+    '''
+    The parts of the chart that don't depend on risk aversion (CML, efficient
+    frontier, assets), built once per theme and moments version and shared
+    by every session
+    (the newest DASHBOARD_LAYER_CACHE themes, default 64). Plain trace dicts
+    (see charts.py), asset clouds thinned beyond DASHBOARD_MAX_POINTS
+    points; streamlit copies the spec it's given, so sharing them is safe.
+
+    Returns
+    -------
+
+        traces          = plotly trace dicts: cml, ef, assets
+        risk_free_rate
+        tangency_port   = [ret_tangent, vol_tangent, sharpe_tangent]
+
+    '''
+    instrument.cache_miss()
+
+    with stage('plotting_structures', cached=True, theme=key):
+        rf_rate, assets, ef_points, tangency_port = get_plotting_structures(key, _positions)
+
+    with stage('frontier_figures', theme=key) as rec:
+        traces = frontier_layer(rf_rate, assets, ef_points, tangency_port, cml_color, ef_color, asset_color,
+                                max_points=int(os.environ.get('DASHBOARD_MAX_POINTS', MAX_POINTS)))
+        rec['points'] = len(traces[-1]['x'])
+
+    return traces, rf_rate, tangency_port
+
+@st.cache_resource(max_entries=2)
+def get_history_returns(version):
+    '''
+    Daily returns behind the moments, from the local price store (for the
+    bootstrap band; empty if the store has no prices).
+    '''
+    with stage('history_returns'):
+        return history_returns(load_moments_version(version))
+
+@st.cache_resource
+def get_resample_pool():
+    '''
+    (pool, workers) for the bootstrap band, shared by every session:
+    DASHBOARD_RESAMPLE_WORKERS processes (default one per cpu), started
+    once, so concurrent requests queue on the same workers instead of each
+    spawning a pool. No pool with one worker (solves run in the session's
+    thread).
+    '''
+    workers = int(os.environ.get('DASHBOARD_RESAMPLE_WORKERS') or os.cpu_count() or 1)
+    return (worker_pool(workers) if workers > 1 else None), workers
+
+def get_resampled_loss(key, positions, risk_aversions, resamples):
+    '''
+    Bootstrap band on the utility loss of the theme at positions (see
+    resample.py) over risk_aversions: median and 5%/95% percentiles, or None
+    if there's no return history on disk. Kept in get_result_cache like
+    the frontiers. Solves run on the shared get_resample_pool.
+    '''
+    store   = get_moments_store()
+    returns = get_history_returns(moments_version)
+    if returns.empty:
+        return None
+    if positions is None or not len(positions):
+        positions = np.arange(len(store))
+    pos = returns.columns.get_indexer(store.tickers[np.sort(positions)])
+    pos = pos[pos >= 0]
+
+    def compute():
+        instrument.cache_miss()
+        pool, workers = get_resample_pool()
+        with stage('resampled_loss', theme=key, resamples=resamples):
+            out = resampled_utility_loss(returns, pos, risk_aversions, store.rf_rate, resamples=resamples,
+                                         max_workers=workers, pool=pool)
+        return {k: out[k] for k in ('median', 'lower', 'upper')}
+
+    cache_key = result_key(returns.columns[pos], store.version, store.estimator, resamples=resamples,
+                           risk_aversions=np.round(risk_aversions, 6).tolist(), kind='resampled_loss')
+    value, _  = get_result_cache().get_or_compute(cache_key, compute)
+    return value
+
+@st.cache_resource(max_entries=2)
+def get_theme_index(scores_mtime, version):
+    '''
+    data_scores.csv indexed against the moments universe, so a theme is a
+    few array ops away from its positions. Rebuilt when the csv changes
+    (scores_mtime) or a new moments version is published.
+    '''
+    instrument.cache_miss()
+    return ThemeIndex.from_csv('inputs/data_scores.csv', universe=load_moments_version(version).tickers)
 
 ###############################################################################
 
 ###############################################################################
-# decide on assets: default list or uploaded list
+# which data: the live moments version. A refresh (refresh.py) publishes a
+# new one in the background; the next rerun picks it up. Nothing here ever
+# downloads or estimates.
 ###############################################################################
 
-asset_list = pd.read_csv('inputs/sp500_tickers.csv',header=None,names=['asset'])
-asset_list = asset_list['asset'].to_list()
+get_refresh_scheduler()
+moments_version = current_version()
+
+if moments_version is None:
+
+    # first start, no data at all yet: build it in the background and
+    # check back every few seconds
+    start_in_background()
+    st.info("Getting the data ready for the first time (prices and estimates for the whole S&P). "
+            "This page updates by itself when it's done (progress in logs/refresh.log).")
+
+    @st.fragment(run_every=10)
+    def wait_for_data():
+        if current_version() is not None:
+            st.rerun()
+
+    wait_for_data()
+    st.stop()
 
 ###############################################################################
-# get E(r) vol of Max Utility portfolio with leverage and RF asset 
+# decide on assets: whole universe or the selected theme
 ###############################################################################
 
-rf_rate, assets, ef_points, tangency_port = get_plotting_structures(asset_list)    
+with stage('theme_index', cached=True):
+    theme_index = get_theme_index(os.path.getmtime('inputs/data_scores.csv'), moments_version)
 
-# solve for max util (rf asset + tang port, lev allowed)
+###############################################################################
+# everything that doesn't depend on risk aversion: the S&P layer never
+# changes, the subset layer is redone only when the theme does
+###############################################################################
 
-mu_cml      = np.array([rf_rate,tangency_port[0]])
-cov_cml     = np.array([[0,0],
-                        [0,tangency_port[1]]])
-ef_max_util = EfficientFrontier(mu_cml,cov_cml,(0,1)) # only allow leverage from 0 to 1, no shorting      
-    
-ef_max_util.max_quadratic_utility(risk_aversion=risk_aversion)
+with stage('frontier_layer', cached=True, theme=SP500_KEY):
+    sp500_layer, rf_rate_1, tangency_port_1 = get_frontier_layer(moments_version, SP500_KEY, None, 'red', 'blue')
+
+subset_key = theme_key(*selected_sectors)
 
-# extract portfolio ret / vol (can't use built in for some reason...)
+with stage('theme_positions', theme=subset_key):
+    subset_positions = theme_index.theme_positions(*selected_sectors)
 
-tang_weight_util_max = ef_max_util.weights[1]
-x_util_max           = tang_weight_util_max*tangency_port[1]
-max_util_port        = [x_util_max*tangency_port[2]+rf_rate,
-                        x_util_max]
+with stage('frontier_layer', cached=True, theme=subset_key):
+    subset_layer, rf_rate_2, tangency_port_2 = get_frontier_layer(moments_version, subset_key, subset_positions, 'green', 'orange', 'orange')
+
+###############################################################################
+# get E(r) vol of Max Utility portfolio with leverage and RF asset
+###############################################################################
+
+# solve for max util (rf asset + tang port, lev allowed), unless precomputed
+
+def get_max_util(key, rf_rate, tangency_port, risk_aversion):
+    with stage('utility', theme=key, risk_aversion=risk_aversion) as rec:
+        pre = get_precomputed(moments_version).get(key, {}).get('max_util', {}).get(str(risk_aversion))
+        rec['precomputed'] = pre is not None
+        if pre is not None:
+            return pre['port'], pre['utility']
+        return max_utility_portfolio(rf_rate, tangency_port, risk_aversion)
 
 #############################################
 # start: plot
 #############################################
 
-# cml
-x_high = assets[1].max()*.8
-fig1 = px.line(x=[0,x_high], y=[rf_rate,rf_rate+x_high*tangency_port[2]])
-fig1.update_traces(line_color='red', line_width=3)
-
-# ef
-fig2 = px.line(y=ef_points[0], x=ef_points[1])
-fig2.update_traces(line_color='blue', line_width=3)
-
-# assets 
-fig3 = px.scatter(y=assets[0], x=assets[1],hover_name=assets[0].index)
-
-# tang + max_util 
-points = pd.DataFrame({
-                    'port': ['Max utility<br>portfolio','Tangency<br>portfolio'],
-                    'y': [max_util_port[0],tangency_port[0]],
-                    'x': [max_util_port[1],tangency_port[1]],
-                    'sym' : ['star','star'],
-                    'size' : [2,2],
-                    'color':['blue','red']})
-
-fig4 = px.scatter(points,x='x',y='y',
-                  symbol='port',
-                  hover_name='port',text="port",
-                  color_discrete_sequence = ['red','blue'],
-                  symbol_sequence=['star','star'],
-                  labels={'x':'Volatility', 'y':'Expected Returns'},
-                  size=[2,2],
-                  color='port')
-
-# perfect formatting text annotation color matches marker
-fig4.update_traces(showlegend=False)
-def trace_specs(t):    
-    # Text annotation color matches marker'
-    # If statement flips the red marker underneith to avoid overlapping text'
-    if t.marker.color == 'red' and (abs(max_util_port[1]-tangency_port[1])<.02):
-        return t.update(textfont_color=t.marker.color, textposition='bottom center')
-    else:
-        return t.update(textfont_color=t.marker.color, textposition='top center')
-
-fig4.for_each_trace(lambda t: trace_specs(t))
-fig4.update_layout(yaxis_range = [0,0.5],
-                   xaxis_range = [0,0.5],
-                   font={'size':16},
-                   yaxis = dict(tickfont = dict(size=20),titlefont = dict(size=20)),
-                   xaxis = dict(tickfont = dict(size=20),titlefont = dict(size=20)),
-                   
-                   )
-
-fig5 = go.Figure(data=fig1.data + fig2.data + fig3.data + fig4.data, layout = fig4.layout)
-fig5.update_layout(height=600) 
-
-#record the maximum utility 
-max_utility_1 = round((max_util_port[0]-.5*risk_aversion*max_util_port[1]**2),4)
-
-
-
-# st.plotly_chart(fig5,use_container_width=True)
-
-def get_theme_assets(option, selected_sectors):
-    """
-    Returns a list of assets based on the selected theme and risk level.
-    """
-    stocks = pd.read_csv('inputs/data_scores.csv')
-
-    if option == 'ESG Investing':
-        #The df needs to be subsetted into one row per firm
-        stocks = stocks.sort_values('Total-Score', ascending=False)
-        subset_asset_list = stocks['Ticker'].tolist()[:100]
-    elif option == 'L,E,H,I,G,H':
-        subset_asset_list = stocks[stocks['Ticker'].str.contains('L|E|H|I|G|H', case=False)]['Ticker'].tolist()
-    elif option == 'I like my beta low':
-        stocks = stocks[stocks['Beta'].notnull()]  # Exclude rows with missing 'Beta' values
-        stocks = stocks.sort_values('Beta', ascending=True)
-        subset_asset_list = stocks['Ticker'].tolist()[:50]
-    elif option == 'I am not high, beta is':
-        stocks = stocks[stocks['Beta'].notnull()]
-        stocks = stocks.sort_values('Beta', ascending=False)
-        subset_asset_list = stocks['Ticker'].tolist()[:50]
-    elif option == 'Cheapest Stocks':
-        stocks = stocks.sort_values('Price', ascending=True)
-        subset_asset_list = stocks['Ticker'].tolist()[:50]
-    elif option == 'Sector':
-        stocks = stocks[stocks['Sector'].isin(selected_sectors)]
-        subset_asset_list = stocks['Ticker'].tolist()
-    return subset_asset_list
-
-subset_asset_list = get_theme_assets(selected_sectors[0], selected_sectors[1])
+@st.fragment
+@instrument.timed('utility_section')
+def utility_section():
+    '''
+    Everything that depends on risk aversion: the risk buttons, the max
+    utility stars, the chart and the results. A fragment, so picking a risk
+    level reruns only this function, not the whole app.
+    '''
+    st.markdown('## RISK')
+    risk_levels = st.radio(
+    "How risky do you want to be?",
+    list(RISK_LEVELS),
+    index=None ,
+    horizontal=True,
+    key='risk_levels',
+     )
 
-###############################################################################
-#Starting plotting the efficient fontier fo subset_asset_list
-###############################################################################
-rf_rate, assets, ef_points, tangency_port = get_plotting_structures(subset_asset_list)
+    risk_aversion = RISK_LEVELS.get(risk_levels, DEFAULT_RISK_AVERSION)
 
-# solve for max util (rf asset + tang port, lev allowed)
+    st.write("You selected:", risk_levels)
 
-mu_cml      = np.array([rf_rate,tangency_port[0]])
-cov_cml     = np.array([[0,0],
-                        [0,tangency_port[1]]])
-ef_max_util = EfficientFrontier(mu_cml,cov_cml,(0,1)) # only allow leverage from 0 to 1, no shorting      
-    
-ef_max_util.max_quadratic_utility(risk_aversion=risk_aversion)
-
-# extract portfolio ret / vol (can't use built in for some reason...)
-
-tang_weight_util_max = ef_max_util.weights[1]
-x_util_max           = tang_weight_util_max*tangency_port[1]
-max_util_port        = [x_util_max*tangency_port[2]+rf_rate,
-                        x_util_max]
-
-x_high = assets[1].max()*.8
-fig6 = px.line(x=[0,x_high], y=[rf_rate,rf_rate+x_high*tangency_port[2]])
-fig6.update_traces(line_color='green', line_width=3)
-
-# ef
-fig7 = px.line(y=ef_points[0], x=ef_points[1])
-fig7.update_traces(line_color='orange', line_width=3)
-
-# assets 
-fig8 = px.scatter(y=assets[0], x=assets[1], hover_name=assets[0].index, color_discrete_sequence=['orange'])
-
-# tang + max_util 
-points = pd.DataFrame({
-                    'port': ['Max utility<br>portfolio','Tangency<br>portfolio'],
-                    'y': [max_util_port[0],tangency_port[0]],
-                    'x': [max_util_port[1],tangency_port[1]],
-                    'sym' : ['star','star'],
-                    'size' : [2,2],
-                    'color':['green','orange']})
-
-fig9 = px.scatter(points,x='x',y='y',
-                  symbol='port',
-                  hover_name='port',text="port",
-                  color_discrete_sequence = ['red','blue'],
-                  symbol_sequence=['square','square'],
-                  labels={'x':'Volatility', 'y':'Expected Returns'},
-                  size=[2,2],
-                  color='port')
-
-# perfect formatting text annotation color matches marker
-fig9.update_traces(showlegend=False)
-def trace_specs(t):    
-    # Text annotation color matches marker'
-    # If statement flips the red marker underneith to avoid overlapping text'
-    if t.marker.color == 'red' and (abs(max_util_port[1]-tangency_port[1])<.02):
-        return t.update(textfont_color=t.marker.color, textposition='bottom center')
-    else:
-        return t.update(textfont_color=t.marker.color, textposition='top center')
-
-fig9.for_each_trace(lambda t: trace_specs(t))
-fig9.update_layout(yaxis_range = [0,0.5],
-                   xaxis_range = [0,0.5],
-                   font={'size':16},
-                   yaxis = dict(tickfont = dict(size=20),titlefont = dict(size=20)),
-                   xaxis = dict(tickfont = dict(size=20),titlefont = dict(size=20)),
-                   
-                   )
-
-fig10 = go.Figure(data=fig1.data + fig2.data + fig3.data + fig4.data + fig6.data + fig7.data + fig8.data + fig9.data,  layout = fig4.layout)
-fig10.update_layout(height=600)
-st.plotly_chart(fig10,use_container_width=True)
-
-#print the maximum utility in each of the portfolios
-max_utility_2 = round((max_util_port[0]-0.5*risk_aversion*max_util_port[1]**2),4)
-
-
-""""
-## Your Results
-"""
-if st.button("Click to see your results!"):
-    st.write("Using the utility function U = Expected Return - 0.5Aσ², the utility of the portfolios are:")
-    st.write(f"Max Utility of SP500: {max_utility_1}")
-    st.write(f"Max Utility of Subset: {max_utility_2}")
-    st.write(f"Loss of Utility: {round(max_utility_1-max_utility_2,4)}")
-    st.write("Where A is the risk aversion parameter and σ is the standard deviation of the portfolio.")
+    # S&P 500
+
+    max_util_port, max_utility_1 = get_max_util(SP500_KEY, rf_rate_1, tangency_port_1, risk_aversion)
+    tangency_port = tangency_port_1
+
+    # tang + max_util, the only traces redone on a rerun
+    sp500_stars = star_traces(max_util_port, tangency_port, 'star')
+
+    # subset
+
+    max_util_port, max_utility_2 = get_max_util(subset_key, rf_rate_2, tangency_port_2, risk_aversion)
+    tangency_port = tangency_port_2
+
+    # tang + max_util
+    subset_stars = star_traces(max_util_port, tangency_port, 'square')
+
+    fig10 = frontier_spec(sp500_layer, sp500_stars, subset_layer, subset_stars)
+    with stage('plotly_chart', figure='frontiers'):
+        st.plotly_chart(fig10,use_container_width=True)
+    if instrument.ENABLED: # serializes the spec again, so only when profiling
+        with stage('chart_payload', figure='frontiers') as rec:
+            rec['bytes'] = payload_bytes(fig10)
+    for note in get_moments_store().caveats(theme_index.theme_tickers(*selected_sectors)):
+        st.caption(note)
+
+    st.markdown("## Your Results")
+
+    # utility loss over a whole range of risk aversions (one vectorized call
+    # for both portfolios), with your pick marked
+
+    A_grid = np.linspace(.05, 10, 400)
+    _, _, _, utility_sp = cml_utility(rf_rate_1, tangency_port_1[0], tangency_port_1[1], A_grid)
+    _, _, _, utility_th = cml_utility(rf_rate_2, tangency_port_2[0], tangency_port_2[1], A_grid)
+
+    # optional: how much of that is estimation noise (bootstrap of the
+    # return history, both portfolios re-solved on each resample)
+
+    band = None
+    if st.checkbox('Show a bootstrap confidence band', key='resample'):
+        resamples = st.select_slider('Resamples', [100, 250, 500, 1000], value=100, key='resamples')
+        with st.spinner(f'Re-solving both frontiers on {resamples} resamples...'):
+            band = get_resampled_loss(subset_key, subset_positions, A_grid, resamples)
+        if band is None:
+            st.caption('No price history in inputs/price_store to resample (run update_data_cache.py).')
+    fig11 = utility_loss_spec(A_grid, utility_sp-utility_th, risk_aversion, band)
+    with stage('plotly_chart', figure='utility_loss'):
+        st.plotly_chart(fig11,use_container_width=True)
+    if instrument.ENABLED:
+        with stage('chart_payload', figure='utility_loss') as rec:
+            rec['bytes'] = payload_bytes(fig11)
+
+    if st.button("Click to see your results!"):
+        st.write("Using the utility function U = Expected Return - 0.5Aσ², the utility of the portfolios are:")
+        st.write(f"Max Utility of SP500: {max_utility_1}")
+        st.write(f"Max Utility of Subset: {max_utility_2}")
+        st.write(f"Loss of Utility: {round(max_utility_1-max_utility_2,4)}")
+        if band is not None:
+            lo, hi = (np.interp(risk_aversion, A_grid, band[k]) for k in ('lower', 'upper'))
+            st.write(f"90% bootstrap band on the loss: {round(lo,4)} to {round(hi,4)}")
+        st.write("Where A is the risk aversion parameter and σ is the standard deviation of the portfolio.")
+
+utility_section()
+
+# hidden debug panel: add ?debug=1 to the url
+if st.query_params.get('debug'):
+    with st.sidebar.expander('Debug: stage timings', expanded=True):
+        st.caption('Result cache')
+        st.json(get_result_cache().stats())
+        if not instrument.ENABLED:
+            st.write('Stage timings are off. Start the app with DASHBOARD_PROFILE=1 (or =memory).')
+        else:
+            records = pd.DataFrame(instrument.recent(session_id)).drop(columns=['session'])
+            st.dataframe(records.tail(50).iloc[::-1], hide_index=True)
+            st.dataframe(pd.DataFrame(instrument.totals()).T, use_container_width=True)
 
 
 '''
@@ -447,6 +467,8 @@ if st.button("Click to see your results!"):
 - Yellow line is the efficient frontier of the subet of firms based on your selected theme and the yellow square is the optimal "all-equity" portfolio
 - The green line is the "capital market line" of the subset of firms based on your selected theme and the green square is the optimal tangency portfolio, based on your risk aversion parameter
 - The chart shows the difference in utility between the two portfolios
+- The purple line is the loss of utility (S&P 500 minus your theme) for every risk aversion, the dashed line is yours
+- Tick "Show a bootstrap confidence band" to shade the 90% range of that loss over resamples of the return history (estimation noise)
 - This portfolio does not incorporate the option of incorporating leverage, and henceforth does not show optimal portfolios beyond the point of tangency with the efficient frontier
 '''
 
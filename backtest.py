@@ -0,0 +1,251 @@
+'''
+Walk-forward, out-of-sample backtest of the themes against the S&P.
+
+The app compares in-sample frontiers from one 10 year window. Here, at the
+end of every month, the moments are re-estimated on the trailing window
+(capm_return / exp_cov, as get_data does), the tangency and max utility
+portfolios formed for the S&P universe and every menu theme (fixed themes
+and single sectors), and held to the next month end. The rows record what
+each portfolio expected and what it realized; summarize() turns them into
+realized utility per theme and risk aversion, and its loss against the S&P.
+
+Moments come from a MomentsEstimator (estimator.py) slid forward a month at
+a time: each rebalance only adds the month's days and drops the ones
+leaving the window, instead of re-estimating the whole window. The months
+are split into contiguous blocks that run on a process pool, each block
+building its estimator once and sliding it from there.
+
+Caveats:
+    - theme membership is today's data_scores.csv (ESG scores, betas,
+      prices), so the themes have look-ahead in them; sectors much less so.
+    - one risk free rate throughout (the price store keeps only the latest).
+    - assets need 20% of the window's days to be used (get_data's filter);
+      the market proxy is every ticker with a price that day.
+    - a held asset without a price at the next month end (delisted) counts
+      at its last price.
+
+    python backtest.py --window 3 --workers 4 --out backtest.csv
+'''
+
+import os
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+MIN_HISTORY = .2 # share of the window's days an asset needs, like get_data
+
+def _month_close(date):
+    '''
+    Last trading day of date's month: last weekday that isn't a US federal
+    holiday or Good Friday (close enough to the NYSE calendar at month ends).
+    '''
+    from pandas.tseries.holiday import AbstractHolidayCalendar, GoodFriday, USFederalHolidayCalendar
+    from pandas.tseries.offsets import CustomBusinessMonthEnd
+
+    class Market(AbstractHolidayCalendar):
+        rules = USFederalHolidayCalendar.rules + [GoodFriday]
+
+    return CustomBusinessMonthEnd(calendar=Market()).rollforward(pd.Timestamp(date).normalize())
+
+def rebalance_dates(prices, window_years=3):
+    '''
+    Last trading day of every month with a full window of prices before it.
+    The last month only counts if the prices reach its close: a partial
+    month's last day isn't a month end.
+    '''
+    index = prices.index
+    ends  = pd.Series(index, index=index).groupby(index.to_period('M')).max()
+    if len(ends) and ends.iloc[-1].normalize() < _month_close(ends.iloc[-1]):
+        ends = ends.iloc[:-1]
+    first = index[0] + pd.DateOffset(years=window_years)
+    return pd.DatetimeIndex(ends[ends >= first].to_numpy())
+
+#############################################
+# one block of consecutive months
+#############################################
+
+_WORKER = None # per worker process: prices, themes, settings
+
+def _init_worker(prices, themes, settings):
+    global _WORKER
+    _WORKER = (prices, themes, settings)
+
+def _solve(mu, cov, rf_rate):
+    '''
+    Tangency weights and [ret, vol] (NaN if there's nothing to hold).
+    '''
+    from frontier import CriticalLine
+
+    if not len(mu):
+        return np.empty(0), (np.nan, np.nan)
+    cla = CriticalLine(mu, cov, tangency_rf=rf_rate)
+    w   = cla.max_sharpe(rf_rate)
+    return w, cla.portfolio_performance(w, rf_rate)[:2]
+
+def _run_block(dates):
+    '''
+    Rows for consecutive rebalance dates (and the date after the last one,
+    for its holding period).
+    '''
+    from estimator import MomentsEstimator, fix_nonpositive_semidefinite
+    from frontier import cml_utility
+
+    prices, themes, s = _WORKER
+    rf, A, window     = s['rf_rate'], np.asarray(s['risk_aversions']), s['window_years']
+    rf_month          = (1+rf)**(1/12) - 1
+    held              = prices.ffill() # delisted names stay at their last price
+    est               = None
+    rows              = []
+
+    for date, next_date in zip(dates[:-1], dates[1:]):
+
+        start = date - pd.DateOffset(years=window)
+        if est is None:
+            est = MomentsEstimator.from_prices(prices.loc[(prices.index >= start) & (prices.index <= date)], start)
+        else:
+            est.refresh(prices.loc[(prices.index >= est.start) & (prices.index <= date)], start)
+
+        valid     = np.flatnonzero(est.n >= MIN_HISTORY * len(est.dates))
+        mu        = est.expected_returns(rf).to_numpy()[valid]
+        cov       = est.cov_matrix(fix_psd=False).iloc[valid, valid]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore') # warns on every fix
+            cov   = fix_nonpositive_semidefinite(cov).to_numpy()
+        realized  = (held.loc[next_date] / held.loc[date] - 1).to_numpy()[valid]
+        realized  = np.nan_to_num(realized) # no price at the start either: not held anyway
+
+        in_valid  = np.full(len(est), -1)
+        in_valid[valid] = np.arange(len(valid))
+
+        for key, positions in themes:
+            pos           = in_valid[positions] if positions is not None else np.arange(len(valid))
+            pos           = pos[pos >= 0]
+            w, (ret, vol) = _solve(mu[pos], cov[np.ix_(pos, pos)], rf)
+            month         = float(w @ realized[pos]) if len(pos) else np.nan
+            y, _, _, u    = cml_utility(rf, ret, vol, A)
+            for A_k, y_k, u_k in zip(A, y, u):
+                rows.append({'date'            : date,
+                             'theme'           : key,
+                             'n_assets'        : len(pos),
+                             'risk_aversion'   : float(A_k),
+                             'tangency_ret'    : float(ret),
+                             'tangency_vol'    : float(vol),
+                             'tangency_weight' : float(y_k),
+                             'expected_utility': float(u_k),
+                             'tangency_realized': month,
+                             'realized_return' : rf_month + y_k*(month - rf_month)})
+    return rows
+
+#############################################
+# the backtest
+#############################################
+
+def backtest(prices, risk_aversions, rf_rate=0.04, window_years=3, themes=None, scores='inputs/data_scores.csv',
+             max_workers=None, blocks=None):
+    '''
+    Monthly walk-forward backtest over a date x ticker price panel (e.g.
+    PriceStore().prices). themes is a list of (key, positions) with
+    positions into prices' columns (None = all of them); by default the S&P
+    universe plus every menu theme in themes.fixed_themes(), from scores.
+
+    Months are split into `blocks` contiguous runs (default 2 per worker)
+    on a process pool of max_workers (None = one per cpu, 0 or 1 = in this
+    process).
+
+    Returns a DataFrame, one row per month x theme x risk aversion:
+    expected (ex ante, annual) tangency ret/vol, tangency weight and utility,
+    and the realized return over the following month of the tangency
+    portfolio and of the max utility mix.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    from themes import SP500_KEY, ThemeIndex, fixed_themes, theme_key
+
+    prices = prices.astype(np.float64)
+    if themes is None:
+        index  = ThemeIndex.from_csv(scores, universe=prices.columns)
+        themes = [(SP500_KEY, None)] + [(theme_key(option, sectors), index.theme_positions(option, sectors))
+                                        for option, sectors in fixed_themes()]
+
+    dates    = rebalance_dates(prices, window_years)
+    settings = {'rf_rate': rf_rate, 'risk_aversions': list(risk_aversions), 'window_years': window_years}
+    workers  = max_workers if max_workers is not None else os.cpu_count() or 1
+    blocks   = blocks or min(max(len(dates)-1, 1), 2*workers)
+
+    # consecutive blocks share their boundary date (one block's last holding
+    # period ends where the next one starts)
+    cuts  = np.linspace(0, len(dates)-1, blocks+1).round().astype(int)
+    tasks = [dates[a:b+1] for a, b in zip(cuts[:-1], cuts[1:]) if b > a]
+
+    if workers <= 1:
+        _init_worker(prices, themes, settings)
+        results = list(map(_run_block, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(prices, themes, settings)) as pool:
+            results = list(pool.map(_run_block, tasks))
+    return pd.DataFrame([row for block in results for row in block])
+
+def summarize(rows, benchmark=None, periods=12):
+    '''
+    Per theme and risk aversion: months held, realized annualized return,
+    vol and utility (mean - .5*A*var of the monthly max utility returns,
+    annualized), the average expected utility, and realized utility loss
+    against benchmark (S&P by default).
+    '''
+    from themes import SP500_KEY
+
+    benchmark = benchmark or SP500_KEY
+    r         = rows['realized_return']
+    stats     = (rows.assign(r=r)
+                     .groupby(['theme', 'risk_aversion'])
+                     .agg(months=('r', 'count'), mean=('r', 'mean'), var=('r', 'var'),
+                          expected_utility=('expected_utility', 'mean'), n_assets=('n_assets', 'mean')))
+    out = pd.DataFrame({'months'          : stats['months'],
+                        'n_assets'        : stats['n_assets'],
+                        'realized_return' : stats['mean'] * periods,
+                        'realized_vol'    : np.sqrt(stats['var'] * periods)})
+    A = out.index.get_level_values('risk_aversion')
+    out['realized_utility'] = out['realized_return'] - .5*A*out['realized_vol']**2
+    out['expected_utility'] = stats['expected_utility']
+    bench = out.xs(benchmark, level='theme')
+    out['realized_loss']    = bench['realized_utility'].reindex(A).to_numpy() - out['realized_utility']
+    out['expected_loss']    = bench['expected_utility'].reindex(A).to_numpy() - out['expected_utility']
+    return out.reset_index()
+
+if __name__ == "__main__":
+
+  import argparse
+
+  from themes import DEFAULT_RISK_AVERSION, RISK_LEVELS
+
+  parser = argparse.ArgumentParser(description='Monthly walk-forward backtest of the themes vs the S&P, '
+                                               'from the prices in inputs/price_store.')
+  parser.add_argument('--window', type=float, default=3, help='estimation window, years')
+  parser.add_argument('--rf', type=float, default=None, help='risk free rate (default: the stored one)')
+  parser.add_argument('--workers', type=int, default=None, help='processes (default: one per cpu)')
+  parser.add_argument('--out', default=None, help='monthly rows to .csv or .parquet')
+  args = parser.parse_args()
+
+  from price_store import PriceStore
+
+  store = PriceStore()
+  if store.prices.empty:
+    raise SystemExit('no prices in inputs/price_store: run update_data_cache.py first')
+  rf    = args.rf if args.rf is not None else (store.rf or {}).get('rate', 0.04)
+  A     = list(RISK_LEVELS.values()) + [DEFAULT_RISK_AVERSION]
+
+  t0      = time.perf_counter()
+  rows    = backtest(store.prices, A, rf_rate=rf, window_years=args.window, max_workers=args.workers)
+  seconds = time.perf_counter() - t0
+  if args.out:
+    rows.to_parquet(args.out) if args.out.endswith('.parquet') else rows.to_csv(args.out, index=False)
+
+  summary = summarize(rows)
+  print(f"{rows['date'].nunique()} months x {rows['theme'].nunique()} themes in {seconds:.1f}s")
+  print(f"{'theme':40s} {'A':>5s} {'ret':>7s} {'vol':>7s} {'U real':>8s} {'U exp':>8s} {'loss real':>9s} {'loss exp':>9s}")
+  for r in summary.itertuples():
+    print(f"{r.theme:40s} {r.risk_aversion:5.2f} {r.realized_return:7.3f} {r.realized_vol:7.3f} "
+          f"{r.realized_utility:8.4f} {r.expected_utility:8.4f} {r.realized_loss:9.4f} {r.expected_loss:9.4f}")
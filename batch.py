@@ -0,0 +1,445 @@
+'''
+The dashboard's pipeline without the dashboard: theme -> frontier, tangency
+portfolio, max utility portfolio and utility loss against the S&P 500, for
+any number of themes and risk aversions.
+
+    solve_theme(e_returns, cov_mat, rf_rate, risk_aversions)
+        frontier, tangency and max utility portfolios of one set of moments
+        (what app.py and update_data_cache.py --precompute run per theme)
+    compare_theme(store, positions, risk_aversions)
+        the same for a theme of the moments store, plus its utility loss
+        against the whole universe
+    SubsetSolver(store, risk_aversions).solve(subsets)
+        solve_theme for many subsets of one universe at once: each set of
+        assets solved once, workers mapping the artifact once, the utility
+        stage batched, on a process pool
+    sweep(store, themes, risk_aversions, out)
+        many themes through a SubsetSolver, one row per theme x risk
+        aversion streamed to a .csv or .parquet file as results come in
+
+From the command line, e.g. every pair and triple of sectors over 20 risk
+aversions between .5 and 10, on 8 processes:
+
+    python batch.py --sectors 2 3 --grid .5 10 20 --workers 8 --out sweep.parquet
+
+Reads the moments artifact update_data_cache.py writes (inputs/moments):
+no downloads, no estimation. Workers memory-map it, so a worker costs about
+what its themes' subsets take.
+'''
+
+import csv
+import itertools
+import os
+import time
+
+import numpy as np
+
+COLUMNS = ['theme', 'option', 'sectors', 'n_assets', 'risk_aversion', 'rf_rate',
+           'tangency_ret', 'tangency_vol', 'tangency_sharpe', 'min_vol_ret', 'min_vol_vol',
+           'tangency_weight', 'max_util_ret', 'max_util_vol', 'utility',
+           'benchmark_utility', 'utility_loss']
+
+#############################################
+# one theme
+#############################################
+
+def solve_theme(e_returns, cov_mat, rf_rate, risk_aversions=(), points=200, key=None):
+    '''
+    Trace the long-only frontier once (critical line algorithm) and read off
+    the tangency portfolio, `points` frontier points and, for each risk
+    aversion, the max utility mix of the risk free asset and the tangency
+    portfolio (no leverage). cov_mat may be dense or a FactorCovariance.
+
+    Returns a dict:
+
+        n_assets
+        rf_rate
+        ef_points       = [rets, vols] (max return -> min vol)
+        tangency_port   = array [ret, vol, sharpe]
+        risk_aversions  = array (A,)
+        max_util        = [weights, rets, vols, utilities], arrays (A,) (see
+                          frontier.cml_utility)
+    '''
+    from frontier import CriticalLine, cml_utility
+    from instrument import stage
+
+    with stage('critical_line', theme=key, assets=len(e_returns)) as rec:
+        cla = CriticalLine(e_returns, cov_mat)
+        rec['turning_points'] = len(cla.lambdas)
+
+    with stage('max_sharpe', theme=key):
+        tangency_port = np.array(cla.portfolio_performance(cla.max_sharpe(risk_free_rate=rf_rate),
+                                                           risk_free_rate=rf_rate))
+
+    with stage('efficient_frontier', theme=key):
+        ret_ef, vol_ef, _ = cla.efficient_frontier(points=points)
+
+    # every risk aversion in one call
+    risk_aversions = np.asarray(risk_aversions, dtype=np.float64)
+    max_util       = [np.empty(0)]*4
+    if len(risk_aversions):
+        with stage('utility', theme=key, risk_aversions=len(risk_aversions)):
+            max_util = list(cml_utility(rf_rate, tangency_port[0], tangency_port[1], risk_aversions))
+
+    return {'n_assets'      : len(e_returns),
+            'rf_rate'       : rf_rate,
+            'ef_points'     : [ret_ef, vol_ef],
+            'tangency_port' : tangency_port,
+            'risk_aversions': risk_aversions,
+            'max_util'      : max_util}
+
+def compare_theme(store, positions, risk_aversions, benchmark=None, key=None, points=200):
+    '''
+    solve_theme for the theme at positions in store (a MomentsStore), plus
+    'benchmark_utility' and 'utility_loss' (benchmark minus theme, per risk
+    aversion). benchmark is a solve_theme result for the same risk
+    aversions; the whole universe is solved if it isn't given.
+    '''
+    risk_aversions = np.asarray(risk_aversions, dtype=np.float64)
+    if benchmark is None:
+        benchmark = solve_theme(*store.subset(), risk_aversions, points=points, key='benchmark')
+
+    result = solve_theme(*store.subset(positions=positions), risk_aversions, points=points, key=key)
+    result['benchmark_utility'] = benchmark['max_util'][3]
+    result['utility_loss']      = benchmark['max_util'][3] - result['max_util'][3]
+    return result
+
+def result_rows(result, theme, option=None, sectors=()):
+    '''
+    compare_theme's result as one row (dict, COLUMNS) per risk aversion.
+    '''
+    ret_ef, vol_ef        = result['ef_points']
+    ret_t, vol_t, sharpe  = (float(x) for x in result['tangency_port'])
+    weights, rets, vols, utilities = result['max_util']
+    return [{'theme'            : theme,
+             'option'           : option if option is not None else theme,
+             'sectors'          : '|'.join(sectors),
+             'n_assets'         : result['n_assets'],
+             'risk_aversion'    : float(A),
+             'rf_rate'          : float(result['rf_rate']),
+             'tangency_ret'     : ret_t,
+             'tangency_vol'     : vol_t,
+             'tangency_sharpe'  : sharpe,
+             'min_vol_ret'      : float(ret_ef[-1]),
+             'min_vol_vol'      : float(vol_ef[-1]),
+             'tangency_weight'  : float(w),
+             'max_util_ret'     : float(r),
+             'max_util_vol'     : float(v),
+             'utility'          : float(u),
+             'benchmark_utility': float(b),
+             'utility_loss'     : float(loss)}
+            for A, w, r, v, u, b, loss in zip(result['risk_aversions'], weights, rets, vols, utilities,
+                                              result['benchmark_utility'], result['utility_loss'])]
+
+#############################################
+# theme definitions
+#############################################
+
+def sector_themes(sizes=(2, 3), sectors=None):
+    '''
+    Every combination of `size` sectors (of themes.SECTORS by default), for
+    each size: ('Sector', [sectors]) pairs like the menu's multiselect.
+    '''
+    from themes import SECTORS
+
+    sectors = list(SECTORS if sectors is None else sectors)
+    return [('Sector', list(combo)) for size in sizes
+            for combo in itertools.combinations(sorted(sectors), size)]
+
+#############################################
+# output: rows streamed to csv / parquet
+#############################################
+
+class _CsvWriter:
+
+    def __init__(self, path):
+        self._file   = open(path, 'w', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=COLUMNS)
+        self._writer.writeheader()
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class _ParquetWriter:
+    '''
+    Rows buffered into row groups of row_group rows (needs pyarrow).
+    '''
+
+    def __init__(self, path, row_group=10_000):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa     = pa
+        self._schema = pa.schema([(c, pa.string()) if c in ('theme', 'option', 'sectors')
+                                  else (c, pa.int64()) if c == 'n_assets'
+                                  else (c, pa.float64()) for c in COLUMNS])
+        self._writer = pq.ParquetWriter(path, self._schema)
+        self._rows   = []
+        self._size   = row_group
+
+    def write(self, rows):
+        self._rows.extend(rows)
+        if len(self._rows) >= self._size:
+            self._flush()
+
+    def _flush(self):
+        if self._rows:
+            self._writer.write_table(self._pa.Table.from_pylist(self._rows, schema=self._schema))
+            self._rows = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+def open_writer(path):
+    '''
+    A row writer for path, by extension (.csv or .parquet).
+    '''
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        return _CsvWriter(path)
+    if ext in ('.parquet', '.pq'):
+        return _ParquetWriter(path)
+    raise ValueError(f'unknown output format {ext!r}: use .csv or .parquet')
+
+#############################################
+# many subsets of one universe at once
+#############################################
+
+_UNIVERSE = None # per worker process: e_returns, cov (dense or factor), rf rate, frontier points
+
+def _init_subset_worker(store, points):
+    '''
+    Map the universe once per worker (store is a MomentsStore or the folder
+    of its artifact): every subset is sliced from these arrays by position.
+    '''
+    global _UNIVERSE
+    if isinstance(store, str):
+        from moments import load_moments
+        store = load_moments(*os.path.split(store))
+    cov       = store.factors if store.cov_mat is None else store.cov_mat
+    _UNIVERSE = (store.e_returns, cov, store.rf_rate, points)
+
+def _solve_subsets(chunk):
+    '''
+    solve_theme (no utility stage) for a chunk of position arrays.
+    '''
+    e_returns, cov, rf_rate, points = _UNIVERSE
+    return [solve_theme(e_returns[positions],
+                        cov[np.ix_(positions, positions)] if isinstance(cov, np.ndarray) else cov.subset(positions),
+                        rf_rate, points=points)
+            for positions in chunk]
+
+class SubsetSolver:
+    '''
+    solve_theme for many subsets (arrays of positions) of one universe (a
+    MomentsStore), sharing what can be shared between them:
+
+        - a set of assets is solved once, however many subsets have it (in
+          whatever order); those subsets get the same result dict
+        - workers map the artifact once, for every batch they're given, and
+          slice e_returns/cov by position (no per subset store.subset, no
+          pandas)
+        - a batch's utility stage is one cml_utility call over every
+          subset x risk aversion
+        - subsets run in chunks on a process pool of max_workers (None =
+          one per cpu, 0 = in this process; an in-memory store always runs
+          in this process), kept until close()
+
+    The critical line of each subset still runs on its own block: its
+    inverses are over that subset's free assets, which other subsets don't
+    have.
+
+        with SubsetSolver(store, risk_aversions, max_workers=8) as solver:
+            for result in solver.solve(subsets): # in order, None if empty
+                ...
+            solver.subsets_per_second
+    '''
+
+    def __init__(self, store, risk_aversions=(), points=200, max_workers=None, chunk=None):
+        self.store          = store
+        self.risk_aversions = np.asarray(risk_aversions, dtype=np.float64)
+        self.points         = points
+        self.max_workers    = max_workers
+        self.chunk          = chunk
+        self.subsets        = 0   # asked for
+        self.solved         = 0   # distinct sets of assets actually solved
+        self.seconds        = 0.  # time spent in solve()
+        self._pool          = None
+
+    @property
+    def in_process(self):
+        return self.max_workers == 0 or self.store.folder is None
+
+    @property
+    def subsets_per_second(self):
+        return self.subsets / self.seconds if self.seconds else float('inf')
+
+    def _map(self, chunks):
+        if self.in_process:
+            _init_subset_worker(self.store, self.points)
+            return map(_solve_subsets, chunks)
+        if self._pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_subset_worker,
+                                             initargs=(self.store.folder, self.points))
+        return self._pool.map(_solve_subsets, chunks)
+
+    def _finish(self, solved):
+        '''
+        solve_theme's dicts, with every risk aversion of every subset in
+        one cml_utility call.
+        '''
+        from frontier import cml_utility
+
+        A = self.risk_aversions
+        if len(A):
+            tangency = np.array([result['tangency_port'] for result in solved])
+            max_util = cml_utility(solved[0]['rf_rate'], tangency[:, :1], tangency[:, 1:2], A)
+        for k, result in enumerate(solved):
+            result['risk_aversions'] = A
+            if len(A):
+                result['max_util'] = [x[k] for x in max_util]
+        return solved
+
+    def solve(self, subsets):
+        '''
+        Generator: a solve_theme result (dict) for each subset, in order, as
+        soon as its chunk is done. None for an empty subset.
+        '''
+        t0      = time.perf_counter()
+        subsets = [np.unique(np.asarray(positions, dtype=np.intp)) for positions in subsets]
+        keys    = [positions.tobytes() for positions in subsets]
+        todo    = list({key: positions for key, positions in zip(keys, subsets) if len(positions)}.items())
+
+        workers = 1 if self.in_process else self.max_workers or os.cpu_count() or 1
+        chunk   = self.chunk or max(1, min(16, len(todo) // (4*workers)))
+        chunks  = [todo[i:i+chunk] for i in range(0, len(todo), chunk)]
+        solved  = self._map([[positions for _, positions in block] for block in chunks])
+        results = {}
+        k       = 0
+        for block in chunks + [[]]: # the last round yields any trailing empty subsets
+            if block:
+                results.update(zip([key for key, _ in block], self._finish(next(solved))))
+                self.solved += len(block)
+            while k < len(subsets) and (not len(subsets[k]) or keys[k] in results or not block):
+                self.subsets += 1
+                self.seconds += time.perf_counter() - t0 # not counting the caller's time
+                yield results.get(keys[k])
+                t0 = time.perf_counter()
+                k += 1
+        self.seconds += time.perf_counter() - t0
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+#############################################
+# many themes, rows to a file
+#############################################
+
+def sweep(store, themes, risk_aversions, out, max_workers=None, points=200, progress=None):
+    '''
+    compare_theme for every (option, selected_sectors) in themes at every
+    risk aversion, against the whole universe of store, streamed to out
+    (.csv/.parquet) in theme order as results come in. Themes are solved
+    together by a SubsetSolver (max_workers processes, 0 = in this process;
+    an in-memory store runs in this process). Themes without any asset in
+    the universe are left out.
+
+    progress(done, total), if given, is called after each theme.
+
+    Returns {'themes', 'subsets', 'rows', 'seconds', 'themes_per_second',
+    'subsets_per_second'} (subsets: distinct sets of assets solved).
+    '''
+    from themes import ThemeIndex, theme_key
+
+    t0             = time.perf_counter()
+    risk_aversions = np.asarray(risk_aversions, dtype=np.float64)
+    index          = ThemeIndex.from_csv(universe=store.tickers)
+
+    tasks  = [(theme_key(option, sectors), option, list(sectors), index.theme_positions(option, sectors))
+              for option, sectors in themes]
+    writer = open_writer(out)
+    rows   = 0
+    try:
+        with SubsetSolver(store, risk_aversions, points, max_workers) as solver:
+            benchmark, = solver.solve([np.arange(len(store))])
+            benchmark  = benchmark['max_util'][3]
+            results    = solver.solve([positions for *_, positions in tasks])
+            for done, ((key, option, sectors, _), result) in enumerate(zip(tasks, results), 1):
+                if result is not None:
+                    result = dict(result, benchmark_utility=benchmark, utility_loss=benchmark - result['max_util'][3])
+                    theme_rows = result_rows(result, key, option, sectors)
+                    writer.write(theme_rows)
+                    rows += len(theme_rows)
+                if progress:
+                    progress(done, len(tasks))
+    finally:
+        writer.close()
+
+    seconds = time.perf_counter() - t0
+    return {'themes'            : len(tasks),
+            'subsets'           : solver.solved,
+            'rows'              : rows,
+            'seconds'           : seconds,
+            'themes_per_second' : len(tasks) / seconds if seconds else float('inf'),
+            'subsets_per_second': solver.solved / seconds if seconds else float('inf')}
+
+if __name__ == "__main__":
+
+  import argparse
+  import sys
+
+  from themes import DEFAULT_RISK_AVERSION, RISK_LEVELS, fixed_themes
+
+  parser = argparse.ArgumentParser(description='Utility comparisons for many themes x risk aversions, '
+                                               'from the moments artifact in inputs/moments.')
+  parser.add_argument('--out', default='sweep.csv', help='output file, .csv or .parquet')
+  parser.add_argument('--sectors', type=int, nargs='*', default=[2, 3], metavar='SIZE',
+                      help='every combination of SIZE sectors (default: pairs and triples)')
+  parser.add_argument('--fixed', action='store_true',
+                      help="also the menu's fixed themes and each single sector")
+  parser.add_argument('--risk-aversions', type=float, nargs='+', metavar='A',
+                      help="risk aversions (default: the app's risk levels)")
+  parser.add_argument('--grid', type=float, nargs=3, metavar=('LO', 'HI', 'N'),
+                      help='N risk aversions evenly spaced from LO to HI')
+  parser.add_argument('--points', type=int, default=200, help='frontier points per theme')
+  parser.add_argument('--workers', type=int, default=None,
+                      help='processes (default: one per cpu, 0 = no pool)')
+  parser.add_argument('--root', default='inputs/moments', help='moments artifact folder')
+  args = parser.parse_args()
+
+  from moments import load_moments
+
+  if args.grid:
+    risk_aversions = np.linspace(args.grid[0], args.grid[1], int(args.grid[2]))
+  elif args.risk_aversions:
+    risk_aversions = args.risk_aversions
+  else:
+    risk_aversions = list(RISK_LEVELS.values()) + [DEFAULT_RISK_AVERSION]
+
+  themes  = sector_themes(args.sectors) + (fixed_themes() if args.fixed else [])
+  store   = load_moments(args.root)
+
+  def progress(done, total):
+    if done == total or done % 50 == 0:
+      print(f'\r{done}/{total} themes', end='', file=sys.stderr, flush=True)
+
+  summary = sweep(store, themes, risk_aversions, args.out, max_workers=args.workers,
+                  points=args.points, progress=progress)
+  print(file=sys.stderr)
+  print(f"{summary['themes']} themes x {len(risk_aversions)} risk aversions = {summary['rows']} rows "
+        f"in {summary['seconds']:.1f}s ({summary['themes_per_second']:.1f} themes/s, "
+        f"{summary['subsets']} distinct subsets: {summary['subsets_per_second']:.1f}/s) -> {args.out}")
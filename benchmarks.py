@@ -0,0 +1,676 @@
+'''
+Benchmarks on synthetic universes (no downloads).
+
+    python benchmarks.py frontier                    # 50, 434, 2000 assets
+    python benchmarks.py frontier --sizes 50 434     # skip the slow one
+    python benchmarks.py rerun                       # dashboard rerun latency
+    python benchmarks.py render                      # frontier chart build + payload
+    python benchmarks.py imports                     # app cold start vs its budget
+    python benchmarks.py ties                        # CriticalLine on tied returns vs cvxpy
+    python benchmarks.py suite                       # every stage, 50/434/2000/5000 assets
+    python benchmarks.py suite --save-baseline       # ... and make that the baseline
+
+frontier: the old path in get_plotting_structures (max_sharpe + min_volatility
++ 20 efficient_risk solves through pypfopt/cvxpy) against CriticalLine
+(whole frontier, 200 points, tangency and min vol in one pass).
+
+rerun: drives app.py headless (streamlit's AppTest) and times the first run,
+a risk level change and a theme change. Needs the moments artifact
+(`python update_data_cache.py`). AppTest always reruns the whole script, so
+for the fragment that redraws the utility stars this is an upper bound.
+
+render: the frontier chart as app.py built it with plotly express against
+charts.py (trace dicts, WebGL asset clouds thinned past charts.MAX_POINTS):
+layer build time, risk change time up to the JSON streamlit sends, and its
+size.
+
+imports: a fresh interpreter runs app.py once on a synthetic artifact with
+precomputed themes (the fast path), under -X importtime. Prints the slowest
+imports; exit code 1 if it took longer than --budget seconds (default
+IMPORT_BUDGET) or loaded cvxpy/pypfopt, scipy, yfinance/pandas_datareader
+or plotly express, which only the data refresh and reference paths need.
+
+ties: CriticalLine (dense and factor cov) against pypfopt's cvxpy solves
+on expected returns with ties (a few assets tied for the top, CAPM returns
+with repeated betas, all equal): tangency Sharpe and min vol have to agree.
+Exit code 1 if any case doesn't.
+
+suite: time and peak memory (tracemalloc, second run) of each stage of the
+data and optimization paths on synthetic price panels/moments, offline
+(LocalProvider stands in for Yahoo/FRED):
+
+    prices            PriceStore fetch + save, cold store
+    capm_return       pypfopt
+    exp_cov           pypfopt (pairwise python loop: capped at 434 assets)
+    estimator_build   MomentsEstimator over the same panel (same numbers)
+    estimator_update  ... one new day in, one old day out (includes copying
+                      the state, so each run starts from the same one)
+    factor_cov        FactorCovariance.from_prices, 15 factors
+    save_moments      write the versioned artifact
+    load_moments      memory-map it + slice a 100 stock theme
+    theme_index       build ThemeIndex; theme_positions: resolve a theme
+    get_theme_assets  the original csv lookup
+    frontier          CriticalLine: tangency + 200 point frontier
+    frontier_factor   ... the same problem as a 5-factor FactorCovariance
+    get_ef_points     the old pypfopt/cvxpy path (capped at 434 assets)
+    utility           cml_utility, 17 themes x 400 risk aversions
+    cold_imports      fresh interpreter: import the app's dependencies
+    cold_load         ... then open the artifact and build the theme index
+    warm_rerun        loaded store: resolve, slice and solve a new theme
+
+Results are compared with the baseline (benchmarks_baseline.json, written
+by --save-baseline); a stage slower/bigger than --tolerance x baseline is
+flagged and the exit code is 1. Baselines are per machine.
+'''
+
+import argparse
+import copy
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+#############################################
+# synthetic inputs
+#############################################
+
+def synthetic_moments(n_assets, n_factors=5, seed=0, factor=False):
+    '''
+    Annualized e_returns / cov_mat that look roughly like the S&P inputs:
+    a few common factors + idiosyncratic noise, CAPM-ish expected returns.
+    factor=True: cov_mat as the same FactorCovariance (nothing N x N).
+    '''
+    rng     = np.random.default_rng(seed)
+    tickers = [f'A{i:04d}' for i in range(n_assets)]
+
+    loadings = rng.normal(1, .4, (n_assets, n_factors)) * np.r_[.15, np.full(n_factors-1, .06)]
+    idio     = rng.uniform(.15, .40, n_assets)**2
+    betas    = loadings[:, 0] / .15
+    e_ret    = .04 + betas*.06 + rng.normal(0, .03, n_assets)
+
+    if factor:
+        from factors import FactorCovariance
+        return pd.Series(e_ret, index=tickers), FactorCovariance(loadings, idio, tickers)
+    cov_mat  = loadings @ loadings.T + np.diag(idio)
+    return (pd.Series(e_ret, index=tickers),
+            pd.DataFrame(cov_mat, index=tickers, columns=tickers))
+
+def synthetic_prices(n_assets, n_days=2520, n_factors=5, seed=0):
+    '''
+    Daily prices for the last n_days business days (get_data asks for 10
+    years back from today): factor model log returns, S&P-ish vols.
+    '''
+    rng      = np.random.default_rng(seed)
+    tickers  = [f'A{i:04d}' for i in range(n_assets)]
+    dates    = pd.bdate_range(end=pd.Timestamp.now().normalize(), periods=n_days)
+
+    factors  = rng.normal(0, .01, (n_days, n_factors))
+    loadings = rng.normal(1, .4, (n_factors, n_assets)) * np.r_[1, np.full(n_factors-1, .4)][:, None]
+    rets     = .0003 + factors @ loadings + rng.normal(0, .015, (n_days, n_assets))
+    prices   = 100*np.exp(np.cumsum(rets, axis=0))
+
+    return pd.DataFrame(prices, index=dates, columns=tickers)
+
+def synthetic_scores(tickers, seed=0):
+    '''
+    A data_scores.csv look-alike for tickers.
+    '''
+    from themes import SECTORS
+
+    rng  = np.random.default_rng(seed)
+    n    = len(tickers)
+    beta = rng.normal(1, .3, n)
+    beta[rng.random(n) < .015] = np.nan # a few missing, like the real file
+
+    return pd.DataFrame({'Ticker'     : tickers,
+                         'Total-Score': rng.uniform(0, 100, n).round(1),
+                         'Beta'       : beta,
+                         'Sector'     : rng.choice(SECTORS, n),
+                         'Price'      : rng.lognormal(4.5, .8, n).round(2)})
+
+#############################################
+# benchmarks
+#############################################
+
+def _timed(f, *args, **kwargs):
+    t0  = time.perf_counter()
+    out = f(*args, **kwargs)
+    return out, time.perf_counter()-t0
+
+def frontier_old(e_returns, cov_mat, rf_rate):
+    '''
+    What get_plotting_structures did before CriticalLine.
+    '''
+    from pypfopt import EfficientFrontier
+    from frontier import get_ef_points
+
+    ef            = EfficientFrontier(e_returns, cov_mat)
+    ef_max_sharpe = EfficientFrontier(e_returns, cov_mat)
+    ef_min_vol    = EfficientFrontier(e_returns, cov_mat)
+
+    ef_max_sharpe.max_sharpe(risk_free_rate=rf_rate)
+    tangency_port = ef_max_sharpe.portfolio_performance(risk_free_rate=rf_rate)
+
+    ef_min_vol.min_volatility()
+    _, vol_min_vol, _ = ef_min_vol.portfolio_performance()
+
+    risk_range = np.logspace(np.log(vol_min_vol+.000001),
+                             np.log(np.sqrt(np.diag(cov_mat)).max()),
+                             20,
+                             base=np.e)
+    ef_points  = get_ef_points(ef, 'risk', risk_range)
+    return ef_points, tangency_port
+
+def frontier_new(e_returns, cov_mat, rf_rate):
+    from frontier import CriticalLine
+
+    cla           = CriticalLine(e_returns, cov_mat)
+    tangency_port = cla.portfolio_performance(cla.max_sharpe(risk_free_rate=rf_rate),
+                                              risk_free_rate=rf_rate)
+    ret_ef, vol_ef, _ = cla.efficient_frontier(points=200)
+    return [ret_ef, vol_ef], tangency_port
+
+def bench_frontier(sizes=(50, 434, 2000), rf_rate=.04):
+
+    rows = []
+    for n in sizes:
+        e_returns, cov_mat = synthetic_moments(n)
+
+        (pts_new, tan_new), t_new = _timed(frontier_new, e_returns, cov_mat, rf_rate)
+        try:
+            (pts_old, tan_old), t_old = _timed(frontier_old, e_returns, cov_mat, rf_rate)
+        except Exception as e: # the cvxpy solves can give up on big universes
+            print(f"{n:5d} assets: old path failed ({type(e).__name__})")
+            (pts_old, tan_old), t_old = ([[]], [np.nan]*3), np.nan
+
+        rows.append({'assets'         : n,
+                     'old_seconds'    : t_old,
+                     'old_points'     : len(pts_old[0]),
+                     'new_seconds'    : t_new,
+                     'new_points'     : len(pts_new[0]),
+                     'speedup'        : t_old/t_new,
+                     'sharpe_old'     : tan_old[2],
+                     'sharpe_new'     : tan_new[2]})
+        print("{assets:5d} assets: old {old_seconds:8.2f}s ({old_points} pts)  "
+              "new {new_seconds:7.3f}s ({new_points} pts)  x{speedup:6.1f}  "
+              "sharpe {sharpe_old:.4f} vs {sharpe_new:.4f}".format(**rows[-1]))
+
+    return pd.DataFrame(rows)
+
+def bench_rerun(repeats=5):
+    from streamlit.testing.v1 import AppTest
+    from themes import RISK_LEVELS
+
+    at        = AppTest.from_file('app.py', default_timeout=300)
+    _, t_cold = _timed(at.run)
+    rows      = [{'event': 'first run', 'seconds': t_cold}]
+
+    risk = at.radio(key='risk_levels')
+    for i in range(repeats):
+        risk.set_value(list(RISK_LEVELS)[i % len(RISK_LEVELS)])
+        _, t = _timed(at.run)
+        rows.append({'event': 'risk change', 'seconds': t})
+
+    theme = at.sidebar.selectbox[0]
+    for i in range(repeats):
+        theme.set_value(theme.options[i % 2]) # back and forth between two themes
+        _, t = _timed(at.run)
+        rows.append({'event': 'theme change', 'seconds': t})
+
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+
+    out = pd.DataFrame(rows).groupby('event', sort=False)['seconds'].agg(['median', 'max', 'count'])
+    print(out.to_string(float_format='{:.3f}'.format))
+    return out
+
+def chart_old(rf_rate, assets, ef_points, tangency_port, stars):
+    '''
+    How app.py built the frontier chart before charts.py: the static layer
+    through plotly express (cached per theme), the stars through px again
+    and a go.Figure merging them on every rerun. Returns (layer, rerun) as
+    functions.
+    '''
+    import plotly.express as px
+    import plotly.graph_objects as go
+
+    def layer():
+        x_high  = assets[2].max()*.8
+        fig_cml = px.line(x=[0,x_high], y=[rf_rate,rf_rate+x_high*tangency_port[2]])
+        fig_cml.update_traces(line_color='red', line_width=3)
+        fig_ef  = px.line(y=ef_points[0], x=ef_points[1])
+        fig_ef.update_traces(line_color='blue', line_width=3)
+        fig_assets = px.scatter(y=assets[1], x=assets[2], hover_name=assets[0])
+        return fig_cml.data + fig_ef.data + fig_assets.data
+
+    def rerun(static):
+        figs = []
+        for symbol in ('star', 'square'):
+            points = pd.DataFrame({'port': ['Max utility<br>portfolio','Tangency<br>portfolio'],
+                                   'y': [stars[0][0], tangency_port[0]], 'x': [stars[0][1], tangency_port[1]]})
+            fig = px.scatter(points, x='x', y='y', symbol='port', hover_name='port', text='port',
+                             color_discrete_sequence=['red','blue'], symbol_sequence=[symbol, symbol],
+                             labels={'x':'Volatility', 'y':'Expected Returns'}, size=[2,2], color='port')
+            fig.update_traces(showlegend=False)
+            figs.append(fig)
+        fig = go.Figure(data=static + figs[0].data + static + figs[1].data, layout=figs[0].layout)
+        fig.update_layout(height=600, yaxis_range=[0,.5], xaxis_range=[0,.5])
+        return fig
+
+    return layer, rerun
+
+def chart_new(rf_rate, assets, ef_points, tangency_port, stars, max_points):
+    from charts import frontier_layer, frontier_spec, star_traces
+
+    def layer():
+        return frontier_layer(rf_rate, assets, ef_points, tangency_port, 'red', 'blue', max_points=max_points)
+
+    def rerun(static):
+        return frontier_spec(static, star_traces(stars[0], tangency_port, 'star'),
+                             static, star_traces(stars[0], tangency_port, 'square'))
+
+    return layer, rerun
+
+def bench_render(sizes=(434, 2000, 5000, 20000), repeats=5, rf_rate=.04):
+    '''
+    The frontier chart (two layers of `assets` points + the stars) built the
+    old way and through charts.py: time to build a layer (once per theme),
+    time of a risk level rerun up to the JSON streamlit sends (stars, merge,
+    streamlit's validation and serialization) and the size of that JSON.
+    Server side only: the browser's drawing time isn't measured (WebGL
+    helps there, with the bigger clouds).
+    '''
+    import plotly.io as pio
+    import streamlit # noqa: F401 (its plotly template, as in the app)
+    from plotly.tools import return_figure_from_figure_or_data
+
+    from charts import MAX_POINTS
+    from frontier import max_utility_portfolio
+
+    def send(fig): # what st.plotly_chart does with it
+        return pio.to_json(return_figure_from_figure_or_data(fig, True), validate=False)
+
+    rows = []
+    for n in sizes:
+        e_returns, cov_mat = synthetic_moments(n, factor=n > 2000)
+        ef_points, tangency_port = frontier_new(e_returns, cov_mat, rf_rate)
+        vols   = np.sqrt(cov_mat.diagonal() if n > 2000 else np.diag(cov_mat))
+        assets = [np.asarray(e_returns.index), e_returns.to_numpy(), np.asarray(vols)]
+        stars  = max_utility_portfolio(rf_rate, tangency_port, 3)
+        for path, build in (('old', chart_old(rf_rate, assets, ef_points, tangency_port, stars)),
+                            ('new', chart_new(rf_rate, assets, ef_points, tangency_port, stars, MAX_POINTS))):
+            layer, rerun = build
+            static, t_layer = _timed(layer)
+            times = [_timed(lambda: send(rerun(static)))[1] for _ in range(repeats)]
+            rows.append({'assets': n, 'path': path, 'layer_seconds': t_layer,
+                         'rerun_seconds': float(np.median(times)), 'payload_kb': len(send(rerun(static)))/1e3})
+            print("{assets:6d} assets {path}: layer {layer_seconds:6.3f}s  rerun {rerun_seconds:6.3f}s  "
+                  "payload {payload_kb:8.1f} kB".format(**rows[-1]))
+
+    return pd.DataFrame(rows)
+
+#############################################
+# suite
+#############################################
+
+SUITE_SIZES      = (50, 434, 2000, 5000)
+STAGE_MAX_ASSETS = {'exp_cov': 434, 'get_ef_points': 434} # reference paths that take hours beyond this
+BASELINE         = 'benchmarks_baseline.json'
+
+def _measure(f, memory=True, repeat=5, budget=1.):
+    '''
+    (output, seconds, peak_bytes): best of up to `repeat` timed runs (fewer
+    once `budget` seconds are spent), then a traced run for peak memory
+    (tracemalloc slows things down, so it doesn't share the timing).
+    '''
+    out, seconds = _timed(f)
+    spent        = seconds
+    for _ in range(repeat-1):
+        if spent > budget:
+            break
+        _, t     = _timed(f)
+        seconds  = min(seconds, t)
+        spent   += t
+    peak = np.nan
+    if memory:
+        tracemalloc.start()
+        f()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return out, seconds, peak
+
+_COLD = '''
+import json, resource, sys, time
+t0 = time.perf_counter()
+import numpy, pandas, streamlit
+import batch, charts, frontier, instrument, moments, refresh, resample, result_cache, themes
+t1 = time.perf_counter()
+store = moments.load_moments(sys.argv[1])
+index = themes.ThemeIndex(pandas.read_csv(sys.argv[2]), universe=store.tickers)
+t2 = time.perf_counter()
+try: # ru_maxrss survives exec on linux (would report the parent's), VmHWM doesn't
+    maxrss = [int(l.split()[1])*1024 for l in open('/proc/self/status') if l.startswith('VmHWM')][0]
+except OSError:
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+print(json.dumps({'cold_imports': t1-t0, 'cold_load': t2-t1, 'maxrss': maxrss}))
+'''
+
+def _cold_start(root, scores_csv):
+    '''
+    Imports + input loading in a fresh interpreter, (seconds, max rss) each.
+    '''
+    out = subprocess.run([sys.executable, '-c', _COLD, root, scores_csv], capture_output=True,
+                         text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    res = json.loads(out.stdout.strip().splitlines()[-1])
+    return {'cold_imports': (res['cold_imports'], np.nan),
+            'cold_load'   : (res['cold_load'], res['maxrss'])}
+
+#############################################
+# cold start budget
+#############################################
+
+IMPORT_BUDGET = 4.  # seconds, fresh interpreter to the end of the app's first run (one core here)
+HEAVY_MODULES = ('cvxpy', 'pypfopt', 'scipy', 'yfinance', 'pandas_datareader', 'plotly.express')
+
+_FIRST_RUN = '''
+import json, os, sys, time
+t0 = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+t1 = time.perf_counter()
+sys.path.insert(0, os.path.dirname(sys.argv[1]))
+at = AppTest.from_file(sys.argv[1], default_timeout=300)
+at.run()
+t2 = time.perf_counter()
+print(json.dumps({'streamlit': t1-t0, 'first_run': t2-t1, 'modules': sorted(sys.modules),
+                  'exceptions': [e.message for e in at.exception]}))
+'''
+
+def _import_profile(stderr, top=12):
+    '''
+    The slowest top level imports (cumulative seconds) from -X importtime
+    output, lazy ones included.
+    '''
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if len(name) - len(name.lstrip()) == 1:
+            rows.append((int(cumulative)/1e6, name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+def bench_imports(budget=IMPORT_BUDGET, rf_rate=.04):
+    '''
+    Cold start of the app on the precomputed fast path: synthetic moments
+    for the tickers of inputs/data_scores.csv (so every menu theme has its
+    stocks) with precomputed themes (update_data_cache.precompute), then a
+    fresh interpreter runs app.py once (AppTest) under -X importtime.
+    Fails (returns False) if that takes longer than budget seconds or loads
+    any of HEAVY_MODULES (the solver, data download and plotting modules
+    only other paths need).
+    '''
+    from moments import MomentsStore, load_moments, save_moments
+    from update_data_cache import precompute
+
+    here   = os.path.dirname(os.path.abspath(__file__))
+    scores = os.path.join(here, 'inputs', 'data_scores.csv')
+    tmp    = tempfile.mkdtemp(prefix='bench_imports_')
+    cwd    = os.getcwd()
+    try:
+        tickers            = pd.read_csv(scores)['Ticker'].tolist()
+        e_returns, cov_mat = synthetic_moments(len(tickers))
+        e_returns.index    = cov_mat.index = cov_mat.columns = tickers
+        os.makedirs(os.path.join(tmp, 'inputs'))
+        shutil.copy(scores, os.path.join(tmp, 'inputs'))
+        os.chdir(tmp) # precompute and the app read inputs/ from here
+        save_moments(MomentsStore(e_returns, cov_mat, rf_rate), keep=1)
+        precompute(load_moments(), max_workers=1)
+
+        out = subprocess.run([sys.executable, '-X', 'importtime', '-c', _FIRST_RUN, os.path.join(here, 'app.py')],
+                             capture_output=True, text=True, check=True)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    res   = json.loads(out.stdout.strip().splitlines()[-1])
+    total = res['streamlit'] + res['first_run']
+    heavy = [m for m in HEAVY_MODULES if m in res['modules']]
+
+    print(f"{'module':40s} {'seconds':>8s}")
+    for seconds, name in _import_profile(out.stderr):
+        print(f"{name:40s} {seconds:8.3f}")
+    print(f"\nstreamlit {res['streamlit']:.2f}s + first run {res['first_run']:.2f}s = {total:.2f}s "
+          f"(budget {budget:.2f}s, {len(tickers)} assets)")
+    for message in res['exceptions']:
+        print(f"app raised: {message}")
+    if heavy:
+        print(f"loaded on the fast path: {', '.join(heavy)}")
+    return total <= budget and not heavy and not res['exceptions']
+
+def check_ties(n=50, rf_rate=.04, tol=1e-6):
+    '''
+    Tangency Sharpe and min vol of CriticalLine vs EfficientFrontier (cvxpy)
+    with tied expected returns. Returns False if any case is off by more
+    than tol.
+    '''
+    from pypfopt import EfficientFrontier
+    from frontier import CriticalLine
+
+    e_returns, cov_mat = synthetic_moments(n)
+    _, factor_cov      = synthetic_moments(n, factor=True)
+    top                = e_returns.copy()
+    top.iloc[:3]       = e_returns.max() + .01
+    cases              = {'top 3 tied' : top,
+                          'capm betas' : e_returns.round(2),
+                          'all equal'  : e_returns*0 + .08}
+
+    ok = True
+    for name, mu in cases.items():
+        ef = EfficientFrontier(mu, cov_mat)
+        ef.max_sharpe(risk_free_rate=rf_rate)
+        sharpe_ref = ef.portfolio_performance(risk_free_rate=rf_rate)[2]
+        ef = EfficientFrontier(mu, cov_mat)
+        ef.min_volatility()
+        vol_ref    = ef.portfolio_performance()[1]
+        for cov_name, cov in [('dense', cov_mat), ('factor', factor_cov)]:
+            cla    = CriticalLine(mu, cov)
+            sharpe = cla.portfolio_performance(cla.max_sharpe(rf_rate), rf_rate)[2]
+            vol    = cla.portfolio_performance(cla.min_volatility())[1]
+            good   = abs(sharpe-sharpe_ref) <= tol*abs(sharpe_ref) and abs(vol-vol_ref) <= tol*vol_ref
+            ok    &= good
+            print(f"{name:12s} {cov_name:7s} sharpe {sharpe:.6f} vs {sharpe_ref:.6f}  "
+                  f"min vol {vol:.6f} vs {vol_ref:.6f}  {'ok' if good else 'MISMATCH'}")
+    return ok
+
+def bench_suite(sizes=SUITE_SIZES, memory=True, limits=True, rf_rate=.04):
+    '''
+    Every stage at every size. Returns a DataFrame: assets, stage, seconds,
+    peak_mb (cold_load: max rss of the fresh process). Stages over their
+    size cap are skipped (NaN).
+    '''
+    from pypfopt import expected_returns, risk_models
+
+    from estimator import MomentsEstimator
+    from factors import FactorCovariance
+    from frontier import CriticalLine, cml_utility
+    from moments import MomentsStore, load_moments, save_moments
+    from price_store import LocalProvider, PriceStore
+    from themes import ThemeIndex, get_theme_assets
+
+    tmp  = tempfile.mkdtemp(prefix='bench_')
+    rows = []
+
+    def run(n, name, f):
+        if limits and n > STAGE_MAX_ASSETS.get(name, np.inf):
+            rows.append({'assets': n, 'stage': name, 'seconds': np.nan, 'peak_mb': np.nan})
+            return None
+        out, seconds, peak = _measure(f, memory)
+        rows.append({'assets': n, 'stage': name, 'seconds': seconds, 'peak_mb': peak/1e6})
+        print(f"{n:5d} assets  {name:17s} {seconds:9.4f}s  peak {peak/1e6:9.1f}MB", flush=True)
+        return out
+
+    try:
+        for n in sizes:
+            prices             = synthetic_prices(n)
+            tickers            = list(prices.columns)
+            e_returns, cov_mat = synthetic_moments(n)
+            scores             = synthetic_scores(tickers)
+            start, end         = prices.index[0], prices.index[-1] + pd.Timedelta(days=1)
+            provider           = LocalProvider(prices, risk_free_rate=rf_rate)
+
+            # data path (get_data)
+
+            def fetch():
+                root = tempfile.mkdtemp(dir=tmp)
+                return PriceStore(root=root).get_prices(tickers, start, end, provider=provider)
+            panel = run(n, 'prices', fetch).astype(np.float64)
+            run(n, 'capm_return', lambda panel=panel: expected_returns.capm_return(panel, risk_free_rate=rf_rate))
+            run(n, 'exp_cov', lambda panel=panel: risk_models.exp_cov(panel))
+            est = run(n, 'estimator_build', lambda panel=panel: MomentsEstimator.from_prices(panel.iloc[:-1]))
+            run(n, 'estimator_update', lambda est=est, panel=panel: copy.deepcopy(est).refresh(panel, panel.index[1]))
+            del est
+            run(n, 'factor_cov', lambda panel=panel: FactorCovariance.from_prices(panel, 15))
+            del panel
+
+            # artifact + themes
+
+            root  = os.path.join(tmp, f'moments_{n}')
+            os.makedirs(root)
+            store = MomentsStore(e_returns, cov_mat, rf_rate)
+            run(n, 'save_moments', lambda: save_moments(store, root=root, keep=1))
+            theme = tickers[::max(1, n//100)][:100]
+            run(n, 'load_moments', lambda: load_moments(root).subset(theme))
+
+            index = run(n, 'theme_index', lambda: ThemeIndex(scores, universe=tickers))
+            run(n, 'theme_positions', lambda: index.theme_positions('ESG Investing'))
+
+            scores_dir = os.path.join(tmp, f'scores_{n}')
+            os.makedirs(os.path.join(scores_dir, 'inputs'))
+            scores_csv = os.path.join(scores_dir, 'inputs', 'data_scores.csv')
+            scores.to_csv(scores_csv, index=False)
+            cwd = os.getcwd()
+            os.chdir(scores_dir) # get_theme_assets reads inputs/data_scores.csv
+            try:
+                run(n, 'get_theme_assets', lambda: get_theme_assets('ESG Investing', []))
+            finally:
+                os.chdir(cwd)
+
+            # optimization path (get_plotting_structures)
+
+            _, tangency_port = run(n, 'frontier', lambda: frontier_new(e_returns, cov_mat, rf_rate))
+            run(n, 'get_ef_points', lambda: frontier_old(e_returns, cov_mat, rf_rate))
+            _, factor_cov = synthetic_moments(n, factor=True)
+            run(n, 'frontier_factor', lambda: frontier_new(e_returns, factor_cov, rf_rate))
+            tangency = np.array([tangency_port[:2]] * 17)
+            run(n, 'utility', lambda: cml_utility(rf_rate, tangency[:, :1], tangency[:, 1:], np.linspace(.05, 10, 400)))
+
+            # cold start vs warm rerun
+
+            for name, (seconds, peak) in _cold_start(root, scores_csv).items():
+                rows.append({'assets': n, 'stage': name, 'seconds': seconds, 'peak_mb': peak/1e6})
+                print(f"{n:5d} assets  {name:17s} {seconds:9.4f}s  rss  {peak/1e6:9.1f}MB", flush=True)
+
+            loaded = load_moments(root)
+            def rerun():
+                mu, cov, rf = loaded.subset(positions=index.theme_positions('Cheapest Stocks'))
+                cla = CriticalLine(mu, cov)
+                tan = cla.portfolio_performance(cla.max_sharpe(risk_free_rate=rf), risk_free_rate=rf)
+                cla.efficient_frontier(points=200)
+                return cml_utility(rf, tan[0], tan[1], np.linspace(.05, 10, 400))
+            run(n, 'warm_rerun', rerun)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return pd.DataFrame(rows)
+
+def _versions():
+    import cvxpy
+    import pypfopt
+    return {'python': platform.python_version(), 'machine': platform.machine(),
+            'processor': platform.processor() or platform.machine(), 'cpus': os.cpu_count(),
+            'numpy': np.__version__, 'pandas': pd.__version__,
+            'pypfopt': getattr(pypfopt, '__version__', '?'), 'cvxpy': cvxpy.__version__}
+
+def save_baseline(results, path=BASELINE):
+    with open(path, 'w') as f:
+        json.dump({'versions': _versions(),
+                   'results' : json.loads(results.to_json(orient='records'))}, f, indent=1)
+
+def compare_baseline(results, path=BASELINE, tolerance=1.5, min_seconds=.01, min_mb=1):
+    '''
+    results joined with the baseline, plus ratios and a regression flag:
+    over tolerance x baseline and more than min_seconds / min_mb worse.
+    None if there's no baseline.
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        base = json.load(f)
+
+    out = results.merge(pd.DataFrame(base['results']), on=['assets', 'stage'], how='left',
+                        suffixes=('', '_base'))
+    out['time_ratio']   = out['seconds'] / out['seconds_base']
+    out['memory_ratio'] = out['peak_mb'] / out['peak_mb_base']
+    out['regression']   = (((out['time_ratio'] > tolerance) & (out['seconds'] - out['seconds_base'] > min_seconds))
+                           | ((out['memory_ratio'] > tolerance) & (out['peak_mb'] - out['peak_mb_base'] > min_mb)))
+
+    changed = {k: (v, _versions().get(k)) for k, v in base['versions'].items() if _versions().get(k) != v}
+    if changed:
+        print('baseline was recorded with different versions/machine: '
+              + ', '.join(f'{k} {old} -> {new}' for k, (old, new) in changed.items()))
+    return out
+
+#############################################
+# cli
+#############################################
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('which', choices=['frontier', 'rerun', 'render', 'imports', 'ties', 'suite'])
+    parser.add_argument('--sizes', type=int, nargs='+', default=None,
+                        help='universe sizes (frontier: 50 434 2000, render: 434 2000 5000 20000, '
+                             'suite: 50 434 2000 5000)')
+    parser.add_argument('--no-memory', action='store_true', help="suite: skip the traced peak memory runs")
+    parser.add_argument('--no-limits', action='store_true', help='suite: run the slow reference stages at every size')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET, help='imports: cold start budget, seconds')
+    args = parser.parse_args()
+
+    if args.which == 'frontier':
+        bench_frontier(args.sizes or [50, 434, 2000])
+    elif args.which == 'rerun':
+        bench_rerun()
+    elif args.which == 'render':
+        bench_render(args.sizes or [434, 2000, 5000, 20000])
+    elif args.which == 'imports':
+        if not bench_imports(budget=args.budget):
+            sys.exit(1)
+    elif args.which == 'ties':
+        if not check_ties():
+            sys.exit(1)
+    elif args.which == 'suite':
+        results = bench_suite(args.sizes or SUITE_SIZES, memory=not args.no_memory, limits=not args.no_limits)
+        if args.save_baseline:
+            save_baseline(results, args.baseline)
+            print(f"saved baseline to {args.baseline}")
+        else:
+            report = compare_baseline(results, args.baseline, args.tolerance)
+            if report is None:
+                print(f"no baseline at {args.baseline} (use --save-baseline)")
+            else:
+                cols = ['assets', 'stage', 'seconds', 'seconds_base', 'time_ratio', 'peak_mb', 'peak_mb_base', 'memory_ratio']
+                print(report[cols + ['regression']].to_string(index=False, float_format='{:.3f}'.format))
+                if report['regression'].any():
+                    print(f"{report['regression'].sum()} stage(s) regressed")
+                    sys.exit(1)
@@ -0,0 +1,151 @@
+'''
+The dashboard's charts as plain plotly specs (dicts of traces and layout).
+
+The frontier chart is mostly static: per theme and moments version the CML,
+the efficient frontier and the asset cloud never change; only the four
+max utility / tangency markers move with the risk level. So
+
+    frontier_layer()   the static traces of one theme, built once per
+                       (version, theme) and cached by the app; coordinates
+                       rounded to `digits` decimals (well below a pixel) so
+                       the spec the browser gets is about half the size
+    star_traces()      the markers, rebuilt on every rerun (a few dicts)
+    frontier_spec()    both layers + FRONTIER_LAYOUT, what st.plotly_chart
+                       is given
+
+Built as dicts rather than through plotly express: px builds a DataFrame
+and a whole figure per call and go.Figure validates every trace again when
+layers are merged, which was most of a rerun's chart time. Streamlit still
+validates and serializes the spec it's given, once.
+
+Asset clouds above GL_POINTS points are drawn with scattergl (WebGL), and
+above max_points they're thinned (downsample: the upper-left edge of the
+cloud, which is what the eye compares with the frontier, plus an even
+random sample of the rest).
+
+payload_bytes() is the size of the JSON streamlit sends for a spec.
+'''
+
+import numpy as np
+
+GL_POINTS  = 200   # asset clouds bigger than this are drawn with WebGL
+MAX_POINTS = 5000  # ... and thinned beyond this
+DIGITS     = 5
+
+FRONTIER_LAYOUT = {'height': 600,
+                   'font'  : {'size': 16},
+                   'margin': {'t': 60},
+                   'xaxis' : {'title': {'text': 'Volatility', 'font': {'size': 20}},
+                              'tickfont': {'size': 20}, 'range': [0, .5]},
+                   'yaxis' : {'title': {'text': 'Expected Returns', 'font': {'size': 20}},
+                              'tickfont': {'size': 20}, 'range': [0, .5]}}
+
+def _default_color():
+    '''
+    First color of the default template (what px gives a single trace).
+    '''
+    import plotly.io as pio
+
+    colorway = pio.templates[pio.templates.default].layout.colorway
+    return colorway[0] if colorway else None
+
+def downsample(x, y, max_points, seed=0):
+    '''
+    Sorted positions of at most max_points of the points (x, y): every point
+    on the upper-left edge (no other point has lower x and higher y), the
+    rest an even random sample. All of them if there are few enough.
+    '''
+    n = len(x)
+    if n <= max_points:
+        return np.arange(n)
+    order = np.lexsort((-y, x))
+    best  = np.maximum.accumulate(y[order])
+    edge  = order[np.r_[True, y[order][1:] > best[:-1]]]
+    if len(edge) >= max_points:
+        return np.sort(edge[np.linspace(0, len(edge)-1, max_points).astype(int)])
+    rest  = np.setdiff1d(np.arange(n), edge)
+    rest  = np.random.default_rng(seed).choice(rest, max_points-len(edge), replace=False)
+    return np.sort(np.concatenate([edge, rest]))
+
+def frontier_layer(rf_rate, assets, ef_points, tangency_port, cml_color, ef_color, asset_color=None,
+                   max_points=MAX_POINTS, digits=DIGITS):
+    '''
+    Static traces of one theme's frontier chart: CML, efficient frontier and
+    the assets (tickers, returns, vols, as from get_plotting_structures).
+    '''
+    tickers, rets, vols = np.asarray(assets[0]), np.asarray(assets[1], dtype=np.float64), np.asarray(assets[2], dtype=np.float64)
+    x_high = vols.max()*.8
+    keep   = downsample(vols, rets, max_points)
+
+    cml    = {'type': 'scatter', 'mode': 'lines', 'showlegend': False,
+              'x': [0, round(float(x_high), digits)],
+              'y': [round(float(rf_rate), digits), round(float(rf_rate + x_high*tangency_port[2]), digits)],
+              'line': {'color': cml_color, 'width': 3},
+              'hovertemplate': 'x=%{x}<br>y=%{y}<extra></extra>'}
+    ef     = {'type': 'scatter', 'mode': 'lines', 'showlegend': False,
+              'x': np.round(ef_points[1], digits), 'y': np.round(ef_points[0], digits),
+              'line': {'color': ef_color, 'width': 3},
+              'hovertemplate': 'x=%{x}<br>y=%{y}<extra></extra>'}
+    cloud  = {'type': 'scattergl' if len(keep) > GL_POINTS else 'scatter', 'mode': 'markers', 'showlegend': False,
+              'x': np.round(vols[keep], digits), 'y': np.round(rets[keep], digits),
+              'hovertext': tickers[keep].tolist(),
+              'marker': {'color': asset_color or _default_color()},
+              'hovertemplate': '<b>%{hovertext}</b><br><br>x=%{x}<br>y=%{y}<extra></extra>'}
+    return [cml, ef, cloud]
+
+def star_traces(max_util_port, tangency_port, symbol='star'):
+    '''
+    The max utility (red) and tangency (blue) markers, labelled. The red
+    label goes underneath when the two are close, so the labels don't
+    overlap.
+    '''
+    close  = abs(max_util_port[1]-tangency_port[1]) < .02
+    traces = []
+    for name, port, color in [('Max utility<br>portfolio', max_util_port, 'red'),
+                              ('Tangency<br>portfolio', tangency_port, 'blue')]:
+        traces.append({'type': 'scatter', 'mode': 'markers+text', 'showlegend': False, 'name': name,
+                       'x': [float(port[1])], 'y': [float(port[0])], 'text': [name], 'hovertext': [name],
+                       'marker': {'symbol': symbol, 'color': color, 'size': 20},
+                       'textfont': {'color': color},
+                       'textposition': 'bottom center' if color == 'red' and close else 'top center',
+                       'hovertemplate': '<b>%{hovertext}</b><br><br>Volatility=%{x}<br>'
+                                        'Expected Returns=%{y}<extra></extra>'})
+    return traces
+
+def frontier_spec(*layers):
+    '''
+    The frontier chart from lists of traces, drawn in order.
+    '''
+    return {'data': [trace for layer in layers for trace in layer], 'layout': FRONTIER_LAYOUT}
+
+def utility_loss_spec(risk_aversions, loss, risk_aversion, band=None):
+    '''
+    Utility loss over a grid of risk aversions, the picked one marked, and
+    optionally a band (dict with 'lower' and 'upper' on the same grid).
+    '''
+    x      = np.round(risk_aversions, DIGITS)
+    traces = [{'type': 'scatter', 'mode': 'lines', 'showlegend': False,
+               'x': x, 'y': np.round(loss, DIGITS), 'line': {'color': 'purple', 'width': 3},
+               'hovertemplate': 'Risk aversion (A)=%{x}<br>Loss of utility=%{y}<extra></extra>'}]
+    if band is not None:
+        traces += [{'type': 'scatter', 'mode': 'lines', 'showlegend': False, 'hoverinfo': 'skip',
+                    'x': x, 'y': np.round(band['upper'], DIGITS), 'line': {'width': 0}},
+                   {'type': 'scatter', 'mode': 'lines', 'name': '90% band', 'hoverinfo': 'skip',
+                    'x': x, 'y': np.round(band['lower'], DIGITS), 'line': {'width': 0},
+                    'fill': 'tonexty', 'fillcolor': 'rgba(128,0,128,.2)'}]
+    return {'data'  : traces,
+            'layout': {'height': 400, 'font': {'size': 16}, 'margin': {'t': 60},
+                       'xaxis': {'title': {'text': 'Risk aversion (A)'}},
+                       'yaxis': {'title': {'text': 'Loss of utility'}},
+                       'shapes': [{'type': 'line', 'x0': risk_aversion, 'x1': risk_aversion, 'xref': 'x',
+                                   'y0': 0, 'y1': 1, 'yref': 'y domain',
+                                   'line': {'color': 'gray', 'dash': 'dash'}}]}}
+
+def payload_bytes(spec):
+    '''
+    Size of the JSON streamlit sends for spec (a dict or a go.Figure).
+    '''
+    import plotly.io as pio
+    from plotly.tools import return_figure_from_figure_or_data
+
+    return len(pio.to_json(return_figure_from_figure_or_data(spec, True), validate=False))
@@ -0,0 +1,364 @@
+'''
+ESG score harvester: the yesg loop from getting_ESG_scores.ipynb as a
+module + CLI.
+
+    python esg_harvest.py                     # S&P list (wikipedia) -> esg_scores.csv
+    python esg_harvest.py --workers 16        # more requests in flight
+    python esg_harvest.py --stub --out /tmp/esg_scores.csv   # offline
+
+Tickers are fetched on a bounded thread pool, each retried with backoff.
+As each one lands, its history is reduced to yearly means (the notebook's
+groupby(['year', 'Company_Symbol']).mean()) and appended to a checkpoint
+next to the output (<out>.progress.jsonl). An interrupted run resumes from
+there: tickers already in the checkpoint aren't fetched again. Every
+`write_every` tickers (and at the end) the yearly rows are merged into the
+csv, which is written to a temp file and moved into place. The checkpoint
+goes once every ticker is in.
+
+Only years newer than what the csv already holds for a ticker are kept.
+The newest year held is redone if it wasn't over when it was written (its
+mean was partial).
+
+Providers are pluggable, like price_store's: anything with
+get_historic_esg(ticker, start_year) and get_tickers(). StubESGProvider
+stands in for yesg/wikipedia offline.
+'''
+
+import json
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+SCORE_COLUMNS = ['Total-Score', 'E-Score', 'S-Score', 'G-Score']
+KEY_COLUMNS   = ['year', 'Company_Symbol']
+SP500_URL     = 'https://en.wikipedia.org/wiki/List_of_S%26P_500_companies'
+
+#############################################
+# providers
+#############################################
+
+class ESGProvider:
+    '''
+    Interface for anything that can supply ESG score histories.
+
+    get_historic_esg(ticker, start_year) returns a frame with SCORE_COLUMNS
+    indexed by date (datetimes, or unix seconds like yesg). start_year is a
+    hint: earlier rows may come back too (they're dropped). None or an
+    empty frame if there's no data for the ticker.
+    '''
+
+    def get_historic_esg(self, ticker, start_year=None):
+        raise NotImplementedError
+
+    def get_tickers(self):
+        raise NotImplementedError
+
+
+class YesgProvider(ESGProvider):
+    '''
+    Scores from yesg (Yahoo's ESG history), tickers from the wikipedia S&P
+    500 list. Needs `pip install yesg beautifulsoup4`.
+    '''
+
+    def get_historic_esg(self, ticker, start_year=None):
+
+        import yesg
+
+        return yesg.get_historic_esg(ticker) # no date filter in the api: whole history
+
+    def get_tickers(self):
+
+        import bs4 as bs
+        import requests
+
+        resource = requests.get(SP500_URL, timeout=30)
+        soup     = bs.BeautifulSoup(resource.text, 'html.parser')
+        table    = soup.find('table', {'class': 'wikitable sortable'})
+        return [row.findAll('td')[0].text.replace('\n', '') for row in table.findAll('tr')[1:]]
+
+
+class StubESGProvider(ESGProvider):
+    '''
+    Offline stand-in for yesg. Monthly scores per ticker (indexed by unix
+    seconds, like yesg) from `scores`, a frame shaped like esg_scores.csv
+    (each yearly mean repeated monthly, so harvesting it gives the same
+    yearly rows back). Without one, they're made up deterministically from
+    the ticker name, first_year to last_year.
+
+    latency, fail_rate and calls work as in price_store.LocalProvider.
+    Tickers in `missing` have no data.
+    '''
+
+    def __init__(self, scores=None, tickers=None, first_year=2014, last_year=None,
+                 missing=(), latency=0, fail_rate=0, seed=0):
+        if isinstance(scores, (str, os.PathLike)):
+            scores = pd.read_csv(scores)
+        self.scores     = scores
+        self.tickers    = list(tickers) if tickers is not None else (
+                          sorted(scores['Company_Symbol'].unique()) if scores is not None else
+                          pd.read_csv('inputs/sp500_tickers.csv', header=None)[0].tolist())
+        self.first_year = first_year
+        self.last_year  = last_year or datetime.now().year
+        self.missing    = set(missing)
+        self.latency    = latency
+        self.fail_rate  = fail_rate
+        self.seed       = seed
+        self.rng        = np.random.default_rng(seed)
+        self.calls      = 0
+        self._lock      = threading.Lock()
+
+    def get_tickers(self):
+        return list(self.tickers)
+
+    def get_historic_esg(self, ticker, start_year=None):
+        with self._lock:
+            self.calls += 1
+            fail = self.fail_rate and self.rng.random() < self.fail_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise ConnectionError('StubESGProvider: injected failure')
+        if ticker in self.missing:
+            return None
+
+        if self.scores is not None:
+            rows  = self.scores.loc[self.scores['Company_Symbol'] == ticker]
+            years = rows['year'].to_numpy()
+            vals  = rows[SCORE_COLUMNS].to_numpy(dtype=np.float64)
+        else:
+            rng   = np.random.default_rng([zlib.crc32(ticker.encode()), self.seed])
+            years = np.arange(self.first_year, self.last_year+1)
+            vals  = np.clip(rng.uniform(40, 80, 4) + np.cumsum(rng.normal(0, 2, (len(years), 4)), axis=0), 0, 100)
+
+        keep   = years >= (start_year or 0)
+        months = pd.DatetimeIndex([pd.Timestamp(int(y), m, 1) for y in years[keep] for m in range(1, 13)])
+        months = months[months <= pd.Timestamp.now()]
+        vals   = np.repeat(vals[keep], 12, axis=0)[:len(months)]
+        epoch  = (months - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
+        return pd.DataFrame(vals, index=np.asarray(epoch), columns=SCORE_COLUMNS)
+
+#############################################
+# one ticker
+#############################################
+
+def yearly_scores(history, ticker, start_year=None):
+    '''
+    A provider's score history for one ticker -> its yearly mean rows
+    (year, Company_Symbol, scores), from start_year on. Rows with a
+    missing score are dropped first, as in the notebook.
+    '''
+    df = pd.DataFrame(history)
+    if df.empty:
+        return pd.DataFrame(columns=KEY_COLUMNS + SCORE_COLUMNS)
+
+    index   = df.index
+    dates   = pd.to_datetime(index, unit='s') if pd.api.types.is_numeric_dtype(index) else pd.to_datetime(index)
+    df      = df.reindex(columns=SCORE_COLUMNS).apply(pd.to_numeric, errors='coerce')
+    df['year'] = np.asarray(dates.year)
+    df      = df.dropna()
+    if start_year is not None:
+        df  = df.loc[df['year'] >= start_year]
+
+    out = df.groupby('year', sort=True)[SCORE_COLUMNS].mean().reset_index()
+    out.insert(1, 'Company_Symbol', ticker)
+    return out
+
+def _fetch_ticker(provider, ticker, start_year, retries, backoff):
+    '''
+    One ticker, retried with exponential backoff. Returns (rows, error);
+    rows is None if every attempt failed.
+    '''
+    error = None
+    for attempt in range(1, retries+1):
+        try:
+            return yearly_scores(provider.get_historic_esg(ticker, start_year), ticker, start_year), None
+        except Exception as e:
+            error = repr(e)
+            if attempt < retries:
+                time.sleep(backoff * 2**(attempt-1))
+    return None, error
+
+#############################################
+# checkpoint + csv
+#############################################
+
+class _Checkpoint:
+    '''
+    One json line per finished ticker: {"ticker", "rows", "error"}. Appended
+    (and flushed) as tickers finish, so a crash loses at most the ones in
+    flight. A half-written last line is ignored.
+    '''
+
+    def __init__(self, path):
+        self.path   = path
+        self.done   = {}
+        self.failed = {}
+        self._lock  = threading.Lock()
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._note(rec)
+        except FileNotFoundError:
+            pass
+
+    def _note(self, rec):
+        if rec['error'] is None:
+            self.done[rec['ticker']] = rec['rows']
+            self.failed.pop(rec['ticker'], None)
+        else:
+            self.failed[rec['ticker']] = rec['error']
+
+    def record(self, ticker, rows, error):
+        rec = {'ticker': ticker,
+               'rows'  : None if rows is None else rows[['year'] + SCORE_COLUMNS].values.tolist(),
+               'error' : error}
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(rec) + '\n')
+            self._note(rec)
+
+    def rows(self):
+        with self._lock:
+            rows = [[int(r[0]), ticker] + r[1:] for ticker, rs in self.done.items() for r in rs]
+        return pd.DataFrame(rows, columns=KEY_COLUMNS + SCORE_COLUMNS)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+def load_scores(path='esg_scores.csv'):
+    try:
+        return pd.read_csv(path)
+    except FileNotFoundError:
+        return pd.DataFrame(columns=KEY_COLUMNS + SCORE_COLUMNS)
+
+def start_years(scores, this_year=None):
+    '''
+    First year to keep per ticker: the year after the newest one held, or
+    that year itself if it wasn't over yet (>= this_year).
+    '''
+    this_year = this_year or datetime.now().year
+    last      = scores.groupby('Company_Symbol')['year'].max()
+    return {t: int(y) if y >= this_year else int(y)+1 for t, y in last.items()}
+
+def merge_scores(scores, new):
+    '''
+    scores with new's (year, ticker) rows added, replacing any already
+    there. Sorted like esg_scores.csv.
+    '''
+    if new.empty:
+        return scores
+    old  = pd.MultiIndex.from_frame(scores[KEY_COLUMNS].astype({'year': int}))
+    keep = ~old.isin(pd.MultiIndex.from_frame(new[KEY_COLUMNS]))
+    out  = pd.concat([scores.loc[keep], new], ignore_index=True)
+    out['year'] = out['year'].astype(int)
+    return out.sort_values(KEY_COLUMNS).reset_index(drop=True)
+
+def write_scores(scores, path='esg_scores.csv'):
+    tmp = path + '.tmp'
+    scores.to_csv(tmp, index=False)
+    os.replace(tmp, path)
+
+#############################################
+# the harvest
+#############################################
+
+def harvest(tickers=None, provider=None, out='esg_scores.csv', max_workers=8, retries=3,
+            backoff=1.0, write_every=100, restart=False, this_year=None, progress=None):
+    '''
+    Fetch ESG histories for tickers (default: provider.get_tickers()) and
+    merge the new yearly rows into `out`. Resumes from <out>.progress.jsonl
+    unless restart. progress(done, total) is called as tickers finish.
+    retries is the number of attempts per ticker (at least 1).
+
+    Returns a dict: tickers, fetched (this run), resumed (from the
+    checkpoint), rows (new yearly rows), failed ({ticker: error}), seconds
+    '''
+    if retries < 1:
+        raise ValueError(f'retries is the number of attempts per ticker, needs to be >= 1 (got {retries})')
+
+    t0       = time.perf_counter()
+    provider = provider or YesgProvider()
+    tickers  = list(dict.fromkeys(tickers or provider.get_tickers()))
+    scores   = load_scores(out)
+    starts   = start_years(scores, this_year)
+
+    ckpt = _Checkpoint(out + '.progress.jsonl')
+    if restart:
+        ckpt.remove()
+        ckpt = _Checkpoint(ckpt.path)
+    todo    = [t for t in tickers if t not in ckpt.done]
+    resumed = len(tickers) - len(todo)
+
+    def flush():
+        write_scores(merge_scores(scores, ckpt.rows()), out)
+
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {pool.submit(_fetch_ticker, provider, t, starts.get(t), retries, backoff): t for t in todo}
+        for i, fut in enumerate(as_completed(futures), 1):
+            rows, error = fut.result()
+            ckpt.record(futures[fut], rows, error)
+            if progress:
+                progress(resumed + i, len(tickers))
+            if write_every and i % write_every == 0:
+                flush()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True) # ctrl-c: keep what's checkpointed
+
+    new    = ckpt.rows()
+    failed = {t: e for t, e in ckpt.failed.items() if t in set(tickers)}
+    flush()
+    if not failed:
+        ckpt.remove()
+
+    return {'tickers': len(tickers),
+            'fetched': len(todo),
+            'resumed': resumed,
+            'rows'   : len(new),
+            'failed' : failed,
+            'seconds': time.perf_counter() - t0}
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Harvest yearly ESG scores into esg_scores.csv.')
+    parser.add_argument('--out', default='esg_scores.csv')
+    parser.add_argument('--tickers-file', default=None,
+                        help='one ticker per line (e.g. inputs/sp500_tickers.csv); default: the S&P 500 list on wikipedia')
+    parser.add_argument('--workers', type=int, default=8, help='requests in flight')
+    parser.add_argument('--retries', type=int, default=3, help='attempts per ticker (at least 1)')
+    parser.add_argument('--backoff', type=float, default=1.0, help='seconds before the first retry (doubles)')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint of an unfinished run')
+    parser.add_argument('--stub', action='store_true', help='offline: StubESGProvider instead of yesg')
+    args = parser.parse_args()
+    if args.retries < 1:
+        parser.error('--retries needs to be at least 1')
+
+    tickers = None
+    if args.tickers_file:
+        tickers = pd.read_csv(args.tickers_file, header=None)[0].tolist()
+
+    def progress(done, total):
+        print(f"\r{done}/{total} tickers", end='', flush=True)
+
+    stats = harvest(tickers, StubESGProvider() if args.stub else YesgProvider(), out=args.out,
+                    max_workers=args.workers, retries=args.retries, backoff=args.backoff,
+                    restart=args.restart, progress=progress)
+    print(f"\n{stats['fetched']} fetched, {stats['resumed']} resumed from the checkpoint, "
+          f"{stats['rows']} new yearly rows, {stats['seconds']:.1f}s -> {args.out}")
+    if stats['failed']:
+        print(f"{len(stats['failed'])} failed (rerun to retry them): " + ', '.join(list(stats['failed'])[:10]))
@@ -0,0 +1,292 @@
+'''
+Incremental moments for the daily refresh.
+
+get_data's estimators, pypfopt's exp_cov (EWMA covariance) and capm_return
+(CAPM with the equal-weighted universe as the market), both redo O(T*N^2)
+work over 10 years of prices on every refresh, exp_cov in a python loop
+over pairs. Both are functions of running sums over the return rows, so
+MomentsEstimator keeps those sums instead:
+
+    EWMA, per pair (pairwise-complete, like pandas):
+        W = sum w m m'    A = sum w x m'    B = sum w x x'
+        (x = returns with 0 for missing, m = observed mask, w = decay^age)
+    column means:   n, sum x
+    CAPM:           per asset sum x*mkt and sum mkt over its rows,
+                    sum mkt, sum mkt^2, sum log(1+mkt), rows
+
+A new day is one decay-weighted rank-1 update of W/A/B (k days: rank-k,
+one matrix product) and O(N) for the rest. A day dropping out of the
+10-year window is the same update with a negative weight. moments() turns
+the sums into exactly what exp_cov/capm_return return (the same PSD fix,
+without importing pypfopt), up to float rounding; drift() measures that
+against a fresh build (or against pypfopt itself).
+
+The market proxy is the average of the estimator's tickers, so a change of
+universe means a rebuild (from_prices), as does a change in which tickers
+pass get_data's history filter.
+
+State is one .npz (save/load). W, A and B are N x N float64 each: about
+4.5MB at 434 assets, 600MB at 5000. covariance=False leaves them out (CAPM
+returns only, O(N): what get_data uses next to a factor covariance).
+'''
+
+import json
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+ESTIMATOR_FORMAT = 1
+
+def _day(d):
+    return pd.Timestamp(d).normalize()
+
+def _returns(prices):
+    '''
+    pypfopt's returns_from_prices: simple returns, all-NaN rows dropped.
+    '''
+    return prices.pct_change().dropna(how='all')
+
+def fix_nonpositive_semidefinite(matrix):
+    '''
+    pypfopt's fix_nonpositive_semidefinite(matrix, 'spectral'): negative
+    eigenvalues set to 0, if the Cholesky check fails (same warning). Here
+    so the estimator paths don't import pypfopt, and with it cvxpy.
+    '''
+    def is_psd(m):
+        try:
+            np.linalg.cholesky(m + 1e-16*np.eye(len(m)))
+            return True
+        except np.linalg.LinAlgError:
+            return False
+
+    if is_psd(matrix):
+        return matrix
+    warnings.warn('The covariance matrix is non positive semidefinite. Amending eigenvalues.')
+    q, V  = np.linalg.eigh(matrix)
+    fixed = (V * np.where(q > 0, q, 0)) @ V.T
+    if not is_psd(fixed):
+        warnings.warn('Could not fix matrix. Please try a different risk model.', UserWarning)
+    if isinstance(matrix, pd.DataFrame):
+        return pd.DataFrame(fixed, index=matrix.index, columns=matrix.index)
+    return fixed
+
+class MomentsEstimator:
+    '''
+    Running EWMA covariance / CAPM sums for a fixed universe over a sliding
+    window of daily prices.
+
+    Build with from_prices(prices, start), then refresh(prices, start)
+    with a panel that starts no later than the current window (so the days
+    leaving it can be taken out) and runs to the new end.
+    '''
+
+    def __init__(self, tickers, span=180, frequency=252, covariance=True):
+
+        n               = len(tickers)
+        self.tickers    = pd.Index(tickers)
+        self.span       = span
+        self.frequency  = frequency
+        self.decay      = 1 - 2/(span+1) # pandas ewm(span=...)
+        self.start      = None           # first price date in the window
+        self.dates      = pd.DatetimeIndex([]) # return dates in the window
+
+        self.W   = np.zeros((n, n)) if covariance else None
+        self.A   = np.zeros((n, n)) if covariance else None
+        self.B   = np.zeros((n, n)) if covariance else None
+        self.n   = np.zeros(n)
+        self.sx  = np.zeros(n)
+        self.sxm = np.zeros(n)
+        self.smi = np.zeros(n)
+        self.sm  = 0.
+        self.sm2 = 0.
+        self.slg = 0.
+
+    def __len__(self):
+        return len(self.tickers)
+
+    @classmethod
+    def from_prices(cls, prices, start=None, **kwargs):
+        '''
+        Build from a date x ticker price panel (window from start, or the
+        whole panel).
+        '''
+        est = cls(prices.columns, **kwargs)
+        est.refresh(prices, start)
+        return est
+
+    #############################################
+    # updates
+    #############################################
+
+    def _accumulate(self, X, weights, sign=1):
+        '''
+        Add (sign=1) or remove (sign=-1) return rows X, ewma weights given.
+        '''
+        M   = ~np.isnan(X)
+        X0  = np.where(M, X, 0.)
+        Mf  = M.astype(np.float64)
+        mkt = X0.sum(1) / M.sum(1) # equal-weighted market, like returns.mean(axis=1)
+
+        if self.W is not None:
+            wX      = X0 * (sign*weights)[:, None]
+            self.W += (Mf * (sign*weights)[:, None]).T @ Mf
+            self.A += wX.T @ Mf
+            self.B += wX.T @ X0
+
+        self.n   += sign * Mf.sum(0)
+        self.sx  += sign * X0.sum(0)
+        self.sxm += sign * (X0.T @ mkt)
+        self.smi += sign * (Mf.T @ mkt)
+        self.sm  += sign * mkt.sum()
+        self.sm2 += sign * (mkt**2).sum()
+        self.slg += sign * np.log1p(mkt).sum()
+
+    def refresh(self, prices, start=None):
+        '''
+        Slide the window to [start, last date of prices]: add the return
+        days after the current window, remove the ones before start.
+        prices must cover the estimator's tickers and reach back to the
+        current window start. Returns (days added, days removed).
+        '''
+        prices = prices.reindex(columns=self.tickers)
+        prices = pd.DataFrame(prices.to_numpy(dtype=np.float64), index=prices.index, columns=self.tickers) # one block
+        start  = _day(start) if start is not None else prices.index[0]
+        if self.start is not None and prices.index[0] > self.start:
+            raise ValueError(f"prices start {prices.index[0].date()}, after the window start "
+                             f"{self.start.date()}: can't take those days out")
+
+        dates     = prices.index
+        new_first = dates[dates >= start][0]
+
+        # returns only where needed: from the last day in the window on, and
+        # the days leaving it (a return only looks one price back)
+        from_day  = max(self.dates[-1], new_first) if len(self.dates) else new_first
+        add       = _returns(prices.loc[dates >= from_day])
+        add       = add.loc[add.index > from_day]
+        drop      = self.dates[self.dates <= new_first]
+        if len(drop):
+            old  = _returns(prices.loc[(dates >= self.start) & (dates <= new_first)])
+            drop = old.loc[old.index.isin(drop)]
+
+        # new days: everything decays by decay^k, newest weighs 1
+        k = len(add)
+        if k:
+            if self.W is not None:
+                scale   = self.decay**k
+                self.W *= scale
+                self.A *= scale
+                self.B *= scale
+            self._accumulate(add.to_numpy(), self.decay**np.arange(k-1, -1, -1.))
+            self.dates = self.dates.append(add.index)
+
+        # old days: take them out at their current weight
+        if len(drop):
+            ages = len(self.dates) - 1 - np.arange(len(drop))
+            self._accumulate(drop.to_numpy(), self.decay**ages, sign=-1)
+            self.dates = self.dates[len(drop):]
+
+        self.start = new_first
+        return k, len(drop)
+
+    #############################################
+    # outputs
+    #############################################
+
+    def cov_matrix(self, fix_psd=True):
+        '''
+        exp_cov(prices over the window): annualized EWMA covariance.
+        '''
+        if self.W is None:
+            raise ValueError('built with covariance=False')
+        with np.errstate(divide='ignore', invalid='ignore'): # assets with no days in the window: NaN
+            xbar = self.sx / self.n
+            num  = (self.B - self.A*xbar[None, :] - self.A.T*xbar[:, None]
+                    + np.outer(xbar, xbar)*self.W)
+            S    = num / self.W * self.frequency
+        S = (S + S.T) / 2 # rounding only, it's symmetric by construction
+        cov_mat = pd.DataFrame(S, index=self.tickers, columns=self.tickers)
+        return fix_nonpositive_semidefinite(cov_mat) if fix_psd else cov_mat
+
+    def expected_returns(self, risk_free_rate=0.02):
+        '''
+        capm_return(prices over the window, risk_free_rate).
+        '''
+        T      = len(self.dates)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var_m  = (self.sm2 - self.sm**2/T) / (T-1)
+            cov_im = (self.sxm - self.sx*self.smi/self.n) / (self.n-1)
+            betas  = pd.Series(cov_im / var_m, index=self.tickers, name='mkt')
+        mkt    = np.expm1(self.slg * self.frequency / T)
+        return risk_free_rate + betas * (mkt - risk_free_rate)
+
+    def moments(self, risk_free_rate=0.02):
+        return self.expected_returns(risk_free_rate), self.cov_matrix()
+
+    def drift(self, prices, reference=False):
+        '''
+        Largest absolute differences between the running estimates and a
+        from-scratch estimate over the same window: a fresh build, or
+        pypfopt's exp_cov/capm_return if reference (slow: a python loop
+        over pairs).
+        '''
+        window = prices.loc[prices.index >= self.start].reindex(columns=self.tickers).astype(np.float64)
+        if reference:
+            from pypfopt import expected_returns, risk_models
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                cov_ref = risk_models.exp_cov(window, span=self.span, frequency=self.frequency)
+                ret_ref = expected_returns.capm_return(window, risk_free_rate=0.)
+        else:
+            fresh   = MomentsEstimator.from_prices(window, span=self.span, frequency=self.frequency)
+            cov_ref = fresh.cov_matrix(fix_psd=False)
+            ret_ref = fresh.expected_returns(0.)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            cov = self.cov_matrix(fix_psd=reference) # pypfopt's is PSD-fixed
+        return {'cov'    : float(np.nanmax(np.abs(cov.to_numpy() - cov_ref.to_numpy()))),
+                'returns': float(np.nanmax(np.abs(self.expected_returns(0.).to_numpy() - ret_ref.to_numpy()))),
+                'days'   : len(self.dates)}
+
+    #############################################
+    # on disk
+    #############################################
+
+    _ARRAYS = ('W', 'A', 'B', 'n', 'sx', 'sxm', 'smi')
+
+    def save(self, path='inputs/estimator.npz'):
+        meta = {'format'   : ESTIMATOR_FORMAT,
+                'span'     : self.span,
+                'frequency': self.frequency,
+                'start'    : str(self.start.date()) if self.start is not None else None,
+                'sums'     : [self.sm, self.sm2, self.slg]}
+        tmp  = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f,
+                     meta    = np.array(json.dumps(meta)),
+                     tickers = np.asarray(self.tickers, dtype=str),
+                     dates   = self.dates.to_numpy(dtype='datetime64[D]'),
+                     **{name: getattr(self, name) for name in self._ARRAYS if getattr(self, name) is not None})
+        os.replace(tmp, path) # a reader sees the old state or the new one
+        return path
+
+    @classmethod
+    def load(cls, path='inputs/estimator.npz'):
+        '''
+        FileNotFoundError if there's no state yet.
+        '''
+        with np.load(path) as f:
+            meta = json.loads(str(f['meta']))
+            if meta['format'] != ESTIMATOR_FORMAT:
+                raise ValueError(f"{path} is estimator format {meta['format']}, expected {ESTIMATOR_FORMAT}")
+            est = cls(f['tickers'], span=meta['span'], frequency=meta['frequency'],
+                      covariance='W' in f.files)
+            for name in cls._ARRAYS:
+                if name in f.files:
+                    setattr(est, name, f[name])
+            est.dates = pd.DatetimeIndex(f['dates'])
+        est.start = pd.Timestamp(meta['start']) if meta['start'] else None
+        est.sm, est.sm2, est.slg = meta['sums']
+        return est
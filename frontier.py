@@ -0,0 +1,497 @@
+'''
+Efficient frontier engine.
+
+`CriticalLine` traces the whole long-only frontier in one pass with the
+critical line algorithm (Markowitz; implementation follows Bailey & Lopez de
+Prado, "An Open-Source Implementation of the Critical-Line Algorithm"). The
+frontier is piecewise: between two turning points the weights move linearly,
+so any number of frontier points, the min vol portfolio (last turning point)
+and the tangency portfolio (closed form on each segment) all come out of the
+same set of turning points. No QP solver involved.
+
+cov can be a dense matrix or a FactorCovariance (factors.py). The algorithm
+only ever needs cov times a vector, blocks next to the free assets, and the
+inverse over the free assets; with a factor model those are O(N*K) and the
+inverse is Woodbury on a K x K matrix, so nothing N x N is ever formed.
+
+`get_ef_points` is the old pypfopt loop (one cvxpy solve per point), kept as
+the reference the engine is benchmarked against (see benchmarks.py).
+'''
+
+import warnings
+
+import numpy as np
+
+from factors import FactorCovariance
+
+class _DenseOps:
+    '''
+    What _solve needs from a dense cov. inv(cov[F, F]) over the free assets
+    F is kept up to date with rank-1 updates as assets enter/leave, and
+    refactored every so often so rounding doesn't pile up.
+    '''
+
+    def __init__(self, cov):
+        self.cov  = cov
+        self.diag = np.diag(cov)
+
+    def start(self, F):
+        self.F, self.inv, self.updates = F, np.linalg.inv(self.cov[np.ix_(F, F)]), 0
+
+    def solve(self, x):
+        return self.inv @ x
+
+    def dot(self, x, rows=None, cols=None):
+        if rows is None:
+            return self.cov[:, cols] @ x
+        return self.cov[np.ix_(rows, cols)] @ x
+
+    def entering(self, B, V):
+        '''
+        For every bounded asset b: b'A V, b'Ab and s = cov_bb - b'Ab, where
+        b = cov[F, b] and A = inv(cov[F, F]).
+        '''
+        cov_BF  = self.cov[np.ix_(B, self.F)]
+        self.bA = cov_BF @ self.inv
+        bAb     = np.einsum('ij,ij->i', self.bA, cov_BF)
+        return self.bA @ V, bAb, self.diag[B] - bAb
+
+    def add(self, i, j, s):
+        '''
+        Free asset i (row j of the last entering() call): border the inverse.
+        '''
+        bA           = self.bA[j]
+        k            = len(self.F)
+        grown        = np.empty((k+1, k+1))
+        grown[:k,:k] = self.inv + np.outer(bA, bA)/s
+        grown[:k, k] = grown[k, :k] = -bA/s
+        grown[k, k]  = 1/s
+        self.inv     = grown
+        self.F       = np.append(self.F, i)
+        self._updated()
+
+    def remove(self, j):
+        '''
+        Bound the j-th free asset: drop row/col j from the inverse.
+        '''
+        keep     = np.arange(len(self.F)) != j
+        a        = self.inv[keep, j]
+        self.inv = self.inv[np.ix_(keep, keep)] - np.outer(a, a)/self.inv[j, j]
+        self.F   = self.F[keep]
+        self._updated()
+
+    def _updated(self):
+        self.updates += 1
+        if self.updates >= 25:
+            self.start(self.F)
+
+    def quad(self, X, *Ys):
+        XS = X @ self.cov
+        return [(XS * Y).sum(axis=-1) for Y in (Ys or (X,))]
+
+class _FactorOps:
+    '''
+    The same for cov = L L' + diag(d). With M = I + L_F' D_F^-1 L_F (K x K):
+
+        inv(cov[F, F]) = D_F^-1 - D_F^-1 L_F M^-1 L_F' D_F^-1    (Woodbury)
+        cov[B, F] inv(cov[F, F]) = L_B M^-1 L_F' D_F^-1
+        b'Ab = l_b' (I - M^-1) l_b,   s = d_b + l_b' M^-1 l_b
+
+    M is rebuilt from F on every change, O(|F| K^2), so there is no rounding
+    to pile up.
+    '''
+
+    def __init__(self, cov):
+        self.cov  = cov
+        self.L    = cov.loadings
+        self.d    = cov.idio
+        self.diag = cov.diagonal()
+
+    def start(self, F):
+        self.F    = F
+        L_F       = self.L[F]
+        self.d_F  = self.d[F]
+        self.DL_F = L_F / self.d_F[:, None]
+        self.Minv = np.linalg.inv(np.eye(self.L.shape[1]) + L_F.T @ self.DL_F)
+
+    def solve(self, x):
+        d_F = self.d_F if x.ndim == 1 else self.d_F[:, None]
+        return x/d_F - self.DL_F @ (self.Minv @ (self.DL_F.T @ x))
+
+    def dot(self, x, rows=None, cols=None):
+        return self.cov.dot(x, rows, cols)
+
+    def entering(self, B, V):
+        L_B    = self.L[B]
+        LM     = L_B @ self.Minv
+        lMl    = np.einsum('ij,ij->i', LM, L_B)
+        bAb    = np.einsum('ij,ij->i', L_B, L_B) - lMl
+        return LM @ (self.DL_F.T @ V), bAb, self.d[B] + lMl
+
+    def add(self, i, j, s):
+        self.start(np.append(self.F, i))
+
+    def remove(self, j):
+        self.start(np.delete(self.F, j))
+
+    def quad(self, X, *Ys):
+        return self.cov.quad(X, *Ys)
+
+class CriticalLine:
+    '''
+    Long-only (lb <= w <= ub, sum(w) = 1) efficient frontier for mu/cov.
+
+    mu, cov can be pandas or numpy (or cov a FactorCovariance). lb, ub are
+    scalars or arrays.
+
+    After init:
+        turning_weights  = (n_turning_points, n_assets) array, from the max
+                           return portfolio down to the min vol portfolio
+        lambdas          = risk tolerance at each turning point (last is 0)
+        complete         = False if tracing stopped at the tangency
+
+    With tangency_rf (a risk free rate) tracing stops at the first turning
+    point whose Sharpe ratio is below the previous one's: Sharpe is
+    unimodal along the frontier, so the tangency portfolio is on one of the
+    segments traced and max_sharpe(tangency_rf) finds it. That's all the
+    utility calculations need, for a fraction of the turning points (about
+    a quarter on the S&P). min_volatility and efficient_frontier then only
+    cover the part traced.
+    '''
+
+    def __init__(self, mu, cov, lb=0, ub=1, tangency_rf=None):
+
+        self.tickers = getattr(mu, 'index', None)
+        self.mu      = np.asarray(mu, dtype=np.float64).ravel()
+        self.cov     = cov if isinstance(cov, FactorCovariance) else np.asarray(cov, dtype=np.float64)
+        self._ops    = _FactorOps(self.cov) if isinstance(cov, FactorCovariance) else _DenseOps(self.cov)
+        n            = self.mu.shape[0]
+        self.lb      = np.broadcast_to(np.asarray(lb, dtype=np.float64), (n,)).copy()
+        self.ub      = np.broadcast_to(np.asarray(ub, dtype=np.float64), (n,)).copy()
+
+        if self.lb.sum() > 1 or self.ub.sum() < 1:
+            raise ValueError("Bounds are infeasible: need sum(lb) <= 1 <= sum(ub)")
+
+        self._solve(tangency_rf)
+
+    @staticmethod
+    def _break_ties(mu, eps=1e-9):
+        '''
+        mu for the tracing when some means are exactly equal. Assets enter
+        one lambda at a time, and one tied with the free asset would enter at
+        lambda = inf: assets tied for the top never became free and the
+        frontier came out wrong. So within each group of equal means the
+        later ones are nudged down by eps (relative to max |mu|) per rank,
+        and everything is shifted so the top mean is 0. The shift doesn't
+        move the frontier (weights sum to 1) but keeps A mu from cancelling
+        against A 1 over nearly equal means. Outputs use the real mu.
+        '''
+        order = np.argsort(-mu, kind='stable')
+        m     = mu[order]
+        tied  = np.r_[False, m[1:] == m[:-1]]
+        if not tied.any():
+            return mu
+        idx   = np.arange(len(m))
+        rank  = idx - np.maximum.accumulate(np.where(tied, 0, idx))
+        out   = mu - m[0]
+        out[order] -= eps * (np.abs(m).max() or 1) * rank
+        return out
+
+    #############################################
+    # the algorithm
+    #############################################
+
+    def _init_weights(self):
+        '''
+        Start at the max return portfolio: everyone at lb, then fill the
+        highest mean assets up to ub until the budget is used. The asset
+        that takes the remainder is the first free asset.
+        '''
+        w     = self.lb.copy()
+        order = np.argsort(-self._mu, kind='stable')
+        for i in order:
+            room = min(self.ub[i]-self.lb[i], 1-w.sum())
+            w[i] += room
+            if w.sum() >= 1-1e-12:
+                return w, i
+        return w, order[-1]
+
+    def _solve(self, tangency_rf=None):
+
+        self._mu        = self._break_ties(self.mu)
+        mu, ops, lb, ub = self._mu, self._ops, self.lb, self.ub
+        n               = mu.shape[0]
+        diag            = ops.diag
+
+        w, first = self._init_weights()
+        free     = np.zeros(n, dtype=bool)
+        free[first] = True
+
+        # free assets (in the order they entered); ops keeps inv(cov[F, F])
+        F         = np.array([first])
+        ops.start(F)
+
+        weights, lambdas = [w.copy()], [None]
+        sharpe_prev      = -np.inf
+        self.complete    = True
+
+        while True:
+
+            B            = np.flatnonzero(~free)
+            ones_F       = np.ones(len(F))
+            u, v         = ops.solve(ones_F), ops.solve(mu[F])   # A1, A mu
+            c1, c3       = u.sum(), v.sum()                      # 1'A1, 1'A mu
+            w_B          = w[B]
+            held         = B[w_B != 0]                           # bounded assets not at 0
+            z            = ops.dot(w[held], cols=held)           # cov_{.,B} w_B
+            z_F          = z[F]
+            r            = ops.solve(z_F)                        # A cov_FB w_B
+            l1, l2       = w_B.sum(), r.sum()
+            lam_prev     = lambdas[-1]
+            # lambda has to strictly fall, else an asset that just left can
+            # re-enter at the same lambda (up to rounding) and we cycle
+            lam_cap      = np.inf if lam_prev is None else lam_prev - 1e-9*max(1, abs(lam_prev))
+
+            # case a) a free asset hits a bound
+
+            lam_in, j_in, b_in = None, None, None
+            if len(F) > 1:
+                c      = -c1*v + c3*u
+                bi     = np.where(c > 0, ub[F], lb[F])
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    lam = ((1-l1+l2)*u - c1*(bi+r)) / c
+                lam[~np.isfinite(lam) | (lam >= lam_cap)] = -np.inf
+                j = np.argmax(lam)
+                if np.isfinite(lam[j]):
+                    lam_in, j_in, b_in = lam[j], j, bi[j]
+
+            # case b) a bounded asset becomes free
+            # (every candidate at once via the block inverse of cov[F+i, F+i])
+
+            lam_out, i_out = None, None
+            if len(B):
+                bAV, bAb, s = ops.entering(B, np.column_stack([ones_F, mu[F], z_F]))
+                q1, q2 = bAV[:, 0], bAV[:, 1]                   # b'A1, b'A mu_F
+                wi     = w_B
+
+                c4_i   = (1-q1)/s
+                c2_i   = (mu[B]-q2)/s
+                c1_i   = c1 + (1-q1)**2/s
+                c3_i   = c3 + (1-q1)*(mu[B]-q2)/s
+
+                z_i    = z[B] - diag[B]*wi                      # cov_{i,B-i} w_{B-i}
+                bAz    = bAV[:, 2] - bAb*wi
+                l3_i   = (z_i - bAz)/s
+                l2_i   = (l2 - q1*wi) + (1-q1)*l3_i
+                l1_i   = l1 - wi
+
+                c      = -c1_i*c2_i + c3_i*c4_i
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    lam = ((1-l1_i+l2_i)*c4_i - c1_i*(wi+l3_i)) / c
+                ok = np.isfinite(lam) & (lam < lam_cap)
+                if ok.any():
+                    lam[~ok] = -np.inf
+                    j = np.argmax(lam)
+                    lam_out, i_out, j_out, s_out = lam[j], B[j], j, s[j]
+                    # others at the same lambda (up to rounding) enter with it
+                    also = B[(lam >= lam_out - 1e-12*max(1, abs(lam_out))) & (B != i_out)]
+
+            if (lam_in is None or lam_in < 0) and (lam_out is None or lam_out < 0):
+                lam = 0.0 # min variance solution, we're done
+            elif lam_out is None or (lam_in is not None and lam_in > lam_out):
+                lam          = lam_in
+                i_in         = F[j_in]
+                free[i_in]   = False
+                w[i_in]      = b_in
+                ops.remove(j_in)
+                F            = ops.F
+            else:
+                lam          = lam_out
+                free[i_out]  = True
+                ops.add(i_out, j_out, s_out)
+                for i in also:
+                    _, _, s_i = ops.entering(np.array([i]), np.empty((len(ops.F), 0)))
+                    if s_i[0] <= 1e-12*diag[i]: # collinear with the free ones
+                        continue
+                    free[i]   = True
+                    ops.add(i, 0, s_i[0])
+                F            = ops.F
+
+            # weights of the free assets at this lambda
+
+            B         = np.flatnonzero(~free)
+            ones_F    = np.ones(len(F))
+            u, v      = ops.solve(ones_F), ops.solve(mu[F])
+            g1, g2    = v.sum(), u.sum()
+            w1        = ops.solve(ops.dot(w[B], rows=F, cols=B))
+            gamma     = -lam*g1/g2 + (1-w[B].sum()+w1.sum())/g2
+            w[F]      = -w1 + gamma*u + lam*v
+
+            weights.append(w.copy())
+            lambdas.append(lam)
+
+            if lam == 0:
+                break
+
+            if tangency_rf is not None:
+                sharpe = (w @ self.mu - tangency_rf) / np.sqrt(ops.quad(w)[0])
+                if sharpe < sharpe_prev:
+                    self.complete = False
+                    break
+                sharpe_prev = sharpe
+
+        self.turning_weights = np.array(weights)
+        self.lambdas         = np.array([np.inf] + lambdas[1:])
+
+    #############################################
+    # outputs
+    #############################################
+
+    def portfolio_performance(self, weights, risk_free_rate=0.02):
+        '''
+        ret, vol, sharpe for a weight vector (or a stack of them, one per row).
+        '''
+        weights = np.asarray(weights)
+        ret     = weights @ self.mu
+        vol     = np.sqrt(self._ops.quad(weights)[0])
+        return ret, vol, (ret-risk_free_rate)/vol
+
+    def min_volatility(self):
+        return self.turning_weights[-1]
+
+    def max_sharpe(self, risk_free_rate=0.02):
+        '''
+        Tangency portfolio. On the segment between turning points a and b,
+        w = a + t(b-a) and sharpe(t) = (p+qt)/sqrt(c+2dt+et^2), which peaks at
+        t = (pd-qc)/(qd-pe); check that (clipped to [0,1]) on every segment.
+        '''
+        A, Bw = self.turning_weights[:-1], self.turning_weights[1:]
+        D     = Bw - A
+        p     = A @ self.mu - risk_free_rate
+        q     = D @ self.mu
+        c, d  = self._ops.quad(A, A, D)
+        e,    = self._ops.quad(D)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (p*d - q*c)/(q*d - p*e)
+        t = np.clip(np.nan_to_num(t, nan=0.0), 0, 1)
+
+        cands  = np.vstack([A + t[:, None]*D, self.turning_weights[-1:]])
+        sharpe = self.portfolio_performance(cands, risk_free_rate)[2]
+        return cands[np.nanargmax(sharpe)]
+
+    def efficient_frontier(self, points=200):
+        '''
+        `points` portfolios along the frontier (max return -> min vol), spaced
+        about evenly in volatility.
+
+        Returns rets, vols, weights (points x n_assets)
+        '''
+        tw      = self.turning_weights
+        vols_tp = self.portfolio_performance(tw)[1]
+
+        if len(tw) == 1:
+            weights = np.repeat(tw, points, axis=0)
+            return self.portfolio_performance(weights)[:2] + (weights,)
+
+        # walk the cumulative vol covered by the segments, each point lands on
+        # a segment and a spot t in [0,1] along it
+        span    = np.abs(np.diff(vols_tp)) + 1e-12
+        cum     = np.r_[0, np.cumsum(span)]
+        s       = np.linspace(0, cum[-1], points)
+        seg     = np.clip(np.searchsorted(cum, s, side='right')-1, 0, len(span)-1)
+        t       = np.clip((s-cum[seg])/span[seg], 0, 1)
+        weights = tw[seg] + t[:, None]*(tw[seg+1]-tw[seg])
+
+        rets, vols, _ = self.portfolio_performance(weights)
+        return rets, vols, weights
+
+#############################################
+# utility on the CML
+#############################################
+
+def cml_utility(rf_rate, tangency_ret, tangency_vol, risk_aversion):
+    '''
+    Max utility mix of the risk free asset and a tangency portfolio, for any
+    number of tangency portfolios and risk aversions at once.
+
+    U(y) = rf + y*(ret_t - rf) - .5*A*y^2*vol_t^2 is a parabola in y (the
+    weight in the tangency portfolio), so the best y in [0,1] (no leverage,
+    no shorting) is clip((ret_t - rf) / (A*vol_t^2), 0, 1).
+
+    Inputs broadcast against each other (numpy rules), e.g. tangency_ret /
+    tangency_vol of shape (themes, 1) and risk_aversion of shape (A,) give a
+    (themes, A) grid.
+
+    Returns arrays of that shape:
+        weights    = y, weight in the tangency portfolio
+        rets, vols = the max utility portfolio
+        utilities  = rets - .5*A*vols^2
+    '''
+    rf_rate = np.asarray(rf_rate, dtype=np.float64)
+    ret_t   = np.asarray(tangency_ret, dtype=np.float64)
+    vol_t   = np.asarray(tangency_vol, dtype=np.float64)
+    A       = np.asarray(risk_aversion, dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = np.clip((ret_t - rf_rate) / (A * vol_t**2), 0, 1)
+    weights = np.where(np.isnan(weights), 0., weights) # 0/0: nothing to gain from the risky part
+
+    rets      = rf_rate + weights*(ret_t - rf_rate)
+    vols      = weights*vol_t
+    utilities = rets - .5*A*vols**2
+    return weights, rets, vols, utilities
+
+def max_utility_portfolio(rf_rate, tangency_port, risk_aversion):
+    '''
+    Best mix of the risk free asset and the tangency portfolio for
+    risk_aversion, with the tangency weight kept in [0,1] (no leverage, no
+    shorting). Scalar version of cml_utility.
+
+    Returns max_util_port = [ret, vol] and its utility ret - .5*A*vol^2
+    (rounded to 4dp, as shown in the app).
+    '''
+    _, ret, vol, utility = cml_utility(rf_rate, tangency_port[0], tangency_port[1], risk_aversion)
+    return [float(ret), float(vol)], round(float(utility), 4)
+
+#############################################
+# reference: one cvxpy solve per point
+#############################################
+
+def get_ef_points(ef, ef_param, ef_param_range):
+    """
+    Helper function to get the points on the efficient frontier from an EfficientFrontier object
+
+    This is _plot_ef without the plotting, and returning the points.
+    """
+    from pypfopt import exceptions
+
+    mus, sigmas = [], []
+
+    # Create a portfolio for each value of ef_param_range
+    for param_value in ef_param_range:
+        try:
+            if ef_param == "utility":
+                ef.max_quadratic_utility(param_value)
+            elif ef_param == "risk":
+                ef.efficient_risk(param_value)
+            elif ef_param == "return":
+                ef.efficient_return(param_value)
+            else:
+                raise NotImplementedError(
+                    "ef_param should be one of {'utility', 'risk', 'return'}"
+                )
+        except exceptions.OptimizationError:
+            continue
+        except ValueError:
+            warnings.warn(
+                "Could not construct portfolio for parameter value {:.3f}".format(
+                    param_value
+                )
+            )
+
+        ret, sigma, _ = ef.portfolio_performance()
+        mus.append(ret)
+        sigmas.append(sigma)
+
+    return mus, sigmas
@@ -0,0 +1,238 @@
+'''
+Stage-level timing/memory records for the dashboard pipeline.
+
+Off unless turned on, and then `stage()` is a flag check. Turn it on with
+the environment (or `configure`):
+
+    DASHBOARD_PROFILE=1          wall time per stage (+ cache hit/miss, counts)
+    DASHBOARD_PROFILE=memory     ... plus allocations and peak memory
+                                 (tracemalloc, so everything runs slower)
+    DASHBOARD_PROFILE_LOG=path   JSON-lines log (default logs/stages.jsonl)
+    DASHBOARD_METRICS_PORT=9100  serve running totals at :9100/metrics
+
+Usage:
+
+    with stage('exp_cov', assets=len(tickers)) as rec:
+        ...
+        rec['iterations'] = n    # anything else worth keeping
+
+A cached function calls cache_miss() first thing; the stage wrapped around
+its call site then says 'miss' instead of 'hit'.
+
+Each record is one line:
+    {"ts": ..., "session": ..., "stage": ..., "seconds": ..., "cache": ...,
+     "alloc_bytes": ..., "peak_bytes": ..., <extra fields>}
+'''
+
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import defaultdict, deque
+
+ENABLED = False
+MEMORY  = False
+LOG_PATH = 'logs/stages.jsonl'
+
+_session = contextvars.ContextVar('session', default=None)
+_open    = contextvars.ContextVar('open_stages', default=())
+_lock    = threading.Lock()
+_recent  = deque(maxlen=2000)
+_totals  = defaultdict(lambda: {'count': 0, 'seconds': 0., 'max_seconds': 0., 'hit': 0, 'miss': 0})
+_collectors = {}
+_server  = None
+
+def configure(enabled=None, memory=None, log_path=None):
+    '''
+    Turn recording on/off. Unset arguments come from the environment.
+    '''
+    global ENABLED, MEMORY, LOG_PATH
+    mode     = os.environ.get('DASHBOARD_PROFILE', '').lower()
+    ENABLED  = bool(mode and mode != '0') if enabled is None else enabled
+    MEMORY   = (mode == 'memory') if memory is None else memory
+    ENABLED  = ENABLED or MEMORY
+    LOG_PATH = log_path or os.environ.get('DASHBOARD_PROFILE_LOG', LOG_PATH)
+    if MEMORY and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def set_session(session_id):
+    _session.set(session_id)
+
+class _Stage:
+
+    __slots__ = ('rec', 't0', 'mem0', 'peak', 'token')
+
+    def __init__(self, name, cached, fields):
+        self.rec = {'stage': name, **fields}
+        if cached:
+            self.rec['cache'] = 'hit'
+
+    def __enter__(self):
+        stack = _open.get()
+        if MEMORY:
+            # peaks nest: fold what's been seen so far into the parent first
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self.mem0 = tracemalloc.get_traced_memory()[0]
+            self.peak = 0
+        self.token = _open.set(stack + (self,))
+        self.t0    = time.perf_counter()
+        return self.rec
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.t0
+        _open.reset(self.token)
+        rec = self.rec
+        rec['seconds'] = seconds
+        if MEMORY:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(self.peak, peak)
+            rec['alloc_bytes'] = current - self.mem0
+            rec['peak_bytes']  = peak - self.mem0
+            stack = _open.get()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+        if exc[0] is not None:
+            rec['error'] = exc[0].__name__
+        _record(rec)
+        return False
+
+class _Off:
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc):
+        return False
+
+_OFF = _Off()
+
+def stage(name, cached=False, **fields):
+    '''
+    Context manager timing one stage. cached=True for call sites of cached
+    functions (records cache hit/miss). Yields the record (a dict).
+    '''
+    if not ENABLED:
+        return _OFF
+    return _Stage(name, cached, fields)
+
+def timed(name, **fields):
+    '''
+    Decorator: the whole function is one stage.
+    '''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return f(*args, **kwargs)
+            with _Stage(name, False, fields):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def cache_miss():
+    '''
+    Call at the top of a cached function: marks the enclosing call site's
+    stage as a cache miss.
+    '''
+    if ENABLED:
+        for s in reversed(_open.get()):
+            if 'cache' in s.rec:
+                s.rec['cache'] = 'miss'
+                return
+
+def _record(rec):
+    rec['ts']      = time.time()
+    rec['session'] = _session.get()
+    line = json.dumps(rec, default=str)
+    with _lock:
+        _recent.append(rec)
+        tot = _totals[rec['stage']]
+        tot['count']      += 1
+        tot['seconds']    += rec['seconds']
+        tot['max_seconds'] = max(tot['max_seconds'], rec['seconds'])
+        if 'cache' in rec:
+            tot[rec['cache']] += 1
+        if LOG_PATH:
+            os.makedirs(os.path.dirname(LOG_PATH) or '.', exist_ok=True)
+            with open(LOG_PATH, 'a') as f:
+                f.write(line + '\n')
+
+def recent(session=None):
+    '''
+    Latest records (this process), optionally for one session only.
+    '''
+    with _lock:
+        return [r for r in _recent if session is None or r['session'] == session]
+
+def totals():
+    with _lock:
+        return {name: dict(tot) for name, tot in _totals.items()}
+
+#############################################
+# metrics endpoint
+#############################################
+
+def add_collector(name, collect):
+    '''
+    Report collect() (a dict of numbers, e.g. a cache's stats) with the
+    metrics, as dashboard_<name>_<key>. Collected even when stage timings
+    are off.
+    '''
+    _collectors[name] = collect
+
+def metrics_text():
+    '''
+    Running totals per stage plus the collectors, prometheus text format.
+    '''
+    lines = []
+    for name, tot in sorted(totals().items()):
+        label = f'{{stage="{name}"}}'
+        lines += [f'dashboard_stage_count{label} {tot["count"]}',
+                  f'dashboard_stage_seconds_sum{label} {tot["seconds"]:.6f}',
+                  f'dashboard_stage_seconds_max{label} {tot["max_seconds"]:.6f}',
+                  f'dashboard_stage_cache_hits{label} {tot["hit"]}',
+                  f'dashboard_stage_cache_misses{label} {tot["miss"]}']
+    for name, collect in sorted(_collectors.items()):
+        lines += [f'dashboard_{name}_{key} {value}' for key, value in collect().items()]
+    return '\n'.join(lines) + '\n'
+
+def serve_metrics(port=None):
+    '''
+    Serve metrics_text at http://localhost:<port>/metrics on a daemon thread
+    (once per process). port defaults to DASHBOARD_METRICS_PORT; no-op if
+    neither is set.
+    '''
+    global _server
+    port = port or os.environ.get('DASHBOARD_METRICS_PORT')
+    if _server is not None or not port:
+        return _server
+
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args): # keep the dashboard's stderr quiet
+            pass
+
+    _server = ThreadingHTTPServer(('127.0.0.1', int(port)), Handler)
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    return _server
+
+configure()
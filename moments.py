@@ -0,0 +1,326 @@
+'''
+Full-universe moments, keyed by ticker.
+
+get_data estimates expected returns (CAPM) and the covariance matrix (EWMA)
+for the whole S&P list once. Any theme is a subset of those tickers, so
+instead of re-downloading and re-estimating for each theme we slice the
+full-universe arrays by position: no I/O, no estimation, a few microseconds.
+
+Slicing is not always identical to re-estimating on the subset, and the store
+says so (see `caveats`):
+
+    - capm_return uses the equal-weighted average of the assets it is given
+      as the market proxy. Sliced returns keep the full-universe proxy
+      (arguably the better market proxy anyway); re-estimating on the subset
+      would use the subset's own average, so betas and E(r) differ.
+    - exp_cov is pairwise, so sliced entries match re-estimation, unless the
+      full matrix had to be fixed to be positive semidefinite.
+    - tickers get_data dropped (insufficient history) or never saw are left
+      out of the slice.
+
+The covariance can also be (or only be) a K-factor model (factors.py,
+`update_data_cache.py --factors K`): N*(K+1) numbers instead of N^2, for
+universes where the dense matrix is too big. subset() then hands out a
+FactorCovariance, which CriticalLine solves in O(N*K).
+
+On disk (save_moments / load_moments) the store is one versioned artifact:
+
+    inputs/moments/CURRENT               name of the live version
+    inputs/moments/<version>/
+        e_returns.npy   float64 (N,)
+        cov_mat.npy     float64 (N, N)     (unless factor-only)
+        loadings.npy    float64 (N, K)     (factor model, optional)
+        idio.npy        float64 (N,)       (factor model, optional)
+        tickers.npy     unicode (N,)
+        meta.json       format, as_of, rf_rate, estimator, psd_fixed, n_assets,
+                        factors (K or null)
+        precomputed.json    (optional) per-theme frontiers/utilities from
+                            `python update_data_cache.py --precompute`
+
+The arrays are memory-mapped when loaded, so opening the artifact costs the
+same for 400 names or 5000, and a subset only reads the rows it needs. A new
+version is written to its own folder and CURRENT is swapped atomically, so a
+reader never sees half an artifact (refresh.py builds new versions in the
+background this way while the app keeps serving the live one).
+'''
+
+import json
+import os
+import shutil
+import warnings
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from factors import FactorCovariance
+
+MOMENTS_FORMAT = 1
+PRECOMPUTED_FORMAT = 1 # bump when precomputed results change meaning
+
+class MomentsStore:
+    '''
+    e_returns / cov_mat / rf_rate for a universe, plus ticker -> position.
+
+    subset(tickers) returns (e_returns, cov_mat, rf_rate) for just those
+    tickers, in the order given, built from the full arrays by position.
+
+    e_returns/cov_mat are a Series/DataFrame (aligned on the Series index),
+    or plain arrays when tickers is given (used as-is, so memory-mapped
+    arrays stay memory-mapped). factors is an optional FactorCovariance for
+    the same tickers; cov_mat can be None (or the FactorCovariance itself)
+    if that's all there is.
+    '''
+
+    def __init__(self, e_returns, cov_mat, rf_rate, estimator='capm_return + exp_cov',
+                 psd_fixed=False, tickers=None, as_of=None, folder=None, factors=None):
+
+        if isinstance(cov_mat, FactorCovariance):
+            cov_mat, factors = None, cov_mat
+
+        if tickers is None:
+            tickers = e_returns.index
+            if cov_mat is not None:
+                cov_mat = cov_mat.loc[tickers, tickers]
+            if factors is not None and factors.tickers is not None:
+                factors = factors.subset(factors.tickers.get_indexer(tickers))
+
+        self.tickers   = pd.Index(tickers)
+        self.e_returns = np.asarray(e_returns, dtype=np.float64)
+        self.cov_mat   = np.asarray(cov_mat, dtype=np.float64) if cov_mat is not None else None
+        self.factors   = FactorCovariance(factors.loadings, factors.idio, self.tickers) if factors is not None else None
+        self.rf_rate   = rf_rate
+        self.estimator = estimator
+        self.psd_fixed = psd_fixed
+        self.as_of     = as_of
+        self.folder    = folder # artifact folder, if loaded from disk
+        self._pos      = None
+
+    def __len__(self):
+        return len(self.tickers)
+
+    @property
+    def version(self):
+        '''
+        Artifact version (folder name), or a per-object name if it was
+        built in memory.
+        '''
+        return os.path.basename(self.folder) if self.folder else f'memory-{id(self):x}'
+
+    def positions(self, tickers):
+        '''
+        Positions of tickers in the universe (unknown tickers and repeats
+        skipped).
+        '''
+        if self._pos is None:
+            self._pos = {t: i for i, t in enumerate(self.tickers)}
+        return np.array([self._pos[t] for t in dict.fromkeys(tickers) if t in self._pos], dtype=np.intp)
+
+    def subset(self, tickers=None, positions=None, factor=None):
+        '''
+        (e_returns, cov_mat, rf_rate) for the tickers (or positions) given.
+        Everything, if neither is.
+
+        cov_mat is a DataFrame, or a FactorCovariance with factor=True (the
+        default when there's no dense matrix).
+        '''
+        if positions is None:
+            positions = np.arange(len(self)) if tickers is None else self.positions(tickers)
+        idx = self.tickers[positions]
+
+        e_returns = pd.Series(self.e_returns[positions], index=idx, name='Expected Returns')
+        factor    = self.cov_mat is None if factor is None else factor
+        if factor:
+            if self.factors is None:
+                raise ValueError('no factor covariance in this store')
+            return e_returns, self.factors.subset(positions), self.rf_rate
+        cov_mat   = pd.DataFrame(self.cov_mat[np.ix_(positions, positions)], index=idx, columns=idx)
+        return e_returns, cov_mat, self.rf_rate
+
+    def variances(self, positions=None):
+        '''
+        Diagonal of the covariance (dense if there is one) at positions.
+        '''
+        if positions is None:
+            positions = np.arange(len(self))
+        if self.cov_mat is None:
+            return self.factors.subset(positions).diagonal()
+        return self.cov_mat[positions, positions]
+
+    def caveats(self, tickers):
+        '''
+        Ways the slice for tickers differs from estimating on them directly.
+        Empty list = slicing is equivalent.
+        '''
+        tickers = list(dict.fromkeys(tickers))
+        known   = set(self.tickers[self.positions(tickers)])
+        missing = [t for t in tickers if t not in known]
+        kept    = len(tickers) - len(missing)
+        notes   = []
+
+        if missing:
+            notes.append(f"{len(missing)} ticker(s) not in the estimated universe were left out: "
+                         + ', '.join(missing[:10]) + (' ...' if len(missing) > 10 else ''))
+        if 'capm' in self.estimator and 0 < kept < len(self):
+            notes.append(f"Expected returns use the full {len(self)}-stock universe as the CAPM market "
+                         f"proxy, not the {kept} stocks in this subset.")
+        if self.psd_fixed and 0 < kept < len(self):
+            notes.append("The full covariance matrix was adjusted to be positive semidefinite, "
+                         "so the sliced block differs slightly from re-estimating it.")
+        if self.cov_mat is None and self.factors is not None:
+            notes.append(f"Covariances come from a {self.factors.k}-factor model (explaining "
+                         f"{self.factors.explained():.0%} of the variance), not the full matrix.")
+        return notes
+
+def load_moments_store(asset_list=None, factors=None, dense=True, **get_data_kwargs):
+    '''
+    Estimate the full universe once (get_data) and wrap it in a MomentsStore.
+    With factors=K also fit a K-factor covariance (dense=False: only that,
+    for universes too big for the dense one).
+    '''
+    from update_data_cache import get_data
+
+    cov_mat, psd_fixed, factor_cov = None, False, None
+    if dense:
+        # exp_cov only warns when it has to amend the eigenvalues
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            e_returns, cov_mat, rf_rate = get_data(asset_list, **get_data_kwargs)
+        psd_fixed = any('positive semidefinite' in str(w.message) for w in caught)
+    if factors:
+        get_data_kwargs.pop('estimator_path', None)
+        factor_returns, factor_cov, rf_rate = get_data(asset_list, factors=factors, **get_data_kwargs)
+        if not dense:
+            e_returns = factor_returns
+
+    estimator = 'capm_return + exp_cov' if dense else f'capm_return + {factors}-factor exp_cov'
+    return MomentsStore(e_returns, cov_mat, rf_rate, estimator=estimator, psd_fixed=psd_fixed,
+                        factors=factor_cov)
+
+#############################################
+# on-disk artifact
+#############################################
+
+def _write_npy(path, arr):
+    with open(path, 'wb') as f:
+        np.save(f, arr)
+
+def save_moments(store, root='inputs/moments', as_of=None, keep=3, publish=True):
+    '''
+    Write store as a new version under root and make it the live one; only
+    the newest `keep` versions are kept. Returns the version folder.
+
+    publish=False only writes the folder, so more can be added to it (e.g.
+    precomputed results) before publish_moments makes it live.
+    '''
+    as_of   = as_of or store.as_of or datetime.now().strftime('%Y-%m-%d')
+    version = f"{as_of}_{datetime.now().strftime('%H%M%S%f')}"
+    folder  = os.path.join(root, version)
+    tmp     = folder + '.tmp'
+    os.makedirs(tmp)
+
+    _write_npy(os.path.join(tmp, 'e_returns.npy'), np.ascontiguousarray(store.e_returns, dtype=np.float64))
+    if store.cov_mat is not None:
+        _write_npy(os.path.join(tmp, 'cov_mat.npy'), np.ascontiguousarray(store.cov_mat, dtype=np.float64))
+    if store.factors is not None:
+        _write_npy(os.path.join(tmp, 'loadings.npy'), np.ascontiguousarray(store.factors.loadings))
+        _write_npy(os.path.join(tmp, 'idio.npy'),     np.ascontiguousarray(store.factors.idio))
+    _write_npy(os.path.join(tmp, 'tickers.npy'),   np.asarray(store.tickers, dtype=str))
+
+    meta = {'format'   : MOMENTS_FORMAT,
+            'as_of'    : as_of,
+            'rf_rate'  : float(store.rf_rate),
+            'estimator': store.estimator,
+            'psd_fixed': bool(store.psd_fixed),
+            'n_assets' : len(store),
+            'factors'  : store.factors.k if store.factors is not None else None}
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    os.replace(tmp, folder)
+
+    if publish:
+        publish_moments(folder, keep)
+    return folder
+
+def publish_moments(folder, keep=3):
+    '''
+    Make the version in folder the live one and drop all but the newest
+    `keep` versions (never the live one). Readers that already loaded an
+    older version keep their memory maps.
+    '''
+    root, version = os.path.split(os.path.normpath(folder))
+
+    # point CURRENT at it (write + rename is atomic)
+    with open(os.path.join(root, 'CURRENT.tmp'), 'w') as f:
+        f.write(version)
+    os.replace(os.path.join(root, 'CURRENT.tmp'), os.path.join(root, 'CURRENT'))
+
+    versions = sorted(d for d in os.listdir(root)
+                      if os.path.isdir(os.path.join(root, d)) and not d.endswith('.tmp'))
+    for old in versions[:-keep]:
+        if old != version:
+            shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+
+def current_version(root='inputs/moments'):
+    '''
+    Name of the live version (None if there's no artifact yet). One small
+    file read, cheap enough to check on every rerun.
+    '''
+    try:
+        with open(os.path.join(root, 'CURRENT')) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def load_moments(root='inputs/moments', version=None):
+    '''
+    Memory-map the live version (or a given one) into a MomentsStore.
+    FileNotFoundError if there is no artifact yet.
+    '''
+    version = version or current_version(root)
+    if version is None:
+        raise FileNotFoundError(os.path.join(root, 'CURRENT'))
+    folder  = os.path.join(root, version)
+
+    with open(os.path.join(folder, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['format'] != MOMENTS_FORMAT:
+        raise ValueError(f"{folder} is moments format {meta['format']}, expected {MOMENTS_FORMAT}")
+
+    load    = lambda name: np.load(os.path.join(folder, name), mmap_mode='r')
+    cov_mat = load('cov_mat.npy') if os.path.exists(os.path.join(folder, 'cov_mat.npy')) else None
+    factors = FactorCovariance(load('loadings.npy'), load('idio.npy')) if meta.get('factors') else None
+
+    return MomentsStore(load('e_returns.npy'),
+                        cov_mat,
+                        meta['rf_rate'],
+                        estimator = meta['estimator'],
+                        psd_fixed = meta['psd_fixed'],
+                        tickers   = load('tickers.npy'),
+                        as_of     = meta['as_of'],
+                        folder    = folder,
+                        factors   = factors)
+
+def save_precomputed(folder, results):
+    '''
+    Write precomputed theme results next to the moments they came from.
+    '''
+    tmp = os.path.join(folder, 'precomputed.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(dict(results, format=PRECOMPUTED_FORMAT), f)
+    os.replace(tmp, os.path.join(folder, 'precomputed.json'))
+
+def load_precomputed(store):
+    '''
+    Precomputed theme results for store's artifact ({} if there are none, or
+    they were written by an older version).
+    '''
+    if store.folder is None:
+        return {}
+    try:
+        with open(os.path.join(store.folder, 'precomputed.json')) as f:
+            results = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return results if results.get('format') == PRECOMPUTED_FORMAT else {}
@@ -0,0 +1,430 @@
+'''
+Local on-disk price store + the providers that fill it.
+
+The store keeps adjusted close prices as a dense date x ticker array on disk
+(column-major, so each ticker's history is one contiguous column) plus a small
+json file recording which date range has already been requested for each
+ticker. Asking the store for prices only hits the provider for the
+ticker/date gaps it hasn't seen before, so a monthly refresh pulls a few weeks
+of data instead of a decade, and restarting the app doesn't touch the network.
+
+Adjusted close isn't fixed: after a split or dividend Yahoo rescales a
+ticker's whole history. So every fetch next to stored data reaches back
+OVERLAP into it, and a ticker whose overlapping prices moved has its stored
+history rescaled by the same ratio before the new prices are joined on
+(otherwise the seam shows up as a huge one-day return).
+
+Providers are pluggable: anything with `get_prices` and `get_risk_free_rate`
+works, so `LocalProvider` can stand in for Yahoo/FRED (tests, offline dev).
+'''
+
+import json
+import os
+import time
+import tracemalloc
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+STORE_VERSION = 2 # 2: prices kept as float32
+EMPTY_RETRY   = pd.Timedelta(days=1) # a range that came back empty for a ticker is asked again after this
+OVERLAP       = pd.Timedelta(days=7) # refetched next to stored prices, to catch rescaled history
+RESCALE_TOL   = 1e-4                 # relative change of an overlapping price that counts as a rescale
+
+# yfinance errors that mean "no data for this ticker" rather than a failed request
+_NO_DATA_ERRORS = ('delisted', 'no price data', 'no data found', 'no timezone found')
+
+#############################################
+# providers
+#############################################
+
+class PriceProvider:
+    '''
+    Interface for anything that can supply prices and the risk free rate.
+
+    get_prices(tickers, start, end) returns a date x ticker frame of adjusted
+    close prices for start <= date < end. Tickers it has no data for can
+    simply be left out of the frame.
+    '''
+
+    def get_prices(self, tickers, start, end):
+        raise NotImplementedError
+
+    def get_risk_free_rate(self, start, end):
+        raise NotImplementedError
+
+
+class YahooProvider(PriceProvider):
+    '''
+    Prices from yfinance, risk free rate (10y treasury) from FRED.
+
+    One Ticker.history call per ticker rather than yf.download: download
+    keeps its frames and errors in module globals (yf.shared) that the
+    chunks fetch_prices runs concurrently would reset for each other,
+    while history with raise_errors keeps everything to the call. Tickers
+    Yahoo has no data for are left out; any other error (rate limit,
+    timeout) raises, so fetch_prices retries the chunk.
+    '''
+
+    def get_prices(self, tickers, start, end):
+
+        import yfinance as yf
+
+        columns = {}
+        for t in tickers:
+            try:
+                history = yf.Ticker(t).history(start=start, end=end, auto_adjust=False, raise_errors=True)
+            except Exception as e:
+                if any(s in str(e).lower() for s in _NO_DATA_ERRORS):
+                    continue
+                raise
+            if len(history):
+                columns[t] = history['Adj Close']
+        if not columns:
+            return pd.DataFrame(index=pd.DatetimeIndex([]))
+        return pd.DataFrame(columns)
+
+    def get_risk_free_rate(self, start, end):
+
+        import pandas_datareader as pdr
+
+        risk_free_rate = pdr.DataReader("IRLTLT01USM156N", "fred", start, end)
+        risk_free_rate = risk_free_rate.iloc[-1]/100
+        return risk_free_rate.item()
+
+
+class LocalProvider(PriceProvider):
+    '''
+    Serves prices from a frame (or a csv with dates in the first column) that
+    is already in memory/on disk. Stand-in for Yahoo/FRED in tests and
+    offline runs.
+
+    latency (seconds) and fail_rate (chance each call raises) let you mimic a
+    slow/flaky network when testing fetch_prices. calls counts how many times
+    get_prices was hit, handy for checking that the store isn't refetching.
+    '''
+
+    def __init__(self, prices, risk_free_rate=0.04, latency=0, fail_rate=0, seed=0):
+        if isinstance(prices, (str, os.PathLike)):
+            prices = pd.read_csv(prices, index_col=0, parse_dates=True)
+        self.prices         = prices.sort_index()
+        self.risk_free_rate = risk_free_rate
+        self.latency        = latency
+        self.fail_rate      = fail_rate
+        self.rng            = np.random.default_rng(seed)
+        self.calls          = 0
+
+    def get_prices(self, tickers, start, end):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail_rate and self.rng.random() < self.fail_rate:
+            raise ConnectionError('LocalProvider: injected failure')
+        cols   = [t for t in tickers if t in self.prices.columns]
+        in_rng = (self.prices.index >= start) & (self.prices.index < end)
+        return self.prices.loc[in_rng, cols]
+
+    def get_risk_free_rate(self, start, end):
+        return self.risk_free_rate
+
+#############################################
+# chunked ingestion
+#############################################
+
+def _fetch_chunk(provider, tickers, start, end, retries, backoff, trace=False):
+    '''
+    One chunk, retried with exponential backoff. Returns (prices, stats);
+    prices is None if every attempt failed.
+    '''
+    t0 = time.perf_counter()
+    if trace:
+        mem0 = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    for attempt in range(1, retries+1):
+        try:
+            prices = provider.get_prices(tickers, start, end)
+            # keep only what we need, as float32, before the next chunk lands
+            prices = prices.astype(np.float32)
+            error  = None
+            break
+        except Exception as e:
+            prices, error = None, repr(e)
+            if attempt < retries:
+                time.sleep(backoff * 2**(attempt-1))
+
+    stats = {'tickers' : len(tickers),
+             'attempts': attempt,
+             'seconds' : time.perf_counter()-t0,
+             'bytes'   : 0 if prices is None else int(prices.memory_usage(index=False).sum()),
+             'error'   : error}
+    if trace:
+        stats['peak_bytes'] = tracemalloc.get_traced_memory()[1] - mem0
+    return prices, stats
+
+def fetch_prices(provider, tickers, start, end, chunk_size=50, max_workers=4,
+                 retries=3, backoff=1.0, trace_memory=False):
+    '''
+    Pull prices for tickers over [start, end) in chunks of chunk_size on a
+    pool of max_workers threads. Each chunk gets up to `retries` attempts
+    (backoff, 2*backoff, ... apart) so one throttled request doesn't sink
+    the whole universe.
+
+    Returns
+    -------
+
+        prices   = date x ticker float32 frame (assembled once, at the end)
+        failed   = tickers whose chunk failed every retry
+        stats    = one dict per chunk: tickers, attempts, seconds, bytes kept
+                   and error; plus peak_bytes (the chunk's traced peak above
+                   what was allocated when it started) when trace_memory=True
+
+    tracemalloc only has one, process-wide peak, so with trace_memory the
+    chunks run one at a time: it's for profiling a fetch, not for
+    everyday refreshes.
+    '''
+    if retries < 1:
+        raise ValueError(f'retries is the number of attempts per chunk, needs to be >= 1 (got {retries})')
+
+    tickers = list(tickers)
+    chunks  = [tickers[i:i+chunk_size] for i in range(0, len(tickers), chunk_size)]
+
+    started_trace = trace_memory and not tracemalloc.is_tracing()
+    if trace_memory:
+        max_workers = 1
+    if started_trace:
+        tracemalloc.start()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(lambda c: _fetch_chunk(provider, c, start, end, retries, backoff, trace_memory),
+                                    chunks))
+    finally:
+        if started_trace:
+            tracemalloc.stop()
+
+    frames, failed, stats = [], [], []
+    for chunk, (prices, chunk_stats) in zip(chunks, results):
+        stats.append(chunk_stats)
+        if prices is None:
+            failed.extend(chunk)
+            warnings.warn(f"Could not fetch {len(chunk)} tickers ({chunk[0]}..): {chunk_stats['error']}")
+        elif len(prices.columns):
+            frames.append(prices)
+
+    if frames:
+        prices = pd.concat(frames, axis=1)
+        prices = prices.loc[:, ~prices.columns.duplicated()]
+    else:
+        prices = pd.DataFrame(index=pd.DatetimeIndex([]), dtype=np.float32)
+
+    return prices, failed, stats
+
+#############################################
+# the store
+#############################################
+
+def _day(d):
+    return pd.Timestamp(d).normalize()
+
+def _subtract(gap, interval):
+    '''
+    The parts of [gap) outside [interval).
+    '''
+    (a, b), (c, d) = gap, interval
+    return [g for g in [(a, min(b, c)), (max(a, d), b)] if g[0] < g[1]]
+
+class PriceStore:
+    '''
+    Date x ticker store of adjusted close prices in `root`:
+
+        prices.npy  float32 array, shape (n_dates, n_tickers), fortran order
+        dates.npy   datetime64[D] row index
+        meta.json   tickers (column index), fetched coverage per ticker,
+                    tickers that came back empty (with when to ask again)
+                    and the last risk free rate pulled
+
+    Files are written to a temp name and moved into place, meta.json last, so
+    a crash mid-write leaves the previous version readable.
+    '''
+
+    def __init__(self, root='inputs/price_store', **fetch_kwargs):
+        self.root         = root
+        self.fetch_kwargs = fetch_kwargs # passed on to fetch_prices
+        self.fetch_stats  = []           # per chunk stats from the last fetch
+        self.rescaled     = {}           # ticker: ratio its stored history was rescaled by, last fetch
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def _load(self):
+
+        try:
+            with open(self._path('meta.json')) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            meta = None
+
+        if meta is None or meta.get('version') != STORE_VERSION:
+            self.prices   = pd.DataFrame(index=pd.DatetimeIndex([]), dtype=np.float32)
+            self.coverage = {}
+            self.empty    = {}
+            self.rf       = None
+            return
+
+        values = np.load(self._path('prices.npy'))
+        dates  = np.load(self._path('dates.npy'))
+        self.prices   = pd.DataFrame(values, index=pd.DatetimeIndex(dates),
+                                     columns=meta['tickers'])
+        self.coverage = {t: (pd.Timestamp(s), pd.Timestamp(e))
+                         for t, (s, e) in meta['coverage'].items()}
+        self.empty    = {t: tuple(pd.Timestamp(x) for x in v) for t, v in meta.get('empty', {}).items()}
+        self.rf       = meta.get('risk_free_rate')
+
+    def _save(self):
+
+        os.makedirs(self.root, exist_ok=True)
+
+        values = np.asfortranarray(self.prices.to_numpy(dtype=np.float32))
+        dates  = self.prices.index.to_numpy().astype('datetime64[D]')
+        meta   = {'version'       : STORE_VERSION,
+                  'tickers'       : list(self.prices.columns),
+                  'coverage'      : {t: [str(s.date()), str(e.date())]
+                                     for t, (s, e) in self.coverage.items()},
+                  'empty'         : {t: [s.isoformat() for s in v] for t, v in self.empty.items()},
+                  'risk_free_rate': self.rf}
+
+        for name, arr in [('prices.npy', values), ('dates.npy', dates)]:
+            tmp = self._path(name + '.tmp')
+            with open(tmp, 'wb') as f:
+                np.save(f, arr)
+            os.replace(tmp, self._path(name))
+
+        tmp = self._path('meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._path('meta.json'))
+
+    def missing(self, tickers, start, end):
+        '''
+        Which ticker/date ranges haven't been fetched yet. A range that came
+        back empty for a ticker (see update) isn't asked for again until its
+        retry time; the rest of the request still is.
+
+        Returns a dict {(gap_start, gap_end): [tickers]} so tickers with the
+        same gap can be fetched in one provider call.
+        '''
+        start, end = _day(start), _day(end)
+        now  = pd.Timestamp.now()
+        gaps = {}
+        for t in tickers:
+            if t not in self.coverage:
+                todo = [(start, end)]
+            else:
+                # reaching OVERLAP into what's stored, to check it against
+                have_start, have_end = self.coverage[t]
+                todo = ([(start, have_start + OVERLAP)] if start < have_start else []) + \
+                       ([(have_end - OVERLAP, end)] if end > have_end else [])
+            if t in self.empty and now < self.empty[t][2]:
+                todo = [g for gap in todo for g in _subtract(gap, self.empty[t][:2])]
+            for gap in todo:
+                gaps.setdefault(gap, []).append(t)
+        return gaps
+
+    def update(self, prices, tickers, start, end):
+        '''
+        Merge freshly fetched prices in and mark [start, end) as covered for
+        the tickers that got values. If the range had trading days (other
+        tickers got rows, or it's longer than a holiday weekend) the ones
+        with nothing (delisted, or a download that failed quietly) have the
+        range recorded in empty and asked for again after EMPTY_RETRY, not
+        every call. A range without trading days marks nothing.
+        '''
+        start, end = _day(start), _day(end)
+        got        = set(prices.columns[prices.notna().any().to_numpy()]) if len(prices) else set()
+        traded     = bool(got) or len(pd.bdate_range(start, end - pd.Timedelta(days=1))) > 3
+
+        if len(prices):
+            prices = prices.copy()
+            prices.index = pd.DatetimeIndex(prices.index).tz_localize(None).normalize()
+            prices = prices[~prices.index.duplicated(keep='last')]
+            self._rescale(prices)
+            self.prices = prices.combine_first(self.prices).sort_index().astype(np.float32)
+
+        retry = pd.Timestamp.now() + EMPTY_RETRY
+        for t in tickers:
+            if t not in got:
+                if traded:
+                    lo, hi = start, end
+                    if t in self.empty and self.empty[t][0] <= end and start <= self.empty[t][1]:
+                        lo, hi = min(lo, self.empty[t][0]), max(hi, self.empty[t][1])
+                    self.empty[t] = (lo, hi, retry)
+                continue
+            self.empty.pop(t, None)
+            if t in self.coverage:
+                have_start, have_end = self.coverage[t]
+                self.coverage[t] = (min(start, have_start), max(end, have_end))
+            else:
+                self.coverage[t] = (start, end)
+
+    def _rescale(self, prices):
+        '''
+        Stored history of the tickers whose prices on the dates they share
+        with prices (the latest one) changed: scaled by new/old, the way
+        Yahoo rescaled it. Recorded in self.rescaled.
+        '''
+        cols  = prices.columns.intersection(self.prices.columns)
+        dates = prices.index.intersection(self.prices.index)
+        if not len(cols) or not len(dates):
+            return
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = (prices.loc[dates, cols].to_numpy(np.float64)
+                     / self.prices.loc[dates, cols].to_numpy(np.float64))
+        ratio = pd.DataFrame(ratio, index=dates, columns=cols).where(np.isfinite(ratio) & (ratio > 0))
+        ratio = ratio.ffill().iloc[-1].dropna()
+        ratio = ratio[(ratio - 1).abs() > RESCALE_TOL]
+        if len(ratio):
+            self.prices[ratio.index] = (self.prices[ratio.index] * ratio).astype(np.float32)
+            self.rescaled.update(ratio.to_dict())
+
+    def get_prices(self, tickers, start, end, provider=None):
+        '''
+        Prices for tickers over [start, end), fetching (and persisting) only
+        what isn't on disk yet. Tickers without data come back as all-NaN
+        columns. Tickers whose fetch failed aren't marked as covered, so the
+        next call tries them again; ones that came back empty are tried again
+        after EMPTY_RETRY. Stored history Yahoo has rescaled since is rescaled
+        too (self.rescaled).
+        '''
+        start, end = _day(start), _day(end)
+        gaps       = self.missing(tickers, start, end)
+
+        if gaps:
+            provider = provider or YahooProvider()
+            self.fetch_stats = []
+            self.rescaled    = {}
+            for (gap_start, gap_end), gap_tickers in gaps.items():
+                fetched, failed, stats = fetch_prices(provider, gap_tickers, gap_start, gap_end,
+                                                      **self.fetch_kwargs)
+                failed  = set(failed)
+                self.update(fetched, [t for t in gap_tickers if t not in failed], gap_start, gap_end)
+                self.fetch_stats.extend(stats)
+            self._save()
+
+        in_rng = (self.prices.index >= start) & (self.prices.index < end)
+        return self.prices.loc[in_rng].reindex(columns=list(tickers))
+
+    def get_risk_free_rate(self, start, end, provider=None):
+        '''
+        Latest risk free rate, refetched only when the requested end date
+        moves past the one stored.
+        '''
+        end = _day(end)
+        if self.rf is None or pd.Timestamp(self.rf['end']) < end:
+            provider = provider or YahooProvider()
+            rate     = provider.get_risk_free_rate(_day(start), end)
+            self.rf  = {'rate': rate, 'end': str(end.date())}
+            self._save()
+        return self.rf['rate']
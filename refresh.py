@@ -0,0 +1,271 @@
+'''
+Background refresh of the data the app serves (stale-while-revalidate).
+
+A rebuild (refresh) fetches what the price store lacks, re-estimates the
+moments, precomputes the themes and writes all of it to a new version folder
+under inputs/moments. Only when the folder is complete is CURRENT swapped to
+it (moments.publish_moments), in one rename. The app reads CURRENT on every
+rerun: until the swap it keeps serving the version it has, after it the next
+rerun of every session loads the new one. No restart, and no user request
+ever waits on a download or an estimate.
+
+    refresh()              one rebuild, in this process
+    refresh_if_stale()     a rebuild if the live version is older than
+                           max_age and no other refresh is running
+    start_in_background()  refresh_if_stale in a detached subprocess
+                           (python refresh.py --max-age ...), output to
+                           logs/refresh.log
+    Scheduler              a thread that calls start_in_background every so
+                           often (what the app runs with
+                           DASHBOARD_REFRESH_HOURS set)
+
+Only one refresh runs at a time: an OS lock on inputs/moments/.refresh.lock
+(flock; msvcrt.locking on Windows), which also holds the owner's pid, is
+taken for the whole rebuild. The OS drops it when the process exits,
+however it dies, so there's nothing stale to take over.
+
+From the command line (e.g. from cron, or instead of the app's scheduler):
+
+    python refresh.py                  rebuild now
+    python refresh.py --max-age 24     rebuild if the live version is > 24h old
+    python refresh.py --every 6 --max-age 24
+                                       check every 6h, forever
+'''
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+MOMENTS_ROOT = 'inputs/moments'
+LOCK_NAME    = '.refresh.lock'
+LOG_PATH     = 'logs/refresh.log'
+
+def artifact_age(root=MOMENTS_ROOT):
+    '''
+    Seconds since the live version was published (inf if there is none).
+    '''
+    try:
+        return time.time() - os.path.getmtime(os.path.join(root, 'CURRENT'))
+    except FileNotFoundError:
+        return float('inf')
+
+def _try_lock(fd, shared=False):
+    '''
+    Non-blocking OS lock on the file behind fd: True if taken. flock where
+    there is one; on Windows msvcrt.locking of the first byte (exclusive
+    only, so shared probes are exclusive there too).
+    '''
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        os.lseek(fd, 0, os.SEEK_SET)
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+    try:
+        fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+def _unlock(fd):
+    '''
+    Drop _try_lock's lock and close fd.
+    '''
+    try:
+        import fcntl # noqa: F401 (closing the fd drops an flock)
+    except ImportError:
+        import msvcrt
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    os.close(fd)
+
+class RefreshLock:
+    '''
+    Exclusive OS lock on a file under root (_try_lock), which also records
+    the owner's pid after a blank first byte (the byte Windows locks, which
+    others can't read). acquire() is non-blocking (False if another
+    process holds it).
+
+        with RefreshLock(root) as locked:
+            if locked: ...
+
+    The file itself stays; only the lock says who holds it, so there's no
+    window between creating the file and writing the pid in which another
+    process could take it over.
+    '''
+
+    def __init__(self, root=MOMENTS_ROOT):
+        self.path = os.path.join(root, LOCK_NAME)
+        self.held = False
+        self._fd  = None
+
+    def holder(self):
+        '''
+        pid of the process holding the lock (0 if it hasn't written it yet),
+        or None if nobody does.
+        '''
+        if self.held:
+            return os.getpid()
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except FileNotFoundError:
+            return None
+        if _try_lock(fd, shared=True):
+            _unlock(fd)
+            return None
+        try:
+            os.lseek(fd, 1, os.SEEK_SET)
+            return int(os.read(fd, 32).strip() or 0)
+        except (OSError, ValueError):
+            return 0
+        finally:
+            os.close(fd)
+
+    def acquire(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+        if not _try_lock(fd):
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, f' {os.getpid()}'.encode())
+        self._fd, self.held = fd, True
+        return True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            os.ftruncate(self._fd, 0)
+            _unlock(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+#############################################
+# rebuild
+#############################################
+
+def refresh(root=MOMENTS_ROOT, precompute=True, factors=None, dense=True, incremental=False,
+            max_workers=None, keep=3):
+    '''
+    Rebuild prices -> moments -> precomputed themes into a new version
+    folder and publish it. Returns the folder. Takes no lock (see
+    refresh_if_stale).
+    '''
+    from instrument import stage
+    from moments import load_moments, load_moments_store, publish_moments, save_moments
+    from update_data_cache import ESTIMATOR_PATH
+    from update_data_cache import precompute as precompute_themes
+
+    with stage('refresh_moments'):
+        moments = load_moments_store(factors=factors, dense=dense,
+                                     estimator_path=ESTIMATOR_PATH if incremental else None)
+        folder  = save_moments(moments, root, keep=keep, publish=False)
+    if precompute:
+        with stage('refresh_precompute'):
+            precompute_themes(load_moments(root, os.path.basename(folder)), max_workers=max_workers)
+    publish_moments(folder, keep)
+    return folder
+
+def refresh_if_stale(max_age=0, root=MOMENTS_ROOT, **refresh_kwargs):
+    '''
+    refresh() if the live version is older than max_age seconds (0: always)
+    and no other refresh holds the lock. Returns the new folder, or None if
+    nothing was done.
+    '''
+    if artifact_age(root) < max_age:
+        return None
+    with RefreshLock(root) as locked:
+        if not locked or artifact_age(root) < max_age: # someone may have just finished
+            return None
+        return refresh(root, **refresh_kwargs)
+
+def start_in_background(max_age=0, root=MOMENTS_ROOT, log_path=LOG_PATH):
+    '''
+    refresh_if_stale in a detached subprocess, so the caller (the app) never
+    waits on it and it finishes even if the caller exits. Returns the
+    Popen, or None if the live version is fresh or a refresh is running.
+    '''
+    if artifact_age(root) < max_age or RefreshLock(root).holder() is not None:
+        return None
+    os.makedirs(os.path.dirname(log_path) or '.', exist_ok=True)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'refresh.py')
+    with open(log_path, 'a') as log:
+        return subprocess.Popen([sys.executable, script, '--root', root, '--max-age', str(max_age/3600)],
+                                stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                                start_new_session=True)
+
+class Scheduler:
+    '''
+    Daemon thread: every `every` seconds, start_in_background(max_age).
+    The first check is right away.
+    '''
+
+    def __init__(self, every=3600, max_age=86400, root=MOMENTS_ROOT):
+        self.every   = every
+        self.max_age = max_age
+        self.root    = root
+        self.running = [] # refresh subprocesses not reaped yet
+        self._stop   = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='moments-refresh', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.running = [p for p in self.running if p.poll() is None] # reap finished ones
+            try:
+                proc = start_in_background(self.max_age, self.root)
+                if proc is not None:
+                    self.running.append(proc)
+            except OSError as e: # keep serving, try again next time
+                print(f'refresh not started: {e!r}', file=sys.stderr)
+            self._stop.wait(self.every)
+
+if __name__ == "__main__":
+
+  import argparse
+  from datetime import datetime
+
+  parser = argparse.ArgumentParser(description='Rebuild the moments artifact the app serves, '
+                                               'publishing it only once complete.')
+  parser.add_argument('--max-age', type=float, default=0, metavar='HOURS',
+                      help='only if the live version is older than this (default: always)')
+  parser.add_argument('--every', type=float, default=None, metavar='HOURS',
+                      help='keep running, checking this often')
+  parser.add_argument('--root', default=MOMENTS_ROOT)
+  parser.add_argument('--no-precompute', action='store_true')
+  parser.add_argument('--incremental', action='store_true',
+                      help='update the moments from inputs/estimator.npz (see update_data_cache.py)')
+  parser.add_argument('--factors', type=int, default=None, metavar='K')
+  parser.add_argument('--factors-only', action='store_true')
+  parser.add_argument('--workers', type=int, default=None, help='processes for the precompute')
+  args = parser.parse_args()
+
+  kwargs = dict(precompute=not args.no_precompute, factors=args.factors, dense=not args.factors_only,
+                incremental=args.incremental, max_workers=args.workers)
+  while True:
+    t0     = time.perf_counter()
+    folder = refresh_if_stale(args.max_age*3600, args.root, **kwargs)
+    print(f"{datetime.now():%Y-%m-%d %H:%M:%S} "
+          + (f"published {os.path.basename(folder)} in {time.perf_counter()-t0:.0f}s" if folder
+             else 'fresh enough, or another refresh is running'), flush=True)
+    if args.every is None:
+      break
+    time.sleep(args.every*3600)
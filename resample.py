@@ -0,0 +1,378 @@
+'''
+Resampled (bootstrap) utility loss, Michaud style.
+
+The dashboard's "Loss of Utility" comes from one set of estimates. Here the
+daily return history is bootstrapped (days drawn with replacement) many
+times, the moments re-estimated on each resample, and the S&P and theme
+tangency portfolios re-solved, giving a distribution of
+
+    max_utility_1 - max_utility_2      (S&P minus theme, per risk aversion)
+
+with confidence bands. Both portfolios are solved on the same resample, so
+the bands are for the difference, not two independent ones.
+
+Batched so it's fast enough to use from the app:
+
+    - a resample is a vector of counts (how often each day was drawn), so
+      the CAPM expected returns of every resample are a few (resamples x
+      days) @ (days x assets) products: one pass for all of them.
+    - covariances are never formed: each resample's is Z'Z for a stacked
+      (chunk x days x assets) factor Z built for a chunk at once.
+    - tangency portfolios come from tangency(), an active-set solve on Z
+      that builds only the covariance rows of assets it touches, warm
+      started from the assets the last few resamples held (CriticalLine if
+      it doesn't converge), on a process pool (chunks of resamples per
+      task). A long-lived server passes one shared pool (worker_pool)
+      instead of starting one per call.
+
+About 23ms a resample for the 434-asset universe on one core (1000 in ~23s,
+less with more workers); CriticalLine took ~80ms. Most of what's left is
+BLAS on the rows tangency() needs, so 1000 resamples in a few seconds takes
+several workers.
+
+Estimates follow get_data's estimators on the resampled history:
+capm_return exactly (with duplicated days counted as often as they were
+drawn), exp_cov with each drawn day keeping its own EWMA weight (by age in
+the original history) and days weighing less than tol of the newest left
+out (changes the result by less than tol, relatively). Missing returns count
+as 0 after demeaning, each asset normalized by the weight of the days it
+has, so every covariance is positive semidefinite without a fix (the same
+as factors.FactorCovariance.from_returns; exactly exp_cov with complete
+data).
+'''
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+class Resampler:
+    '''
+    Bootstrap resamples of a daily return history (date x ticker, NaN =
+    missing) and their moments.
+    '''
+
+    def __init__(self, returns, span=180, frequency=252, tol=1e-6):
+        X              = returns.to_numpy(dtype=np.float64)
+        M              = ~np.isnan(X)
+        self.tickers   = returns.columns
+        self.frequency = frequency
+        self.X0        = np.where(M, X, 0.)
+        self.M         = M.astype(np.float64)
+        self.mkt       = self.X0.sum(1) / M.sum(1) # equal-weighted market, like capm_return
+        decay          = 1 - 2/(span+1)
+        ages           = np.arange(len(X)-1, -1, -1.)
+        self.recent    = np.flatnonzero(decay**ages >= tol) # days that matter to exp_cov
+        self.weights   = decay**ages[self.recent]
+
+    def __len__(self):
+        return self.X0.shape[0]
+
+    def draw(self, n, seed=None):
+        '''
+        n resamples of the history: (n, days) counts, each row summing to
+        the number of days.
+        '''
+        T = len(self)
+        return np.random.default_rng(seed).multinomial(T, np.full(T, 1/T), size=n).astype(np.float64)
+
+    def expected_returns(self, counts, risk_free_rate=0.02):
+        '''
+        capm_return on each resample, (n, assets). counts of ones give the
+        estimate on the history itself.
+        '''
+        counts = np.atleast_2d(counts)
+        X0, M, mkt = self.X0, self.M, self.mkt
+        n      = counts @ M
+        sx     = counts @ X0
+        sxm    = counts @ (X0 * mkt[:, None])
+        smi    = counts @ (M * mkt[:, None])
+        T      = counts.sum(1)
+        sm     = counts @ mkt
+        var_m  = (counts @ mkt**2 - sm**2/T) / (T-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            betas = (sxm - sx*smi/n) / (n-1) / var_m[:, None]
+        market = np.expm1((counts @ np.log1p(mkt)) * self.frequency / T)
+        return risk_free_rate + betas * (market - risk_free_rate)[:, None]
+
+    def covariances(self, counts, positions=None):
+        '''
+        EWMA covariance of each resample, stacked: (n, assets, assets), for
+        the assets at positions (all if None).
+        '''
+        Z = self.factors(counts, positions)
+        return np.matmul(Z.transpose(0, 2, 1), Z)
+
+    def factors(self, counts, positions=None):
+        '''
+        Z with covariances() = Z'Z for each resample, stacked: (n, days,
+        assets), days the ones that matter to exp_cov. Cheaper to build than
+        the covariances (days x assets per resample, not assets^2) and all
+        tangency() needs.
+        '''
+        counts = np.atleast_2d(counts)
+        X0, M  = self.X0, self.M
+        if positions is not None:
+            X0, M = X0[:, positions], M[:, positions]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = (counts @ X0) / (counts @ M) # exp_cov demeans by the (resample's) plain mean
+        X0, M, W = X0[self.recent], M[self.recent], counts[:, self.recent] * self.weights
+        norm     = np.sqrt((W @ M) / self.frequency)
+
+        Z  = (X0[None] - mean[:, None, :]) * M[None]
+        Z *= np.sqrt(W)[:, :, None]
+        Z /= norm[:, None, :]
+        return Z
+
+def tangency(Z, excess, free=None, likely=None, tol=1e-10, max_iter=500):
+    '''
+    Long-only tangency portfolio for cov = Z'Z and excess returns mu - rf,
+    by a primal active set method on
+
+        min y'cov y   s.t.  excess'y = 1, y >= 0        (weights y/sum(y))
+
+    which only ever needs the rows of cov of the assets held (Z_S'Z, each
+    computed once, when the asset is first held). free (the assets held by a nearby problem,
+    e.g. the previous resample) is the warm start, less the ones it would
+    hold short; without it, the asset with the best excess return. The
+    rows of the likely assets (e.g. every one recent resamples held)
+    are computed up front in one product, which is much cheaper than one
+    at a time. A
+    resample's tangency holds almost the same assets as the last one's, so
+    this is a couple of small solves where CriticalLine traces the frontier
+    down to the tangency.
+
+    Returns (weights, free) or None if there's no asset with a positive
+    excess return or it didn't converge (use CriticalLine then).
+    '''
+    n = len(excess)
+    if not n or excess.max() <= 0:
+        return None
+
+    # rows of cov (= columns, it's symmetric), computed as assets are first held
+    cov  = np.empty((n, n))
+    have = np.zeros(n, dtype=bool)
+    if likely is not None and len(likely):
+        likely       = np.asarray(likely)
+        cov[likely]  = Z[:, likely].T @ Z
+        have[likely] = True
+
+    def rows(S):
+        new = S[~have[S]]
+        if len(new):
+            cov[new]  = Z[:, new].T @ Z
+            have[new] = True
+        return cov[S]
+
+    def solve(S):
+        x = np.linalg.solve(rows(S)[:, S], excess[S])
+        return x / (excess[S] @ x)
+
+    y = np.zeros(n)
+    S = np.sort(np.asarray(free)) if free is not None else np.empty(0, dtype=int)
+    while len(S): # drop what the warm start would hold short until it's long only
+        y_S = solve(S)
+        if (y_S > 0).all():
+            y[S] = y_S
+            break
+        S = S[y_S > 0]
+    if not len(S):
+        best    = np.argmax(excess)
+        S       = np.array([best])
+        y[best] = 1/excess[best]
+
+    for _ in range(max_iter):
+        target = solve(S)
+        step   = target - y[S]
+        shrink = step < 0
+        if (target >= 0).all() or not shrink.any():
+            y[S] = target
+            # multipliers of the assets not held: cov y - lambda excess >= 0
+            g      = y[S] @ rows(S)
+            lam    = g[S] @ y[S]                   # y'cov y = lambda excess'y = lambda
+            nu     = g - lam*excess
+            nu[S]  = np.inf
+            j      = np.argmin(nu)
+            if nu[j] >= -tol*max(lam*np.abs(excess).max(), 1e-300):
+                w = y / y.sum()
+                return w, S
+            S = np.sort(np.append(S, j))
+        else:
+            # go as far towards target as y >= 0 allows; the first to hit 0 leaves
+            ratios    = np.where(shrink, -y[S] / np.where(shrink, step, -1), np.inf)
+            k         = np.argmin(ratios)
+            y[S]     += ratios[k] * step
+            y[S[k]]   = 0.
+            S         = np.delete(S, k)
+    return None
+
+def history_returns(store, years=10, price_store=None):
+    '''
+    Daily returns of store's tickers (a MomentsStore) over the window its
+    moments were estimated on, from what the local price store already has
+    (no downloads; tickers it lacks are left out).
+    '''
+    from dateutil.relativedelta import relativedelta
+
+    from estimator import _returns
+    from price_store import PriceStore
+
+    end    = pd.Timestamp(store.as_of) + pd.Timedelta(days=1)
+    start  = end - relativedelta(years=years)
+    prices = (price_store or PriceStore()).prices
+    prices = prices.loc[(prices.index >= start) & (prices.index < end), prices.columns.isin(store.tickers)]
+    return _returns(prices.astype(np.float64)).dropna(axis=1, how='all')
+
+#############################################
+# tangency portfolios on a process pool
+#############################################
+
+_WORKER     = None # per worker process: resampler, theme positions, rf rate
+LIKELY_FROM = 8    # a tangency precomputes cov for what the last this many resamples held
+
+def _init_worker(resampler, positions, rf_rate):
+    global _WORKER
+    _WORKER = (resampler, positions, rf_rate)
+
+def _tangencies(task, state=None):
+    '''
+    [ret, vol] of the universe's and the theme's tangency portfolio, for a
+    block of resamples: (block, 2, 2). Factors are built chunk resamples at
+    a time; each tangency starts from the assets the previous resample's
+    held (tangency()), CriticalLine if that doesn't work out.
+    '''
+    from frontier import CriticalLine
+
+    counts, e_returns, chunk = task
+    resampler, pos, rf       = state or _WORKER
+    out                      = np.empty((len(counts), 2, 2))
+    held                     = [[], []] # assets held in the last few resamples
+    for i in range(0, len(counts), chunk):
+        factors = resampler.factors(counts[i:i+chunk])
+        for k, (mu, Z) in enumerate(zip(e_returns[i:i+chunk], factors), i):
+            for j, (mu_j, Z_j) in enumerate([(mu, Z), (mu[pos], Z[:, pos])]):
+                recent = held[j][-LIKELY_FROM:]
+                found  = tangency(Z_j, mu_j - rf, recent[-1] if recent else None,
+                                  np.unique(np.concatenate(recent)) if recent else None)
+                if found is None:
+                    cla = CriticalLine(mu_j, Z_j.T @ Z_j, tangency_rf=rf)
+                    w   = cla.max_sharpe(rf)
+                else:
+                    w   = found[0]
+                    held[j].append(found[1])
+                out[k, j] = w @ mu_j, np.linalg.norm(Z_j @ w)
+    return out
+
+def _tangencies_with(task):
+    '''
+    _tangencies for a shared pool: the task carries the worker state.
+    '''
+    state, task = task
+    return _tangencies(task, state)
+
+def worker_pool(max_workers):
+    '''
+    A process pool to pass to resampled_utility_loss(pool=...) across
+    calls, so a server starts (and imports numpy in) its workers once and
+    concurrent requests share max_workers processes. Spawned, not forked:
+    safe from inside the app's threaded server.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+def resampled_utility_loss(returns, positions, risk_aversions, rf_rate, resamples=1000, seed=0,
+                           max_workers=None, chunk=16, bands=(5, 95), pool=None, **resampler_kwargs):
+    '''
+    Bootstrap distribution of the utility loss of the theme at positions
+    (columns of returns) against all of returns' columns, for each risk
+    aversion. Tangency solves run on a process pool of max_workers (None =
+    one per cpu; 0 or 1 = in this process), chunk resamples per task.
+
+    pool: an executor from worker_pool(max_workers) to run on instead of a
+    new pool. Its workers don't have this call's data, so the resamples
+    are split into one block per worker, each task carrying the resampler.
+
+    Returns a dict:
+
+        risk_aversions  (A,)
+        loss            (resamples, A) utility loss on each resample
+        mean, median    (A,)
+        lower, upper    (A,) the bands percentiles of loss
+        tangency        (resamples, 2, 2) [ret, vol] of the universe's
+                        (0) and theme's (1) tangency portfolio
+        seconds
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+
+    from frontier import cml_utility
+
+    t0             = time.perf_counter()
+    risk_aversions = np.asarray(risk_aversions, dtype=np.float64)
+    positions      = np.asarray(positions)
+    resampler      = Resampler(returns, **resampler_kwargs)
+    counts         = resampler.draw(resamples, seed)
+    e_returns      = resampler.expected_returns(counts, rf_rate) # every resample in one pass
+    tasks          = [(counts[i:i+chunk], e_returns[i:i+chunk], chunk) for i in range(0, resamples, chunk)]
+
+    workers = max_workers if max_workers is not None else os.cpu_count() or 1
+    if pool is not None:
+        state    = (resampler, positions, rf_rate)
+        cuts     = np.linspace(0, resamples, max(workers, 1)+1).round().astype(int)
+        blocks   = [(state, (counts[a:b], e_returns[a:b], chunk)) for a, b in zip(cuts[:-1], cuts[1:]) if b > a]
+        tangency = np.concatenate(list(pool.map(_tangencies_with, blocks)))
+    elif workers <= 1:
+        _init_worker(resampler, positions, rf_rate)
+        tangency = np.concatenate([_tangencies(task) for task in tasks])
+    else:
+        # spawned, not forked: safe from inside the app's threaded server
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(resampler, positions, rf_rate)) as pool:
+            tangency = np.concatenate(list(pool.map(_tangencies, tasks)))
+
+    # every resample x risk aversion at once: (resamples, 2, A)
+    _, _, _, utilities = cml_utility(rf_rate, tangency[:, :, :1], tangency[:, :, 1:], risk_aversions)
+    loss         = utilities[:, 0] - utilities[:, 1]
+    lower, upper = np.percentile(loss, bands, axis=0)
+    return {'risk_aversions': risk_aversions,
+            'loss'          : loss,
+            'mean'          : loss.mean(0),
+            'median'        : np.median(loss, 0),
+            'lower'         : lower,
+            'upper'         : upper,
+            'tangency'      : tangency,
+            'seconds'       : time.perf_counter() - t0}
+
+if __name__ == "__main__":
+
+  import argparse
+
+  from themes import DEFAULT_RISK_AVERSION, RISK_LEVELS, THEMES, ThemeIndex, theme_key
+
+  parser = argparse.ArgumentParser(description='Bootstrap confidence bands on the utility loss of a theme.')
+  parser.add_argument('--theme', default='ESG Investing', choices=THEMES)
+  parser.add_argument('--sectors', nargs='*', default=[], help="with --theme Sector")
+  parser.add_argument('--resamples', type=int, default=1000)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--workers', type=int, default=None, help='processes (default: one per cpu)')
+  args = parser.parse_args()
+
+  from moments import load_moments
+
+  store     = load_moments()
+  returns   = history_returns(store)
+  index     = ThemeIndex.from_csv(universe=returns.columns)
+  A         = list(RISK_LEVELS.values()) + [DEFAULT_RISK_AVERSION]
+  out       = resampled_utility_loss(returns, index.theme_positions(args.theme, args.sectors), A,
+                                     store.rf_rate, resamples=args.resamples, seed=args.seed,
+                                     max_workers=args.workers)
+
+  print(f"{theme_key(args.theme, args.sectors)}: {args.resamples} resamples of {len(returns)} days x "
+        f"{returns.shape[1]} assets in {out['seconds']:.1f}s")
+  print(f"{'A':>6s} {'mean':>8s} {'median':>8s} {'5%':>8s} {'95%':>8s}")
+  for row in zip(A, out['mean'], out['median'], out['lower'], out['upper']):
+    print(f"{row[0]:6.2f} " + ' '.join(f'{x:8.4f}' for x in row[1:]))
@@ -0,0 +1,165 @@
+'''
+Process-wide LRU cache for optimization results, bounded in bytes.
+
+st.cache_data pickles every return value in and out (a copy per call),
+hashes its arguments on every call and keeps every entry for the life of
+the server, so every sector combination anyone ever picked stays in memory.
+ResultCache instead:
+
+    - keys on a canonical hash of what a result depends on (result_key):
+      the sorted ticker set, the moments version and the estimator. The
+      same stocks reached through different themes share an entry.
+    - keeps values as they are, with numpy arrays frozen read-only, so a
+      hit is a dict lookup: no pickling, no copy.
+    - evicts the least recently used entries once over max_bytes.
+    - computes a missing key once even if several sessions ask at once.
+    - counts hits, misses, evictions, entries and bytes (stats()), for
+      sizing it.
+
+Usage:
+
+    cache = ResultCache(max_bytes=64e6)
+    value, hit = cache.get_or_compute(result_key(tickers, version, estimator), compute)
+'''
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+ENTRY_OVERHEAD = 256 # bytes charged per entry/container on top of its arrays
+
+def result_key(tickers, version, estimator, **params):
+    '''
+    Canonical key: the same for any order of the same tickers.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps([str(version), str(estimator), sorted((k, str(v)) for k, v in params.items())]).encode())
+    for t in sorted(map(str, tickers)):
+        h.update(t.encode() + b'\0')
+    return h.hexdigest()
+
+def freeze(value):
+    '''
+    value with every numpy array in it made read-only (in place, no copy)
+    and lists turned into tuples.
+    '''
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+        return value
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, dict):
+        return {k: freeze(v) for k, v in value.items()}
+    return value
+
+def sizeof(value):
+    '''
+    Approximate bytes held by value: array buffers plus a flat charge per
+    container.
+    '''
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return ENTRY_OVERHEAD + sum(sizeof(v) for v in value)
+    if isinstance(value, dict):
+        return ENTRY_OVERHEAD + sum(sizeof(v) for v in value.values())
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return 8
+
+class ResultCache:
+    '''
+    Thread-safe LRU of frozen values, at most max_bytes (by sizeof). A value
+    bigger than the whole budget is returned but not kept.
+    '''
+
+    def __init__(self, max_bytes=64e6):
+        self.max_bytes = int(max_bytes)
+        self.bytes     = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self._entries  = OrderedDict() # key -> (value, nbytes), oldest first
+        self._lock     = threading.Lock()
+        self._pending  = {}            # key -> lock held while it's computed
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._get(key, default)
+
+    def _get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        '''
+        Store value (frozen) under key, evicting as needed. Returns it.
+        '''
+        value  = freeze(value)
+        nbytes = sizeof(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            if nbytes > self.max_bytes:
+                return value
+            self._entries[key] = (value, nbytes)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                _, (_, freed) = self._entries.popitem(last=False)
+                self.bytes     -= freed
+                self.evictions += 1
+        return value
+
+    def get_or_compute(self, key, compute):
+        '''
+        (value, hit). On a miss compute() runs once per key: concurrent
+        callers for the same key wait for it instead of computing again.
+        '''
+        missing = object()
+        with self._lock:
+            value = self._get(key, missing)
+            if value is not missing:
+                return value, True
+            key_lock = self._pending.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                value = self._get(key, missing) # someone else just computed it
+                if value is not missing:
+                    return value, True
+                self.misses += 1
+            try:
+                return self.put(key, compute()), False
+            finally:
+                with self._lock:
+                    self._pending.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries'  : len(self._entries),
+                    'bytes'    : self.bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits'     : self.hits,
+                    'misses'   : self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate' : self.hits / lookups if lookups else 0.}
@@ -0,0 +1,209 @@
+'''
+The theme menu, the sector list and the risk buttons, plus ThemeIndex to
+turn a choice into positions in the moments matrix. Lives outside app.py so
+update_data_cache.py can precompute every theme without starting streamlit.
+
+get_theme_assets is the original lookup (re-reads and re-sorts
+data_scores.csv, returns tickers); ThemeIndex gives the same themes from
+arrays built once.
+'''
+
+import numpy as np
+import pandas as pd
+
+THEMES = ('ESG Investing', 'L,E,H,I,G,H', 'I like my beta low', 'I am not high, beta is', 'Sector','Cheapest Stocks')
+
+SECTORS = ['Industrials', 'Healthcare', 'Technology', 'Utilities', 'Financial Services', 'Basic Materials', 'Consumer Cyclical', 'Real Estate', 'Communication Services', 'Consumer Defensive', 'Energy']
+
+# todo - didn't think about these numbers AT ALL, adjust them
+RISK_LEVELS = {
+    ":rainbow[Mild Risk]"    : 3,
+    ":rainbow[Moderate]"     : 2.5,
+    ":rainbow[Elevated Risk]": 2,
+    ":rainbow[Severe Risk]"  : 1.75,
+    ":rainbow[Extreme Risk]" : .05,
+}
+DEFAULT_RISK_AVERSION = 10 # nothing picked yet
+
+SP500_KEY = 'S&P 500'
+
+def theme_key(option, selected_sectors=()):
+    '''
+    Name a theme choice, e.g. 'ESG Investing' or 'Sector: Energy, Utilities'
+    (sectors sorted, so the order they were picked in doesn't matter).
+    '''
+    if option == 'Sector':
+        return 'Sector: ' + ', '.join(sorted(selected_sectors))
+    return option
+
+def get_theme_assets(option, selected_sectors):
+    """
+    Returns a list of assets based on the selected theme and risk level.
+    """
+    stocks = pd.read_csv('inputs/data_scores.csv')
+
+    if option == 'ESG Investing':
+        #The df needs to be subsetted into one row per firm
+        stocks = stocks.sort_values('Total-Score', ascending=False)
+        subset_asset_list = stocks['Ticker'].tolist()[:100]
+    elif option == 'L,E,H,I,G,H':
+        subset_asset_list = stocks[stocks['Ticker'].str.contains('L|E|H|I|G|H', case=False)]['Ticker'].tolist()
+    elif option == 'I like my beta low':
+        stocks = stocks[stocks['Beta'].notnull()]  # Exclude rows with missing 'Beta' values
+        stocks = stocks.sort_values('Beta', ascending=True)
+        subset_asset_list = stocks['Ticker'].tolist()[:50]
+    elif option == 'I am not high, beta is':
+        stocks = stocks[stocks['Beta'].notnull()]
+        stocks = stocks.sort_values('Beta', ascending=False)
+        subset_asset_list = stocks['Ticker'].tolist()[:50]
+    elif option == 'Cheapest Stocks':
+        stocks = stocks.sort_values('Price', ascending=True)
+        subset_asset_list = stocks['Ticker'].tolist()[:50]
+    elif option == 'Sector':
+        stocks = stocks[stocks['Sector'].isin(selected_sectors)]
+        subset_asset_list = stocks['Ticker'].tolist()
+    return subset_asset_list
+
+def fixed_themes():
+    '''
+    Every choice the menu offers without a multiselect: the fixed themes and
+    each single sector. (option, selected_sectors) pairs.
+    '''
+    return ([(option, []) for option in THEMES if option != 'Sector']
+            + [('Sector', [sector]) for sector in SECTORS])
+
+#############################################
+# theme index
+#############################################
+
+# option -> (column, how many, ascending) for the "top n by a score" themes
+TOP_N_THEMES = {
+    'ESG Investing'         : ('Total-Score', 100, False),
+    'I like my beta low'    : ('Beta', 50, True),
+    'I am not high, beta is': ('Beta', 50, False),
+    'Cheapest Stocks'       : ('Price', 50, True),
+}
+SORT_COLUMNS = ('Total-Score', 'Beta', 'Price')
+
+def _letter_bits(tickers):
+    '''
+    One uint32 per ticker, bit i set if letter chr(65+i) is in it (any case).
+    '''
+    codes   = np.char.upper(np.asarray(tickers, dtype=str))
+    codes   = codes.view(np.uint32).reshape(len(codes), -1) - ord('A') # padding/non-letters wrap past 25
+    letters = codes < 26
+    bits    = np.where(letters, np.left_shift(np.uint32(1), np.where(letters, codes, 0)), 0)
+    return np.bitwise_or.reduce(bits, axis=1).astype(np.uint32)
+
+class ThemeIndex:
+    '''
+    data_scores.csv indexed once (per data version), so a theme resolves to
+    an integer array of positions in the moments matrix in microseconds.
+
+    Selectors return boolean masks over the rows of data_scores, so themes
+    compose with & / | / ~, e.g. tech stocks in the top 100 ESG that are
+    also low beta:
+
+        idx  = ThemeIndex.from_csv(universe=store.tickers)
+        mask = idx.sector('Technology') & idx.top('Total-Score', 100) & idx.top('Beta', 50, ascending=True)
+        store.subset(positions=idx.positions(mask, by='Total-Score'))
+
+    universe is the ticker order positions refer to (e.g. MomentsStore.tickers);
+    rows whose ticker isn't in it are left out of positions.
+    '''
+
+    def __init__(self, scores, universe=None):
+
+        self.tickers = scores['Ticker'].to_numpy(dtype=str)
+        universe     = pd.Index(self.tickers if universe is None else universe)
+        self._pos    = universe.get_indexer(self.tickers) # -1 = not in universe
+
+        # sort permutations (NaNs dropped), per column and direction
+        self._order   = {}
+        self._missing = {}
+        for col in SORT_COLUMNS:
+            values = scores[col].to_numpy(dtype=np.float64)
+            valid  = np.flatnonzero(~np.isnan(values))
+            self._missing[col] = np.flatnonzero(np.isnan(values))
+            asc    = valid[np.argsort(values[valid], kind='stable')]
+            self._order[col, True]  = asc
+            self._order[col, False] = valid[np.argsort(-values[valid], kind='stable')]
+
+        sectors       = scores['Sector'].to_numpy()
+        self._sectors = {sector: sectors == sector for sector in pd.unique(sectors)}
+        self._letters = _letter_bits(self.tickers)
+
+    @classmethod
+    def from_csv(cls, path='inputs/data_scores.csv', universe=None):
+        return cls(pd.read_csv(path), universe)
+
+    def __len__(self):
+        return len(self.tickers)
+
+    # selectors: boolean masks over data_scores rows
+
+    def top(self, column, n, ascending=False):
+        '''
+        The n highest (lowest if ascending) rows by column.
+        '''
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self._order[column, ascending][:n]] = True
+        return mask
+
+    def sector(self, *sectors):
+        '''
+        Rows in any of sectors.
+        '''
+        mask = np.zeros(len(self), dtype=bool)
+        for sector in sectors:
+            if sector in self._sectors:
+                mask |= self._sectors[sector]
+        return mask
+
+    def has_any(self, letters):
+        '''
+        Rows whose ticker contains any of letters (any case).
+        '''
+        want = _letter_bits([letters])[0]
+        return (self._letters & want) != 0
+
+    def mask(self, option, selected_sectors=()):
+        '''
+        Rows in a menu theme (same themes as get_theme_assets).
+        '''
+        if option in TOP_N_THEMES:
+            column, n, ascending = TOP_N_THEMES[option]
+            return self.top(column, n, ascending)
+        if option == 'L,E,H,I,G,H':
+            return self.has_any('LEHIG')
+        if option == 'Sector':
+            return self.sector(*selected_sectors)
+        raise KeyError(option)
+
+    # resolve
+
+    def positions(self, mask, by=None, ascending=False):
+        '''
+        Universe positions of the rows in mask, in data_scores order (or
+        sorted by column `by`, rows where it's missing going last).
+        '''
+        if by is None:
+            rows = np.flatnonzero(mask)
+        else:
+            order, missing = self._order[by, ascending], self._missing[by]
+            rows = np.concatenate([order[mask[order]], missing[mask[missing]]])
+        pos = self._pos[rows]
+        return pos[pos >= 0]
+
+    def theme_positions(self, option, selected_sectors=()):
+        '''
+        Universe positions for a menu theme, ordered like get_theme_assets.
+        '''
+        column, _, ascending = TOP_N_THEMES.get(option, (None, None, False))
+        return self.positions(self.mask(option, selected_sectors), by=column, ascending=ascending)
+
+    def theme_tickers(self, option, selected_sectors=()):
+        '''
+        Tickers in a menu theme, whether or not they're in the universe.
+        '''
+        return self.tickers[self.mask(option, selected_sectors)].tolist()
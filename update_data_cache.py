@@ -1,21 +1,38 @@
-# todo set up github actions to recompute these monthly 
+# scheduled refreshes (while the app keeps serving): see refresh.py
 
-def get_data(asset_list=None):
+import os
+
+ESTIMATOR_PATH = 'inputs/estimator.npz'
+
+def get_data(asset_list=None, provider=None, store=None, estimator_path=None, factors=None):
     '''
     asset_list is a list of tickers, allowing this to be used with custom list 
     of assets.
     
     If none given, uses the default list of ETF assets picked by WSB team.
+
+    Prices come from the local PriceStore (inputs/price_store), which only asks
+    the provider (Yahoo/FRED unless one is passed) for dates and tickers it
+    doesn't have yet.
+
+    With estimator_path (e.g. 'inputs/estimator.npz') the moments come from
+    a MomentsEstimator kept there (estimator.py): only the days that entered
+    or left the 10 year window since the last run are applied, instead of
+    re-estimating from scratch. Same numbers. It is rebuilt if the tickers
+    passing the history filter changed.
+
+    With factors=K the covariance is a K-factor model (factors.py) instead
+    of exp_cov, and nothing N x N is estimated: for 3000+ name universes.
     '''
   
     import csv
     from datetime import datetime
     import numpy as np
+    import pandas as pd
     from dateutil.relativedelta import relativedelta
-    import pandas_datareader as pdr
-    import yfinance as yf
 
-    from pypfopt import expected_returns, risk_models
+    from instrument import stage
+    from price_store import PriceStore
 
     # get etf prices
 
@@ -33,37 +50,238 @@ def get_data(asset_list=None):
     start  = datetime.now() - relativedelta(years=10)
     end    = datetime.now() 
 
-    asset_prices = yf.download(asset_list, start=start, end=end, progress=False)
-    asset_prices = asset_prices.filter(like='Adj Close') # reduce to just columns with this in the name
-    asset_prices.columns = asset_prices.columns.get_level_values(1)
+    estimator = None
+    if estimator_path:
+        from estimator import MomentsEstimator
+        try:
+            estimator = MomentsEstimator.load(estimator_path)
+        except FileNotFoundError:
+            pass
+
+    # from the old window start if there's an estimator (the days leaving the
+    # window are taken out of it), already on disk anyway
+
+    fetch_start = min(start, estimator.start) if estimator is not None else start
+
+    store = store or PriceStore()
+    with stage('prices', assets=len(asset_list)) as rec: # downloads only what the store lacks
+        all_prices = store.get_prices(asset_list, fetch_start, end, provider=provider)
+        rec['fetched_chunks'] = len(store.fetch_stats)
+    asset_prices = all_prices.loc[all_prices.index >= pd.Timestamp(start).normalize()]
 
     # drop assets with insufficient data (2 years, or 20% of request)
     
     valid_cols = asset_prices.isin([' ','NULL',np.nan]).mean() < .8
-    asset_prices = asset_prices.loc[:, valid_cols]
+    asset_prices = asset_prices.loc[:, valid_cols].astype(np.float64) # store keeps float32
 
     # get risk free rate
 
-    risk_free_rate = pdr.DataReader("IRLTLT01USM156N", "fred", start,end)
-    risk_free_rate = risk_free_rate.iloc[-1]/100
-    risk_free_rate = risk_free_rate.item()
+    with stage('risk_free_rate'):
+        risk_free_rate = store.get_risk_free_rate(start, end, provider=provider)
 
     # compute e_returns (capm with current rf), cov_mat
 
-    e_returns = expected_returns.capm_return(asset_prices,risk_free_rate=risk_free_rate )#, span = 200)
-    cov_mat   = risk_models.exp_cov(asset_prices)#,span=100)
+    if factors:
+        from estimator import MomentsEstimator
+        from factors import FactorCovariance
+        with stage('capm_return', assets=asset_prices.shape[1]): # capm_return's numbers, O(N)
+            e_returns = MomentsEstimator.from_prices(asset_prices, start, covariance=False
+                                                     ).expected_returns(risk_free_rate)
+        with stage('factor_cov', assets=asset_prices.shape[1], factors=factors):
+            cov_mat   = FactorCovariance.from_prices(asset_prices, factors)
+        return e_returns, cov_mat, risk_free_rate
+
+    if estimator_path:
+        with stage('estimator_update', assets=asset_prices.shape[1]) as rec:
+            if estimator is None or list(estimator.tickers) != list(asset_prices.columns):
+                estimator      = MomentsEstimator.from_prices(asset_prices, start)
+                rec['rebuilt'] = True
+            else:
+                rec['days_added'], rec['days_removed'] = estimator.refresh(
+                    all_prices.loc[:, valid_cols].astype(np.float64), start)
+            estimator.save(estimator_path)
+        with stage('estimator_moments', assets=asset_prices.shape[1]):
+            e_returns, cov_mat = estimator.moments(risk_free_rate)
+        return e_returns, cov_mat, risk_free_rate
+
+    # pypfopt (and the cvxpy it pulls in, ~2s) only on this path
+
+    from pypfopt import expected_returns, risk_models
+
+    with stage('capm_return', assets=asset_prices.shape[1]):
+        e_returns = expected_returns.capm_return(asset_prices,risk_free_rate=risk_free_rate )#, span = 200)
+    with stage('exp_cov', assets=asset_prices.shape[1]):
+        cov_mat   = risk_models.exp_cov(asset_prices)#,span=100)
 
     return e_returns, cov_mat, risk_free_rate
   
+#############################################
+# batch mode: precompute every fixed theme x risk level
+#############################################
+
+def factor_report(store=None, points=200):
+    '''
+    How far each fixed theme's frontier (and the S&P one) moves when solved
+    on the artifact's factor covariance instead of the dense one (see
+    factors.frontier_deviation). Saved next to the artifact as
+    factor_report.json.
+    '''
+    import json
+    import numpy as np
+
+    from factors import frontier_deviation
+    from moments import load_moments
+    from themes import SP500_KEY, ThemeIndex, fixed_themes, theme_key
+
+    store  = store or load_moments()
+    if store.cov_mat is None or store.factors is None:
+        raise ValueError('the artifact needs both the dense and the factor covariance '
+                         '(update_data_cache.py --factors K)')
+    themes = ThemeIndex.from_csv(universe=store.tickers)
+
+    tasks  = [(SP500_KEY, np.arange(len(store)))]
+    tasks += [(theme_key(option, sectors), themes.theme_positions(option, sectors))
+              for option, sectors in fixed_themes()]
+
+    report = {}
+    for key, positions in tasks:
+        if len(positions) < 2:
+            continue
+        e_returns, cov_mat, rf_rate = store.subset(positions=positions, factor=False)
+        report[key] = frontier_deviation(e_returns, cov_mat, store.factors.subset(positions), rf_rate, points)
+
+    if store.folder is not None:
+        tmp = os.path.join(store.folder, 'factor_report.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(report, f, indent=1)
+        os.replace(tmp, os.path.join(store.folder, 'factor_report.json'))
+    return report
+
+def precompute(store=None, max_workers=None):
+    '''
+    Solve the S&P universe, every fixed theme and each single sector for
+    every risk level, together (batch.SubsetSolver, on a process pool), and
+    save the results next to the moments artifact (precomputed.json) for the
+    app to look up.
+    '''
+    import numpy as np
+
+    from batch import SubsetSolver
+    from moments import load_moments, save_precomputed
+    from themes import (DEFAULT_RISK_AVERSION, RISK_LEVELS, SP500_KEY,
+                        ThemeIndex, fixed_themes, theme_key)
+
+    store          = store or load_moments()
+    risk_aversions = list(RISK_LEVELS.values()) + [DEFAULT_RISK_AVERSION]
+
+    themes         = ThemeIndex.from_csv(universe=store.tickers)
+
+    tasks  = [(SP500_KEY, np.arange(len(store)))]
+    tasks += [(theme_key(option, sectors), themes.theme_positions(option, sectors))
+              for option, sectors in fixed_themes()]
+
+    results = {}
+    with SubsetSolver(store, risk_aversions, max_workers=max_workers) as solver:
+        for (key, _), solved in zip(tasks, solver.solve([positions for _, positions in tasks])):
+            if solved is None:
+                continue
+            ret_ef, vol_ef = solved['ef_points']
+            results[key]   = {'n_assets'     : solved['n_assets'],
+                              'ef_points'    : [ret_ef.tolist(), vol_ef.tolist()],
+                              'tangency_port': solved['tangency_port'].tolist(),
+                              'max_util'     : {str(A): {'port': [float(r), float(v)], 'utility': round(float(u), 4)}
+                                                for A, _, r, v, u in zip(risk_aversions, *solved['max_util'])}}
+
+    save_precomputed(store.folder, {'as_of'         : store.as_of,
+                                    'risk_aversions': risk_aversions,
+                                    'themes'        : results})
+    return results
+
 if __name__ == "__main__":
 
-  e_returns, cov_mat, risk_free_rate = get_data()
-  
-  e_returns.to_csv('inputs/e_returns.csv')
-  cov_mat.to_csv('inputs/cov_mat.csv')
+  import argparse
+
+  parser = argparse.ArgumentParser(description='Refresh the moments artifact in inputs/moments.')
+  parser.add_argument('--precompute', action='store_true',
+                      help='also precompute every fixed theme x risk level for the app')
+  parser.add_argument('--no-refresh', action='store_true',
+                      help="don't download, (re)precompute (or --factor-report) the current artifact")
+  parser.add_argument('--workers', type=int, default=None, help='processes for --precompute')
+  parser.add_argument('--incremental', action='store_true',
+                      help='update the moments from inputs/estimator.npz instead of re-estimating')
+  parser.add_argument('--check-drift', action='store_true',
+                      help='with --incremental: compare against a full re-estimate')
+  parser.add_argument('--factors', type=int, default=None, metavar='K',
+                      help='also fit a K-factor covariance (stored next to the dense one)')
+  parser.add_argument('--factors-only', action='store_true',
+                      help="with --factors: skip the dense covariance (large universes)")
+  parser.add_argument('--factor-report', action='store_true',
+                      help='compare factor vs dense frontiers for the current artifact')
+  parser.add_argument('--profile', nargs='?', const='time', choices=['time', 'memory'],
+                      help='log per-stage timings (and memory) to logs/stages.jsonl')
+  parser.add_argument('--trace-memory', action='store_true',
+                      help='peak memory per price chunk (tracemalloc; fetches one chunk at a time)')
+  args = parser.parse_args()
+
+  if args.profile:
+    os.environ['DASHBOARD_PROFILE'] = args.profile # so precompute workers pick it up too
+    import instrument
+    instrument.configure()
+
+  import pandas as pd
+
+  from price_store import PriceStore
+  from moments import load_moments, load_moments_store, publish_moments, save_moments
+
+  if not args.no_refresh:
+
+    store   = PriceStore(trace_memory=args.trace_memory)
+    moments = load_moments_store(store=store, # get_data + notes whether cov was made PSD
+                                 factors=args.factors, dense=not args.factors_only,
+                                 estimator_path=ESTIMATOR_PATH if args.incremental else None)
+    if moments.factors is not None:
+      print(f"{moments.factors.k} factors explain {moments.factors.explained():.1%} of the variance, "
+            f"{moments.factors.nbytes/1e6:.1f}MB"
+            + (f" vs {moments.cov_mat.nbytes/1e6:.1f}MB dense" if moments.cov_mat is not None else ''))
+
+    for i, chunk in enumerate(store.fetch_stats):
+        print(f"chunk {i:3d}: {chunk['tickers']:3d} tickers, {chunk['attempts']} attempt(s), "
+              f"{chunk['seconds']:6.2f}s, kept {chunk['bytes']/1e6:6.2f}MB"
+              + (f", peak {chunk['peak_bytes']/1e6:7.1f}MB" if 'peak_bytes' in chunk else '')
+              + (f", FAILED: {chunk['error']}" if chunk['error'] else ''))
+
+    if args.incremental and args.check_drift:
+      from estimator import MomentsEstimator
+      est   = MomentsEstimator.load(ESTIMATOR_PATH)
+      drift = est.drift(store.get_prices(list(est.tickers), est.start, est.dates[-1] + pd.Timedelta(days=1)))
+      print(f"estimator drift over {drift['days']} days: cov {drift['cov']:.2e}, returns {drift['returns']:.2e}")
+
+    # one artifact (inputs/moments) that the app memory-maps, made live
+    # once the precomputed results are in it
+
+    folder = save_moments(moments, publish=False)
+    print(f"wrote {folder}")
+
+  if args.precompute or (args.no_refresh and not args.factor_report):
+
+    root, version = os.path.split(folder) if not args.no_refresh else ('inputs/moments', None)
+    results = precompute(load_moments(root, version), max_workers=args.workers)
+    print(f"precomputed {len(results)} themes")
+
+  if not args.no_refresh:
+
+    publish_moments(folder)
+    print(f"published {os.path.basename(folder)}")
+
+  if args.factor_report:
 
-  with open('inputs/risk_free_rate.txt', 'w') as f:
-      f.write('%f' % risk_free_rate)
+    report = factor_report(load_moments())
+    print(f"{'theme':45s} {'assets':>6s} {'cov err':>8s} {'vol gap':>8s} {'eff loss':>8s} "
+          f"{'sharpe d/f':>12s} {'turnover':>8s} {'solve d/f (s)':>14s}")
+    for key, r in report.items():
+      print(f"{key[:45]:45s} {r['assets']:6d} {r['cov_error']:8.3f} {r['vol_gap_max']:8.4f} "
+            f"{r['efficiency_loss_max']:8.4f} {r['tangency']['dense'][2]:5.2f}/{r['tangency']['factor_dense'][2]:5.2f} "
+            f"{r['tangency']['turnover']:8.2f} {r['seconds_dense']:6.2f}/{r['seconds_factor']:6.2f}")
 
 
 # def get_theme_assets(option, start_year, end_year, risk_level):